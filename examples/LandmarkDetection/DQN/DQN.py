@@ -10,15 +10,22 @@ import os
 import sys
 import time
 import argparse
+import functools
 from collections import deque
 import tensorflow as tf
 from RL.medical import MedicalPlayer, FrameStack
+from RL.batchedEnv import BatchedMedicalEnv
+from RL.envPool import EnvPool
 from tensorpack.input_source import QueueInput
+from tensorpack.tfutils.sesscreate import NewSessionCreator
 from tensorpack_medical.models.conv3d import Conv3D
 from tensorpack_medical.models.pool3d import MaxPooling3D
-from RL.common import Evaluator, eval_model_multithread, play_n_episodes
+from RL.common import (Evaluator, eval_model_multithread, play_n_episodes, evaluate_files,
+                       evaluate_start_points, start_grid)
 from RL.DQNModel import Model3D as DQNModel
 from RL.expreplay import ExpReplay
+from RL.inference import InferenceServer
+from RL.actors import ActorPool
 
 from tensorpack import (PredictConfig, OfflinePredictor, get_model_loader,
                         logger, TrainConfig, ModelSaver, PeriodicTrigger,
@@ -63,28 +70,93 @@ EVAL_EPISODE = 50
 MAX_EPOCHS = 1000
 # Number of pretraining steps (only relevant for HITL)
 NUM_PRETRAIN = 100000
+# directory of the pre-processed volume cache (None disables caching)
+CACHE_DIR = None
+# directory of a prebuilt, memory mapped volume store (see utils/build_volume_store.py)
+STORE_DIR = None
+# number of volumes decoded ahead of time by each player (0 disables prefetching)
+PREFETCH = 0
+# dataset manifest used instead of --files/--type (see filesListLandmark.from_manifest)
+MANIFEST = None
+# visit the files in a new random order on every pass, with an optional seed
+SHUFFLE = None
+SEED = None
+# normalise intensities in place with numpy instead of SimpleITK filters
+FAST_NORM = False
+# pre-computed strided grids of every volume for the multiscale crops (None, 'stride' or 'antialias')
+PYRAMID = None
+# pad the pyramid grids so that every crop is a fixed-shape view (implies the 'stride' pyramid)
+PADDED_CROPS = False
+# number of training episodes stepped together with one prediction per step
+NUM_ENVS = 1
+# number of processes stepping the NUM_ENVS episodes (0 steps them in the training process)
+ENV_WORKERS = 0
+# the agent oscillates once it visits a location of its history more than this number of times
+OSCILLATION_THRESHOLD = 3
+# how FrameStack builds the stacked observations of play and eval ('stack', 'view' or 'copy')
+FRAME_STACK = 'stack'
+# store replay transitions as (volume, location, scale) references cropped again when sampled
+COMPACT_REPLAY = False
+# sampling of the replay memory, 'uniform' or 'prioritized' by the TD errors
+REPLAY = 'uniform'
+# priority exponent and initial importance sampling exponent (annealed to 1) of the prioritized replay
+PRIORITY_ALPHA = 0.6
+PRIORITY_BETA = 0.4
+# number of rewards summed in the returns of the TD targets
+N_STEP = 1
+# directories the replay memories are saved into next to the checkpoints and restored from
+REPLAY_SAVE_DIR = None
+REPLAY_RESTORE_DIR = None
+# map the restored replay frames from disk instead of loading them at once
+MMAP_REPLAY = False
+# demonstration buffer prebuilt from the HITL logs (None renders the logs, see utils/build_hitl_buffer.py)
+HITL_BUFFER = None
+# number of processes rendering the HITL logs (0 renders them in the training process)
+HITL_WORKERS = 0
+# largest batch of states of the simulator and evaluator threads predicted together (0 disables the inference server)
+INFERENCE_BATCH = 0
+# longest wait in seconds of the inference server for more states
+INFERENCE_LATENCY = 0.005
+# number of actor processes playing on the CPU with their own epsilon (0 plays in a simulator thread)
+ACTORS = 0
+# sampled transitions per transition of the actors (None: BATCH_SIZE / UPDATE_FREQ, as the simulator thread)
+REPLAY_RATIO = None
+# number of training steps between the weights sent to the actors
+SYNC_EVERY = 400
+# number of evaluation episodes stepped together with one prediction per step (0 plays them one at a time)
+EVAL_ENVS = 8
+# fractions of the volume dimensions of the start points of every evaluated file (None: one random start point)
+START_GRID = None
+# start from every point of the grid instead of those on the planes through the centre
+FULL_START_GRID = False
 
 ###############################################################################
 
 def get_player(directory=None, files_list= None, data_type=None, viz=False,
-               task='play', saveGif=False, saveVideo=False):
+               task='play', saveGif=False, saveVideo=False, shard=None):
     # in atari paper, max_num_frames = 30000
     env = MedicalPlayer(directory=directory, screen_dims=IMAGE_SIZE,
                         viz=viz, saveGif=saveGif, saveVideo=saveVideo,
-                        task=task, files_list=files_list, data_type=data_type, max_num_frames=1500)
+                        task=task, files_list=files_list, data_type=data_type, max_num_frames=1500,
+                        cache_dir=CACHE_DIR, store_dir=STORE_DIR, prefetch=PREFETCH,
+                        manifest=MANIFEST, shuffle=SHUFFLE, seed=SEED, shard=shard,
+                        fast_normalisation=FAST_NORM, pyramid=PYRAMID,
+                        padded_crops=PADDED_CROPS, oscillation_threshold=OSCILLATION_THRESHOLD)
 
     if task not in ['browse','train']:
         # in training, env will be decorated by ExpReplay, and history
         # is taken care of in expreplay buffer
         # otherwise, FrameStack modifies self.step to save observations into a queue
-        env = FrameStack(env, FRAME_HISTORY)
+        env = FrameStack(env, FRAME_HISTORY, mode=FRAME_STACK)
     return env
 
 ###############################################################################
 
 class Model(DQNModel):
-    def __init__(self,IMAGE_SIZE, FRAME_HISTORY, METHOD, NUM_ACTIONS, GAMMA, trainable_variables):
-        super(Model, self).__init__(IMAGE_SIZE, FRAME_HISTORY, METHOD, NUM_ACTIONS, GAMMA)
+    def __init__(self,IMAGE_SIZE, FRAME_HISTORY, METHOD, NUM_ACTIONS, GAMMA, trainable_variables,
+                 prioritized=False, n_step=1):
+        super(Model, self).__init__(IMAGE_SIZE, FRAME_HISTORY, METHOD, NUM_ACTIONS, GAMMA, prioritized,
+                                    n_step)
         self.conv_freeze = "CNN" not in trainable_variables
         if "FC" not in trainable_variables:
             self.fc_freeze = "FC_intermediate" not in trainable_variables
@@ -151,11 +223,57 @@ class Model(DQNModel):
 
 ###############################################################################
 
+def get_train_episode_player(files_list, data_type, i):
+    """Return the player of training episode i, sampling its shard of the files"""
+    return get_player(task='train', files_list=files_list, data_type=data_type,
+                      shard=(i, NUM_ENVS))
+
+def get_actor_player(file_names, data_type, i):
+    """Return the player of actor i, sampling its shard of the files"""
+    return get_player(task='train', files_list=[open(name) for name in file_names],
+                      data_type=data_type, shard=(i, ACTORS))
+
+def set_settings(settings):
+    """Set the settings of this module (the globals set from the arguments)
+    in a spawned actor process"""
+    globals().update(settings)
+
+def get_actor_predictor():
+    """Return the predictor of an actor, running on a single CPU thread"""
+    # the frozen layers only differ in training, the actors load all weights
+    return OfflinePredictor(PredictConfig(
+        model=Model(IMAGE_SIZE, FRAME_HISTORY, METHOD, NUM_ACTIONS, GAMMA, ['CNN', 'FC']),
+        session_creator=NewSessionCreator(config=tf.ConfigProto(
+            intra_op_parallelism_threads=1, inter_op_parallelism_threads=1)),
+        input_names=['state'],
+        output_names=['Qvalue']))
+
+def get_train_player(files_list, data_type):
+    """Return the training player, a BatchedMedicalEnv (or an EnvPool of
+    ENV_WORKERS processes) of NUM_ENVS players if NUM_ENVS > 1, or an
+    ActorPool of ACTORS processes"""
+    if ACTORS:
+        # the actors are spawned, they get the file names and the settings of this process
+        player_fn = functools.partial(get_actor_player, [f.name for f in files_list], data_type)
+        settings = {name: value for name, value in globals().items() if name.isupper()}
+        return ActorPool(player_fn, get_actor_predictor, ACTORS, FRAME_HISTORY,
+                         initializer=set_settings, initargs=(settings,))
+    if NUM_ENVS == 1 and not ENV_WORKERS:
+        return get_player(task='train', files_list=files_list, data_type=data_type)
+    player_fn = functools.partial(get_train_episode_player, files_list, data_type)
+    if ENV_WORKERS:
+        return EnvPool(player_fn, NUM_ENVS, ENV_WORKERS, IMAGE_SIZE)
+    return BatchedMedicalEnv([player_fn(i) for i in range(NUM_ENVS)])
+
 def get_config(files_list, data_type, trainable_variables):
     """This is only used during training."""
+    inference_server = None
+    if INFERENCE_BATCH:
+        inference_server = InferenceServer(['state'], ['Qvalue'], max_batch=INFERENCE_BATCH,
+                                           max_latency=INFERENCE_LATENCY)
     expreplay = ExpReplay(
         predictor_io_names=(['state'], ['Qvalue']),
-        player=get_player(task='train', files_list=files_list, data_type=data_type),
+        player=get_train_player(files_list, data_type),
         state_shape=IMAGE_SIZE,
         batch_size=BATCH_SIZE,
         memory_size=MEMORY_SIZE,
@@ -166,14 +284,30 @@ def get_config(files_list, data_type, trainable_variables):
         update_frequency=INIT_UPDATE_FREQ,
         ###############################################################################
         history_len=FRAME_HISTORY,
-        arg_type=data_type
+        arg_type=data_type,
+        compact=COMPACT_REPLAY,
+        prioritized=REPLAY == 'prioritized',
+        priority_alpha=PRIORITY_ALPHA,
+        priority_beta=PRIORITY_BETA,
+        n_step=N_STEP,
+        gamma=GAMMA,
+        save_dir=REPLAY_SAVE_DIR,
+        restore_dir=REPLAY_RESTORE_DIR,
+        mmap_restore=MMAP_REPLAY,
+        hitl_buffer=HITL_BUFFER,
+        hitl_workers=HITL_WORKERS,
+        inference_server=inference_server,
+        replay_ratio=REPLAY_RATIO,
+        sync_every=SYNC_EVERY
     )
 
     return TrainConfig(
         # dataflow=expreplay,
         data=QueueInput(expreplay),
-        model=Model(IMAGE_SIZE, FRAME_HISTORY, METHOD, NUM_ACTIONS, GAMMA, trainable_variables),
-        callbacks=[
+        model=Model(IMAGE_SIZE, FRAME_HISTORY, METHOD, NUM_ACTIONS, GAMMA, trainable_variables,
+                    prioritized=REPLAY == 'prioritized', n_step=N_STEP),
+        # the inference server runs before the callbacks predicting through it
+        callbacks=([inference_server] if inference_server else []) + [
             ModelSaver(),
             PeriodicTrigger(
                 RunOp(DQNModel.update_target_param, verbose=True),
@@ -206,10 +340,18 @@ def get_config(files_list, data_type, trainable_variables):
                 Evaluator(nr_eval=EVAL_EPISODE, input_names=['state'],
                           output_names=['Qvalue'], files_list=files_list,
                           data_type=data_type,
-                          get_player_fn=get_player),
+                          get_player_fn=get_player,
+                          inference_server=inference_server),
                 every_k_steps=STEPS_PER_EVAL),
             HumanHyperParamSetter('learning_rate'),
-        ],
+        ] + ([
+            # anneal the importance sampling correction of the prioritized replay to 1
+            ScheduledHyperParamSetter(
+                ObjAttrParam(expreplay, 'priority_beta'),
+                [(0, PRIORITY_BETA), (1000000, 1.0)],
+                interp='linear',
+                step_based=True),
+        ] if REPLAY == 'prioritized' else []),
         steps_per_epoch=STEPS_PER_EPOCH,
         max_epoch=MAX_EPOCHS,
     )
@@ -268,6 +410,67 @@ if __name__ == '__main__':
 
     parser.add_argument('--directory', help='file name to store evaluation results',
                         default=None)
+    parser.add_argument('--cacheDir', help='directory to cache pre-processed volumes, re-used across epochs and runs',
+                        default=None)
+    parser.add_argument('--volumeStore', help='directory of a prebuilt volume store, memory mapped and shared by all players',
+                        default=None)
+    parser.add_argument('--prefetch', help='number of volumes to decode ahead of time in a background thread',
+                        default=0, type=int)
+    parser.add_argument('--manifest', help='JSON manifest describing the dataset, replaces --files and --type',
+                        default=None)
+    parser.add_argument('--shuffle', help='sample the files in a new random order on every pass',
+                        action='store_true', default=None)
+    parser.add_argument('--seed', help='seed of the file shuffling', default=None, type=int)
+    parser.add_argument('--fastNorm', help='normalise image intensities with a single pass numpy path',
+                        action='store_true', default=False)
+    parser.add_argument('--pyramid', help='pre-compute strided grids of every volume for cheaper multiscale crops',
+                        choices=['stride', 'antialias'], default=None)
+    parser.add_argument('--paddedCrops', help='pad the pyramid grids once so that crops need no boundary clipping',
+                        action='store_true', default=False)
+    parser.add_argument('--numEnvs', help='number of training episodes stepped together with one batched prediction',
+                        default=1, type=int)
+    parser.add_argument('--envWorkers', help='number of processes stepping the training episodes (default 0: in process)',
+                        default=0, type=int)
+    parser.add_argument('--oscillationThreshold', help='number of visits of a location after which the agent is oscillating',
+                        default=3, type=int)
+    parser.add_argument('--frameStack', help='stack play and eval observations in a new array, a rolling buffer view or a reused copy',
+                        choices=list(FrameStack.MODES), default='stack')
+    parser.add_argument('--compactReplay', help='store replay transitions as references to their volume, location and scale',
+                        action='store_true', default=False)
+    parser.add_argument('--memorySize', help='number of transitions kept in the replay memory',
+                        default=MEMORY_SIZE, type=float)
+    parser.add_argument('--replay', help='sample the replay memory uniformly or prioritized by the TD errors',
+                        choices=['uniform', 'prioritized'], default='uniform')
+    parser.add_argument('--priorityAlpha', help='priority exponent of the prioritized replay',
+                        default=PRIORITY_ALPHA, type=float)
+    parser.add_argument('--priorityBeta', help='initial importance sampling exponent of the prioritized replay',
+                        default=PRIORITY_BETA, type=float)
+    parser.add_argument('--nStep', help='number of rewards summed in the returns of the TD targets',
+                        default=N_STEP, type=int)
+    parser.add_argument('--saveReplay', help='save the replay memories next to the checkpoints and restore them with --load',
+                        action='store_true', default=False)
+    parser.add_argument('--mmapReplay', help='map the restored replay frames from disk instead of loading them',
+                        action='store_true', default=False)
+    parser.add_argument('--hitlBuffer', help='demonstration buffer prebuilt from the HITL logs by utils/build_hitl_buffer.py',
+                        default=None)
+    parser.add_argument('--hitlWorkers', help='number of processes rendering the HITL logs (default 0: in process)',
+                        default=0, type=int)
+    parser.add_argument('--inferenceBatch', help='largest batch of states of the simulator and evaluator threads predicted together (default 0: no batching)',
+                        default=INFERENCE_BATCH, type=int)
+    parser.add_argument('--inferenceLatency', help='longest wait in ms of the inference server for more states',
+                        default=1e3 * INFERENCE_LATENCY, type=float)
+    parser.add_argument('--actors', help='number of actor processes playing on the CPU with their own epsilon (default 0: simulator thread)',
+                        default=ACTORS, type=int)
+    parser.add_argument('--replayRatio', help='sampled transitions per transition of the actors (default: batch size / update frequency)',
+                        default=REPLAY_RATIO, type=float)
+    parser.add_argument('--syncEvery', help='number of training steps between the weights sent to the actors',
+                        default=SYNC_EVERY, type=int)
+    parser.add_argument('--evalEnvs', help='number of evaluation episodes stepped together with one batched prediction (0: one at a time)',
+                        default=EVAL_ENVS, type=int)
+    parser.add_argument('--startGrid', help='evaluate every file from the start points at these fractions of the volume dimensions, e.g. 0.25 0.5 0.75',
+                        nargs='+', type=float, default=START_GRID)
+    parser.add_argument('--fullStartGrid', help='start from every point of the grid instead of those on the planes through the centre',
+                        action='store_true', default=False)
     args = parser.parse_args()
 
     # f1 = filenames_GUI()
@@ -279,8 +482,10 @@ if __name__ == '__main__':
     if args.gpu:
         os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu
 
-    # check input files
-    if args.task == 'play':
+    # check input files, a manifest lists its own files
+    if args.manifest:
+        assert args.files is None, 'Use either --files or --manifest'
+    elif args.task == 'play':
         error_message = """Wrong input files {} for {} task - should be 1 \'images.txt\' """.format(len(args.files), args.task)
         assert len(args.files) == 1
     else:
@@ -288,11 +493,46 @@ if __name__ == '__main__':
         assert len(args.files) == 2, (error_message)
 
     METHOD = args.algo
+    CACHE_DIR = args.cacheDir
+    STORE_DIR = args.volumeStore
+    PREFETCH = args.prefetch
+    MANIFEST = args.manifest
+    SHUFFLE = args.shuffle
+    SEED = args.seed
+    FAST_NORM = args.fastNorm
+    PYRAMID = args.pyramid
+    PADDED_CROPS = args.paddedCrops
+    NUM_ENVS = args.numEnvs
+    ENV_WORKERS = args.envWorkers
+    OSCILLATION_THRESHOLD = args.oscillationThreshold
+    FRAME_STACK = args.frameStack
+    COMPACT_REPLAY = args.compactReplay
+    MEMORY_SIZE = args.memorySize
+    INIT_MEMORY_SIZE = MEMORY_SIZE // 20
+    REPLAY = args.replay
+    PRIORITY_ALPHA = args.priorityAlpha
+    PRIORITY_BETA = args.priorityBeta
+    N_STEP = args.nStep
+    MMAP_REPLAY = args.mmapReplay
+    HITL_BUFFER = args.hitlBuffer
+    HITL_WORKERS = args.hitlWorkers
+    INFERENCE_BATCH = args.inferenceBatch
+    INFERENCE_LATENCY = args.inferenceLatency / 1e3
+    ACTORS = args.actors
+    REPLAY_RATIO = args.replayRatio
+    SYNC_EVERY = args.syncEvery
+    EVAL_ENVS = args.evalEnvs
+    START_GRID = args.startGrid
+    FULL_START_GRID = args.fullStartGrid
     # load files into env to set num_actions, num_validation_files
     init_player = MedicalPlayer(files_list=args.files, #files_list=files_list,
                                 data_type=args.type,
                                 screen_dims=IMAGE_SIZE,
-                                task='play')
+                                task='play',
+                                cache_dir=CACHE_DIR,
+                                store_dir=STORE_DIR,
+                                manifest=MANIFEST,
+                                fast_normalisation=FAST_NORM)
     NUM_ACTIONS = init_player.action_space.n
     num_files = init_player.files.num_files
 
@@ -313,7 +553,20 @@ if __name__ == '__main__':
                                         task='play'),
                             pred, num_files, viewer=None)
 
-        # run episodes in parallel and evaluate pretrained model
+        # evaluate pretrained model on every file from every start point of the grid
+        elif args.task == 'eval' and START_GRID:
+            evaluate_start_points(pred, get_player, num_files,
+                                  start_grid(START_GRID, center_planes=not FULL_START_GRID),
+                                  files_list=args.files, data_type=args.type,
+                                  history_len=FRAME_HISTORY, results=args.directory)
+
+        # evaluate pretrained model on every file once, stepping EVAL_ENVS episodes together
+        elif args.task == 'eval' and EVAL_ENVS:
+            evaluate_files(pred, get_player, num_files, num_envs=EVAL_ENVS,
+                           files_list=args.files, data_type=args.type,
+                           results=args.directory)
+
+        # run episodes one at a time and evaluate pretrained model
         elif args.task == 'eval':
             play_n_episodes(get_player(directory=args.directory,
                                         files_list=args.files,
@@ -334,6 +587,10 @@ if __name__ == '__main__':
             INIT_UPDATE_FREQ = 0
         else:
             INIT_UPDATE_FREQ = 4
+        if args.saveReplay:
+            REPLAY_SAVE_DIR = os.path.join(logger_dir, 'replay')
+            if args.load:  # memories saved by the run of the checkpoint
+                REPLAY_RESTORE_DIR = os.path.join(os.path.dirname(args.load), 'replay')
         config = get_config(args.files, args.type, args.trainable)
         if args.load:  # resume training from a saved checkpoint
             session_init = get_model_loader(args.load)
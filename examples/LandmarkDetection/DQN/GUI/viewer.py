@@ -167,19 +167,19 @@ class SimpleImageViewer(QWidget):
         self.change_layout(self.window.usecase)
 
         # Draw background image - black image
-        cvImg = self.arrs[0].astype(np.uint8)
+        cvImg = np.ascontiguousarray(self.arrs[0], dtype=np.uint8)
         self.height, self.width, self.channel = cvImg.shape
         bytesPerLine = 3 * self.width
         qImg = QImage(cvImg.data, self.width, self.height, bytesPerLine, QImage.Format_RGB888)
         self.img = QPixmap(qImg) # can use this to scale the image: .scaled(450, 350, QtCore.Qt.KeepAspectRatio)
 
-        cvImg_x = self.arrs[1].astype(np.uint8)
+        cvImg_x = np.ascontiguousarray(self.arrs[1], dtype=np.uint8)
         self.height_x, self.width_x, self.channel_x = cvImg_x.shape
         bytesPerLine = 3 * self.width_x
         qImg_x = QImage(cvImg_x.data, self.width_x, self.height_x, bytesPerLine, QImage.Format_RGB888)
         self.img_x = QPixmap(qImg_x)
 
-        cvImg_y = self.arrs[2].astype(np.uint8)
+        cvImg_y = np.ascontiguousarray(self.arrs[2], dtype=np.uint8)
         self.height_y, self.width_y, self.channel_y = cvImg_y.shape
         bytesPerLine = 3 * self.width_y
         qImg_y = QImage(cvImg_y.data, self.width_y, self.height_y, bytesPerLine, QImage.Format_RGB888)
@@ -318,13 +318,13 @@ class SimpleImageViewer(QWidget):
         """
 
         if self.window.usecase in {self.window.BRAIN, self.window.CARDIAC}:
-            cvImg = arrs[0].astype(np.uint8)
-            cvImg_x = arrs[1].astype(np.uint8)
-            cvImg_y = arrs[2].astype(np.uint8)
+            cvImg = np.ascontiguousarray(arrs[0], dtype=np.uint8)
+            cvImg_x = np.ascontiguousarray(arrs[1], dtype=np.uint8)
+            cvImg_y = np.ascontiguousarray(arrs[2], dtype=np.uint8)
         elif self.window.usecase == self.window.FETAL:
-            cvImg = arrs[0].astype(np.uint8)
-            cvImg_x = arrs[2].astype(np.uint8)
-            cvImg_y = arrs[1].astype(np.uint8)
+            cvImg = np.ascontiguousarray(arrs[0], dtype=np.uint8)
+            cvImg_x = np.ascontiguousarray(arrs[2], dtype=np.uint8)
+            cvImg_y = np.ascontiguousarray(arrs[1], dtype=np.uint8)
 
         # Get height, width, etc
         self.height, self.width, self.channel = cvImg.shape
@@ -108,13 +108,19 @@ class Model2D(ModelDesc):
 
 
 class Model3D(ModelDesc):
-    def __init__(self, image_shape, channel, method, num_actions, gamma):
+    def __init__(self, image_shape, channel, method, num_actions, gamma, prioritized=False, n_step=1):
         """
         :param image_shape: the shape of input 3d image
         :param channel: history length and goes to channel dimension in kernel
         :param method: dqn or double (default is double)
         :param num_actions: number of actions
         :param gamma: discount factor
+        :param prioritized: take the importance sampling weights and the
+            replay keys of the samples as inputs (prioritized replay), weight
+            the TD loss and output the TD errors as 'td_error'
+        :param n_step: learn from n-step returns: the combined state holds the
+            n-th next state in its last channels and the discount of its value
+            is an input
 
         See http://tensorpack.readthedocs.io/tutorial/training-interface.html for Mode lDesc documentation.
         """
@@ -124,17 +130,22 @@ class Model3D(ModelDesc):
         self.image_shape = image_shape
         self.num_actions = num_actions
         self.margin_lambda = 1.0
+        self.prioritized = prioritized
+        self.n_step = n_step
 
     def inputs(self):
         # Use a combined state for efficiency.
         # The first h channels are the current state, and the last h channels are the next state.
         return [InputDesc(tf.uint8,
-                          (None,) + self.image_shape + (self.channel + 1,),
+                          (None,) + self.image_shape + (self.channel + self.n_step,),
                           'comb_state'),
                 InputDesc(tf.int64, (None,), 'action'),
                 InputDesc(tf.float32, (None,), 'reward'),
                 InputDesc(tf.bool, (None,), 'isOver'),
-                InputDesc(tf.bool, (None,), 'human')]
+                InputDesc(tf.bool, (None,), 'human')] + ([
+                InputDesc(tf.float32, (None,), 'discount')] if self.n_step > 1 else []) + ([
+                InputDesc(tf.float32, (None,), 'isWeight'),
+                InputDesc(tf.int64, (None,), 'sampleIndex')] if self.prioritized else [])
 
     @abc.abstractmethod
     def _get_DQN_prediction(self, image):
@@ -147,7 +158,8 @@ class Model3D(ModelDesc):
         return self._get_DQN_prediction(image)
 
     def build_graph(self, *inputs):
-        comb_state, self.action, reward, isOver, human = inputs
+        comb_state, self.action, reward, isOver, human = inputs[:5]
+        extra_inputs = list(inputs[5:])
         comb_state = tf.cast(comb_state, tf.float32)
         state = tf.slice(comb_state, [0, 0, 0, 0, 0], [-1, -1, -1, -1, self.channel], name='state')
         # Standard DQN loss
@@ -155,8 +167,13 @@ class Model3D(ModelDesc):
         if not get_current_tower_context().is_training:
             return
 
-        reward = tf.clip_by_value(reward, -1, 1)
-        next_state = tf.slice(comb_state, [0, 0, 0, 0, 1], [-1, -1, -1, -1, self.channel], name='next_state')
+        if self.n_step > 1:
+            # the n-step returns sum rewards clipped by the replay memory
+            discount = extra_inputs.pop(0)
+        else:
+            reward = tf.clip_by_value(reward, -1, 1)
+        next_state = tf.slice(comb_state, [0, 0, 0, 0, self.n_step], [-1, -1, -1, -1, self.channel],
+                              name='next_state')
         self.action_onehot = tf.one_hot(self.action, self.num_actions, 1.0, 0.0)
 
         pred_action_value = tf.reduce_sum(self.predict_value * self.action_onehot, 1)  # N,
@@ -177,9 +194,21 @@ class Model3D(ModelDesc):
             predict_onehot = tf.one_hot(self.greedy_choice, self.num_actions, 1.0, 0.0)
             best_v = tf.reduce_sum(targetQ_predict_value * predict_onehot, 1)
 
-        target = reward + (1.0 - tf.cast(isOver, tf.float32)) * self.gamma * tf.stop_gradient(best_v)
-        cost = tf.losses.huber_loss(target, pred_action_value,
-                                    reduction=tf.losses.Reduction.MEAN)
+        if self.n_step > 1:
+            target = reward + discount * tf.stop_gradient(best_v)
+        else:
+            target = reward + (1.0 - tf.cast(isOver, tf.float32)) * self.gamma * tf.stop_gradient(best_v)
+        if self.prioritized:
+            is_weight, sample_index = extra_inputs
+            # fetched by ExpReplay to update the priorities of the samples
+            tf.abs(target - pred_action_value, name='td_error')
+            tf.identity(sample_index, name='sample_index')
+            # mean of the weighted losses (all weights are positive)
+            cost = tf.losses.huber_loss(target, pred_action_value, weights=is_weight,
+                                        reduction=tf.losses.Reduction.SUM_BY_NONZERO_WEIGHTS)
+        else:
+            cost = tf.losses.huber_loss(target, pred_action_value,
+                                        reduction=tf.losses.Reduction.MEAN)
 
         ###############################################################################
         # HITL UPDATE: Margin classification loss
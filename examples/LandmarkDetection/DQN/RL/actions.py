@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: actions.py
+
+import numpy as np
+
+__all__ = ['ACTION_DIRECTIONS', 'move', 'apply_actions']
+
+# unit move of every action in image coordinates:
+# 0 UP Z+, 1 FORWARD Y+, 2 RIGHT X+, 3 LEFT X-, 4 BACKWARD Y-, 5 DOWN Z-
+ACTION_DIRECTIONS = np.array([[0, 0, 1],
+                              [0, 1, 0],
+                              [1, 0, 0],
+                              [-1, 0, 0],
+                              [0, -1, 0],
+                              [0, 0, -1]], dtype='int64')
+# direction, axis and sign of every action as python values for the single agent path
+_DIRECTIONS = [tuple(d) for d in ACTION_DIRECTIONS.tolist()]
+_LIMITS = [(int(np.abs(d).argmax()), int(d.sum()) > 0) for d in ACTION_DIRECTIONS]
+
+
+def move(location, act, action_step, dims):
+    """ Apply an action to a location.
+
+    The agent moves action_step voxels along the axis of the action. A move
+    to or past the upper border of the image, or to or below 0, is refused.
+
+    Args
+      location: (x, y, z) integer location
+      act: action index
+      action_step: number of voxels moved
+      dims: image dimensions
+    Returns
+      (next_location, go_out) where next_location is location itself if the
+      agent tried to go out of the image
+    """
+    dx, dy, dz = _DIRECTIONS[act]
+    next_location = (location[0] + dx * action_step,
+                     location[1] + dy * action_step,
+                     location[2] + dz * action_step)
+    axis, up = _LIMITS[act]
+    if (next_location[axis] >= dims[axis]) if up else (next_location[axis] <= 0):
+        return location, True
+    return next_location, False
+
+
+def apply_actions(locations, acts, action_steps, dims):
+    """ Vectorised `move` of a batch of locations.
+
+    Args
+      locations: (N, 3) integer locations
+      acts: (N,) actions
+      action_steps: (N,) or scalar number of voxels moved
+      dims: (N, 3) or (3,) image dimensions
+    Returns
+      (next_locations, go_out) arrays of shape (N, 3) and (N,)
+    """
+    locations = np.asarray(locations)
+    acts = np.asarray(acts)
+    rows = np.arange(len(acts))
+    direction = ACTION_DIRECTIONS[acts]
+    axis = np.abs(direction).argmax(axis=1)
+    next_locations = locations + direction * np.asarray(action_steps).reshape(-1, 1)
+    moved = next_locations[rows, axis]
+    bound = np.broadcast_to(dims, locations.shape)[rows, axis]
+    go_out = np.where(direction[rows, axis] > 0, moved >= bound, moved <= 0)
+    next_locations[go_out] = locations[go_out]
+    return next_locations, go_out
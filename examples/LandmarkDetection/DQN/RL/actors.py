@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: actors.py
+
+import os
+import time
+import traceback
+import threading
+import multiprocessing as mp
+import numpy as np
+from collections import deque
+from six.moves import queue
+
+from tensorpack.utils import logger
+from tensorpack.utils.stats import StatCounter
+
+__all__ = ['actor_epsilons', 'ActorPool']
+
+
+def actor_epsilons(num_actors, epsilon=0.4, alpha=7):
+    """ exploration of every actor, epsilon^(1 + alpha i / (num_actors - 1))
+    for actor i as in Ape-X (Horgan et al., Distributed Prioritized
+    Experience Replay, 2018)
+    """
+    if num_actors == 1:
+        return [epsilon]
+    return [epsilon ** (1 + alpha * i / float(num_actors - 1)) for i in range(num_actors)]
+
+
+def _load_weights(variables, session, weights):
+    for name, value in weights.items():
+        variables[name].load(value, session)
+
+
+def _actor(index, conn, transitions, player_fn, predictor_fn, history_len, epsilon,
+           chunk_size, seed, initializer, initargs):
+    """ play the episodes of player index epsilon-greedily with the weights
+    sent on conn, and put chunks of chunk_size transitions into transitions
+    """
+    try:
+        # actors predict on the CPU, the GPU is left to the learner
+        os.environ['CUDA_VISIBLE_DEVICES'] = ''
+        import tensorflow as tf
+        if initializer is not None:
+            initializer(*initargs)
+        player = player_fn(index)
+        predictor = predictor_fn()
+        with predictor.graph.as_default():
+            variables = {v.name: v for v in tf.global_variables()}
+        conn.send(('ready', (player.action_space, sorted(variables))))
+        _load_weights(variables, predictor.sess, conn.recv())
+
+        rng = np.random.RandomState(seed)
+        num_actions = player.action_space.n
+        hist = deque(maxlen=history_len - 1)
+        ob = player.reset()
+        zeros = np.zeros_like(ob)
+        frames = np.empty((chunk_size,) + ob.shape, dtype='uint8')
+        action = np.zeros((chunk_size,), dtype='int32')
+        reward = np.zeros((chunk_size,), dtype='float32')
+        isOver = np.zeros((chunk_size,), dtype='bool')
+        episodes = []
+        i = 0
+        while True:
+            # keep the last weights sent, None closes the actor
+            weights = False
+            while conn.poll():
+                weights = conn.recv()
+                if weights is None:
+                    return
+            if weights is not False:
+                _load_weights(variables, predictor.sess, weights)
+
+            q_values = np.zeros(num_actions, dtype='float32')
+            if rng.rand() <= epsilon:
+                act = rng.randint(num_actions)
+            else:
+                history = [zeros] * (hist.maxlen - len(hist)) + list(hist) + [ob]
+                q_values = predictor(np.stack(history, axis=-1)[None])[0][0]
+                act = int(np.argmax(q_values))
+            next_ob, r, over, info = player.step(act, q_values)
+            frames[i], action[i], reward[i], isOver[i] = ob, act, r, over
+            if over:
+                episodes.append((info['score'], info['distError']))
+                hist.clear()
+                next_ob = player.reset()
+            else:
+                hist.append(frames[i])
+            ob = next_ob
+            i += 1
+            if i == chunk_size:
+                # games played and won since the last chunk
+                stats = (player.num_games.sum if player.num_games.count else 0,
+                         player.num_success.sum if player.num_success.count else 0)
+                player.reset_stat()
+                transitions.put(('ok', (frames.copy(), action.copy(), reward.copy(), isOver.copy(),
+                                        episodes, stats)))
+                episodes = []
+                i = 0
+    except Exception:
+        transitions.put(('error', traceback.format_exc()))
+    finally:
+        conn.close()
+
+
+class ActorPool(object):
+    """ Actor processes playing training episodes for the replay memory, as
+        in Ape-X.
+
+        Every actor owns a player and a copy of the Q-network on the CPU,
+        explores with its own epsilon (see actor_epsilons) and puts chunks of
+        chunk_size transitions into its queue, which holds at most queue_size
+        chunks. The learner gets a chunk of every actor at a time (see
+        receive) and sends the weights of the network to the actors with
+        send_weights, which they load before their next step.
+
+        The pool replaces the player of ExpReplay: it has the action space and
+        the game statistics of the actors. The actors are spawned, not forked,
+        so they start without the TensorFlow and CUDA state of the learner;
+        player_fn, predictor_fn and initializer must therefore be picklable
+        (module functions or partials of them), and the module settings they
+        depend on restored by initializer.
+
+        Attributes:
+        player_fn: function returning the MedicalPlayer of actor i
+        predictor_fn: function returning the OfflinePredictor of an actor,
+            whose variables are loaded from the weights sent by the learner
+        num_actors: number of actor processes
+        history_len: number of frames of the states
+        epsilons: exploration of every actor (default: actor_epsilons)
+        chunk_size: number of transitions of a chunk (default: 50)
+        initializer: function called with initargs in every actor before
+            player_fn, as the one of multiprocessing.Pool (default: None)
+    """
+
+    def __init__(self, player_fn, predictor_fn, num_actors, history_len, epsilons=None,
+                 chunk_size=50, queue_size=4, seed=0, initializer=None, initargs=()):
+        assert num_actors > 0, 'invalid number of actors {}'.format(num_actors)
+        self.num_actors = num_actors
+        self.chunk_size = chunk_size
+        self.epsilons = epsilons or actor_epsilons(num_actors)
+        assert len(self.epsilons) == num_actors, 'one epsilon per actor'
+        self._conns, self._queues, self._procs = [], [], []
+        ctx = mp.get_context('spawn')
+        for i in range(num_actors):
+            parent_conn, child_conn = ctx.Pipe()
+            transitions = ctx.Queue(maxsize=queue_size)
+            proc = ctx.Process(target=_actor, args=(i, child_conn, transitions, player_fn, predictor_fn,
+                                                    history_len, self.epsilons[i], chunk_size, seed + i,
+                                                    initializer, initargs))
+            proc.daemon = True
+            proc.start()
+            child_conn.close()
+            self._conns.append(parent_conn)
+            self._queues.append(transitions)
+            self._procs.append(proc)
+        # action space and names of the variables of the actor networks
+        self.action_space, self.variable_names = [self._ready(i) for i in range(num_actors)][0]
+        self.actions = self.action_space.n
+        self.reset_stat()
+
+        # the weights are sent by a thread, the learner only waits for the last ones
+        self._weights = queue.Queue(maxsize=1)
+        self._sending = threading.Event()
+        self._sender = threading.Thread(target=self._send_loop, name='ActorWeightsThread')
+        self._sender.daemon = True
+        self._sender.start()
+        logger.info("Started {} actors with epsilons {}".format(
+            num_actors, ', '.join('{:.3g}'.format(e) for e in self.epsilons)))
+
+    def reset_stat(self):
+        """ Reset all statistics counter"""
+        self.num_games = StatCounter()
+        self.num_success = StatCounter()
+
+    def _check(self, reply):
+        status, content = reply
+        if status == 'error':
+            self.close()
+            raise RuntimeError("Actor failed:\n{}".format(content))
+        return content
+
+    def _ready(self, i):
+        """ wait for the network of actor i to be built """
+        while not self._conns[i].poll(1):
+            if not self._queues[i].empty():
+                self._check(self._queues[i].get())
+            if not self._procs[i].is_alive():
+                self.close()
+                raise RuntimeError("Actor {} exited".format(i))
+        try:
+            return self._conns[i].recv()[1]
+        except EOFError:
+            # the actor failed and closed its pipe, its error is in its queue
+            self._check(self._queues[i].get(timeout=5))
+            self.close()
+            raise RuntimeError("Actor {} exited".format(i))
+
+    def _send_loop(self):
+        while True:
+            weights = self._weights.get()
+            if weights is None:
+                break
+            for conn in self._conns:
+                conn.send(weights)
+            self._sending.clear()
+
+    @property
+    def sending(self):
+        """ True while the last weights are sent """
+        return self._sending.is_set()
+
+    def send_weights(self, weights):
+        """ send a dict of variable name -> value to all actors, without
+        waiting, unless the last weights are still sent
+        :returns: False if the weights were dropped
+        """
+        if self._sending.is_set():
+            return False
+        self._sending.set()
+        self._weights.put(weights)
+        return True
+
+    def receive(self):
+        """ one chunk of every actor, a list of (frames, action, reward,
+        isOver, finished episodes as (score, distError))
+        """
+        chunks = []
+        for transitions in self._queues:
+            frames, action, reward, isOver, episodes, (games, success) = \
+                self._check(transitions.get())
+            if games:
+                self.num_games.feed(games)
+            if success:
+                self.num_success.feed(success)
+            chunks.append((frames, action, reward, isOver, episodes))
+        return chunks
+
+    def close(self):
+        """ stop the actors, once they got the weights being sent """
+        if getattr(self, '_sender', None) is not None and self._sender.is_alive():
+            self._weights.put(None)
+            self._sender.join(5)
+        if getattr(self, '_sender', None) is None or not self._sender.is_alive():
+            for conn in self._conns:
+                try:
+                    conn.send(None)
+                except (IOError, OSError):
+                    pass
+        # drain the queues of the actors blocked on them
+        deadline = time.time() + 5
+        while any(proc.is_alive() for proc in self._procs) and time.time() < deadline:
+            for transitions in self._queues:
+                try:
+                    transitions.get(timeout=0.01)
+                except queue.Empty:
+                    pass
+        for proc in self._procs:
+            if proc.is_alive():
+                proc.terminate()
+            proc.join()
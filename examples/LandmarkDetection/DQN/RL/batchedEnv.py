@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: batchedEnv.py
+
+import csv
+import numpy as np
+from collections import defaultdict
+
+from tensorpack.utils.stats import StatCounter
+
+from RL.actions import apply_actions
+from RL.cropping import window_lower, crop_image, FrameRef
+from RL.history import LocationHistory
+
+__all__ = ['BatchedMedicalEnv']
+
+
+class BatchedMedicalEnv(object):
+    """ N independent MedicalPlayer episodes stepped together.
+
+        `step` takes one action (and q-values) per episode and returns the
+        stacked observations, rewards and terminal flags as arrays, so the
+        predictor runs once per N transitions. Moves, bound checks, rewards,
+        distances and the oscillation check are computed on (N, ...) arrays
+        with the same rules as MedicalPlayer.step; only the crops loop over the
+        episodes since they may be on different volumes.
+
+        Every episode is backed by a MedicalPlayer, which samples its volume
+        and random start point on reset. Terminal episodes are reset
+        automatically: their observation is the first screen of the new
+        episode and their info holds the final score and distance error.
+
+        Without auto_reset, terminal episodes stay at their last location and
+        `start` begins the episodes at given locations of the volumes their
+        players hold, so that several episodes can share the player (and the
+        volume) of a single MedicalPlayer. `keep` drops finished episodes.
+
+        Attributes:
+        players: list of MedicalPlayer (task 'train', 'eval' or 'play'),
+            usually with disjoint shards of the files list
+        auto_reset: reset terminal episodes in step (default: True)
+    """
+    # per-episode arrays, indexed by the slot of the episode
+    _ARRAYS = ('location', 'target', 'spacing', 'dims', 'scale', 'action_step', 'cnt',
+               'cur_dist', 'reward', 'score')
+    # per-episode lists
+    _LISTS = ('players', 'images', 'filenames', 'histories')
+
+    def __init__(self, players, auto_reset=True):
+        assert players, 'There is no player given'
+        self.players = list(players)
+        self.num_envs = len(players)
+        self.auto_reset = auto_reset
+        player = players[0]
+        self.task = player.task
+        self.multiscale = player.multiscale
+        self.max_num_frames = player.max_num_frames
+        self.directory = player.directory
+        self.screen_dims = player.screen_dims
+        self.action_space = player.action_space
+        self.observation_space = player.observation_space
+        self.actions = self.action_space.n
+        self.history_length = player._history_length
+        self.oscillation_threshold = player.oscillation_threshold
+
+        n = self.num_envs
+        self.images = [None] * n
+        self.filenames = [None] * n
+        self.location = np.zeros((n, 3), dtype='int64')
+        self.target = np.zeros((n, 3), dtype='float64')
+        self.spacing = np.ones((n, 3), dtype='float64')
+        self.dims = np.zeros((n, 3), dtype='int64')
+        self.scale = np.ones(n, dtype='int64')
+        self.action_step = np.ones(n, dtype='int64')
+        self.cnt = np.zeros(n, dtype='int64')
+        self.cur_dist = np.zeros(n, dtype='float64')
+        self.reward = np.zeros(n, dtype='float64')
+        self.score = np.zeros(n, dtype='float64')
+        self.histories = [LocationHistory(self.history_length, self.oscillation_threshold)
+                          for _ in range(n)]
+        self.reset_stat()
+
+    def reset_stat(self):
+        """ Reset all statistics counter"""
+        self.stats = defaultdict(list)
+        self.num_games = StatCounter()
+        self.num_success = StatCounter()
+
+    def _load_episode(self, i, location=None):
+        """ start a new episode in slot i from a freshly reset player, or at
+        location of the current volume of the player if given """
+        player = self.players[i]
+        if location is None:
+            player.reset()
+        self.num_games.feed(1)
+        self.images[i] = player._image
+        self.filenames[i] = player.filename
+        self.location[i] = player._location if location is None else location
+        if player._target_loc is not None:
+            self.target[i] = player._target_loc
+        self.spacing[i] = player.spacing
+        self.dims[i] = player._image_dims
+        self.scale[i] = player.xscale
+        self.action_step[i] = player.action_step
+        self.cnt[i] = 0
+        if location is None:
+            self.cur_dist[i] = player.cur_dist
+        elif self.task != 'play':
+            self.cur_dist[i] = self._distance(self.location[i:i + 1], slice(i, i + 1))[0]
+        self.reward[i] = 0
+        self.score[i] = 0
+        self._clear_history(i)
+
+    def _clear_history(self, i):
+        self.histories[i].clear()
+
+    def _distance(self, location, indexes=slice(None)):
+        """ distance in mm of the locations of the episodes in indexes to their targets """
+        return np.linalg.norm(self.spacing[indexes] * (location - self.target[indexes]), axis=1)
+
+    def _observe(self, out=None):
+        """ crop the screens of all episodes into out """
+        if out is None:
+            dtype = self.images[0].data.dtype
+            out = np.zeros((self.num_envs,) + tuple(self.screen_dims), dtype=dtype)
+        lower = window_lower(self.location, self.scale, self.screen_dims)
+        for i in range(self.num_envs):
+            crop_image(self.images[i], lower[i], self.scale[i], self.screen_dims, out=out[i])
+        return out
+
+    def frame_refs(self):
+        """ list of the FrameRef of the current observation of every episode """
+        return [FrameRef(image, tuple(location), scale) for image, location, scale
+                in zip(self.images, self.location.tolist(), self.scale.tolist())]
+
+    def reset(self, out=None):
+        """ start a new episode in every slot and return the (N, ...) observations,
+        written into out if given
+        """
+        for i in range(self.num_envs):
+            self._load_episode(i)
+        return self._observe(out=out)
+
+    def start(self, locations, out=None):
+        """ start an episode in every slot at locations (N, 3) of the volume
+        held by its player, which is not reset, and return the (N, ...)
+        observations, written into out if given
+        """
+        for i in range(self.num_envs):
+            self._load_episode(i, locations[i])
+        return self._observe(out=out)
+
+    def keep(self, indexes):
+        """ keep the episodes of the slots in indexes, in that order """
+        indexes = np.asarray(indexes, dtype='int64')
+        for name in self._ARRAYS:
+            setattr(self, name, getattr(self, name)[indexes])
+        for name in self._LISTS:
+            values = getattr(self, name)
+            setattr(self, name, [values[i] for i in indexes])
+        self.num_envs = len(indexes)
+
+    def _oscillate(self):
+        """ (N,) flags of the episodes that visited a location of their history
+        more than oscillation_threshold times
+        """
+        return np.array([h.oscillating for h in self.histories], dtype='bool')
+
+    def _best_location(self, indexes):
+        """ best locations of the histories of the episodes in indexes """
+        return np.array([self.histories[i].best_location() for i in indexes], dtype='int64')
+
+    def step(self, acts, qvalues=None, out=None):
+        """ apply one action per episode
+        Args:
+          acts: (N,) actions
+          qvalues: (N, num_actions) q-values of the actions (default zeros)
+          out: optional (N, ...) array to write the observations into
+        Returns:
+          observations (N, ...), rewards (N,), terminals (N,) and a list of
+          N info dicts
+        """
+        acts = np.asarray(acts, dtype='int64')
+        if qvalues is None:
+            qvalues = np.zeros((self.num_envs, self.actions), dtype='float32')
+        next_location, go_out = apply_actions(self.location, acts, self.action_step, self.dims)
+
+        # punish -1 reward if the agent tries to go out
+        if self.task != 'play':
+            self.reward = np.where(go_out, -1.0,
+                                   self._distance(self.location) - self._distance(next_location))
+        self.location = next_location
+
+        terminal = np.zeros(self.num_envs, dtype='bool')
+        # terminate if the distance is less than 1 during training
+        if self.task == 'train':
+            success = self.cur_dist <= 1
+            terminal |= success
+            if success.any():
+                self.num_success.feed(int(success.sum()))
+        # terminate if maximum number of steps is reached
+        self.cnt += 1
+        terminal |= self.cnt >= self.max_num_frames
+
+        if self.task != 'play':
+            self.cur_dist = self._distance(self.location)
+        # update history buffer with new location and qvalues
+        for history, location, q in zip(self.histories, self.location.tolist(), qvalues):
+            history.push(tuple(location), q)
+
+        # move oscillating agents to their best location and refine their scale
+        oscillate = np.flatnonzero(self._oscillate())
+        if len(oscillate):
+            self.location[oscillate] = self._best_location(oscillate)
+            if self.task != 'play':
+                self.cur_dist[oscillate] = self._distance(self.location[oscillate], oscillate)
+            for i in oscillate:
+                if self.multiscale and self.scale[i] > 1:
+                    self.scale[i] -= 1
+                    self.action_step[i] = int(self.action_step[i] / 3)
+                    self._clear_history(i)
+                else:
+                    terminal[i] = True
+                    if self.cur_dist[i] <= 1:
+                        self.num_success.feed(1)
+
+        self.score += self.reward
+        infos = [{'score': self.score[i], 'gameOver': terminal[i],
+                  'distError': self.cur_dist[i], 'filename': self.filenames[i]}
+                 for i in range(self.num_envs)]
+        if self.directory:
+            # store results when batch evaluation
+            with open(self.directory, 'a') as outcsv:
+                writer = csv.writer(outcsv)
+                for i in np.flatnonzero(terminal):
+                    writer.writerow([infos[i]['filename'], infos[i]['score'], infos[i]['distError']])
+
+        reward = self.reward.copy()
+        if self.auto_reset:
+            for i in np.flatnonzero(terminal):
+                self._load_episode(i)
+        return self._observe(out=out), reward, terminal, infos
@@ -1,5 +1,9 @@
+import csv
+import json
+import os
 import random
 import time
+import itertools
 import threading
 import numpy as np
 from tqdm import tqdm
@@ -17,6 +21,9 @@ from tensorpack.utils.concurrency import (StoppableThread, ShareSessionThread)
 
 import traceback
 
+from RL.inference import InferenceServer
+from RL.batchedEnv import BatchedMedicalEnv
+
 
 ###############################################################################
 
@@ -83,6 +90,237 @@ def play_n_episodes(player, predfunc, nr, render=False, viewer=None):
 
 ###############################################################################
 
+# fields of the per-file results of evaluate_files
+EVAL_FIELDS = ('filename', 'score', 'distError', 'steps', 'seconds', 'location', 'target', 'shard')
+# fields of the rows appended to the results CSV by MedicalPlayer, which
+# evaluate_files keeps for the tools reading them
+LEGACY_FIELDS = ('filename', 'score', 'distError')
+
+
+# fields of the results of evaluate_start_points, a row per start point and
+# a row per consensus ('mean' and 'median' start) of every file
+START_FIELDS = ('filename', 'start', 'start_location', 'location', 'distError', 'steps', 'seconds',
+                'target')
+
+
+class _ResultsWriter(object):
+    """ results appended to a CSV file as soon as they are known, or written
+    as a JSON list of objects (of every field) if path ends with .json.
+
+    With csv_fields, a header row is written when the file is new; without,
+    the rows hold LEGACY_FIELDS only, as MedicalPlayer appends them. """
+    def __init__(self, path, csv_fields=None):
+        self.path = path
+        self.fields = csv_fields or LEGACY_FIELDS
+        self.results = []
+        self._csv = None
+        if path and not path.endswith('.json'):
+            new_file = not os.path.exists(path) or not os.path.getsize(path)
+            self._file = open(path, 'a', newline='')
+            self._csv = csv.writer(self._file)
+            if csv_fields and new_file:
+                self._csv.writerow(csv_fields)
+
+    def add(self, result):
+        self.results.append(result)
+        if self._csv is not None:
+            self._csv.writerow([' '.join(str(x) for x in v) if isinstance(v, list) else
+                                '' if v is None else v
+                                for v in (result[k] for k in self.fields)])
+            self._file.flush()
+
+    def close(self):
+        if self._csv is not None:
+            self._file.close()
+        elif self.path:
+            with open(self.path, 'w') as f:
+                json.dump(self.results, f, indent=1)
+
+
+def make_eval_players(get_player_fn, num_files, num_envs=8, files_list=None, data_type=None):
+    """ players of evaluate_files, each sampling one of min(num_envs,
+    num_files) shards of the files """
+    num_envs = max(min(num_envs, num_files), 1)
+    return [get_player_fn(task='eval', files_list=files_list, data_type=data_type,
+                          shard=(i, num_envs)) for i in range(num_envs)]
+
+
+def evaluate_files(pred, get_player_fn, num_files, num_envs=8, files_list=None, data_type=None,
+                   results=None, players=None, seed=None):
+    """
+    Args:
+        pred (OfflinePredictor): state -> Qvalue
+        num_envs (int): number of episodes stepped together
+        results (str): CSV file the filename, score and distError of every
+            file are appended to, as by MedicalPlayer, or JSON file (.json) of
+            the per-file results
+        players (list): players of make_eval_players, kept with their
+            volumes between evaluations (made with get_player_fn if None)
+        seed (int): seed the start points of the players, so that
+            evaluations with the same seed start from the same points
+
+    Evaluate every file exactly once: the files are split into num_envs
+    shards, one per player, and the episodes of all players are stepped in
+    lockstep with a single prediction for all of them at every step. A player
+    stops once it played every file of its shard.
+
+    :returns: list of the per-file results, dicts of EVAL_FIELDS in the
+        order the episodes ended
+    """
+    if players is None:
+        players = make_eval_players(get_player_fn, num_files, num_envs, files_list, data_type)
+    num_envs = len(players)
+    remaining = []
+    for i, player in enumerate(players):
+        player.restart_files()
+        if seed is not None:
+            player.unwrapped.rng = np.random.RandomState(seed + i)
+        remaining.append(player.num_shard_files)
+    assert sum(remaining) == num_files, 'the shards have {} files, expected {}'.format(
+        sum(remaining), num_files)
+    logger.info("Evaluating {} files with {} episodes stepped together".format(num_files, num_envs))
+
+    writer = _ResultsWriter(results)
+    obs = [player.reset() for player in players]
+    starts = [time.time()] * num_envs
+    steps = [0] * num_envs
+    active = list(range(num_envs))
+    t = time.time()
+    try:
+        with tqdm(total=num_files, **get_tqdm_kwargs()) as pbar:
+            while active:
+                q_values = pred(np.stack([obs[i] for i in active]))[0]
+                acts = q_values.argmax(axis=1)
+                for k, i in enumerate(active):
+                    obs[i], _, isOver, info = players[i].step(acts[k], q_values[k], viewer=None)
+                    steps[i] += 1
+                    if not isOver:
+                        continue
+                    target = players[i]._target_loc
+                    writer.add({'filename': info['filename'], 'score': float(info['score']),
+                                'distError': float(info['distError']), 'steps': steps[i],
+                                'seconds': time.time() - starts[i],
+                                'location': [int(x) for x in players[i]._location],
+                                'target': None if target is None else [float(x) for x in target],
+                                'shard': i})
+                    pbar.update()
+                    remaining[i] -= 1
+                    if remaining[i]:
+                        obs[i] = players[i].reset()
+                        starts[i] = time.time()
+                        steps[i] = 0
+                active = [i for i in active if remaining[i]]
+    finally:
+        writer.close()
+
+    t = time.time() - t
+    dist = [r['distError'] for r in writer.results]
+    if dist:
+        logger.info("Evaluated {} files in {:.1f}s ({:.2f} files/s); Average Score: {}; "
+                    "Average Distance: {}; Median Distance: {}; Max Distance: {}".format(
+                        len(dist), t, len(dist) / t, np.mean([r['score'] for r in writer.results]),
+                        np.mean(dist), np.median(dist), np.max(dist)))
+    return writer.results
+
+###############################################################################
+
+def start_grid(fractions=(0.25, 0.5, 0.75), center_planes=True):
+    """ start points as fractions of the volume dimensions, every
+    combination of fractions along the 3 axes, or only those on the planes
+    through the centre (with a fraction of 0.5) if center_planes, the 19
+    points of the default fractions """
+    points = list(itertools.product(fractions, repeat=3))
+    if center_planes:
+        points = [p for p in points if 0.5 in p]
+    assert points, 'no start point in the grid of {}'.format(fractions)
+    return points
+
+
+def evaluate_start_points(pred, get_player_fn, num_files, grid, files_list=None, data_type=None,
+                          history_len=4, results=None):
+    """
+    Args:
+        pred (OfflinePredictor): state -> Qvalue
+        grid (list): start points as fractions of the volume dimensions (see
+            start_grid)
+        history_len (int): number of frames of the states
+        results (str): CSV file the results are appended to, with a header
+            if it is new, or JSON file (.json)
+
+    Evaluate every file from every start point of the grid: the volume is
+    loaded once and the episodes of all start points are stepped together
+    with a single prediction per step. The consensus landmark of a file is
+    the mean and the median of the final locations of its episodes.
+
+    :returns: list of the results, dicts of START_FIELDS, with the rows of
+        the start points of a file followed by its 'mean' and 'median' rows
+    """
+    player = get_player_fn(task='eval', files_list=files_list, data_type=data_type).unwrapped
+    player.restart_files()
+    assert player.num_shard_files == num_files, 'the player has {} files, expected {}'.format(
+        player.num_shard_files, num_files)
+    fractions = np.array(grid, dtype='float64')
+    logger.info("Evaluating {} files from {} start points".format(num_files, len(fractions)))
+
+    writer = _ResultsWriter(results, START_FIELDS)
+    t = time.time()
+    try:
+        for _ in tqdm(range(num_files), **get_tqdm_kwargs()):
+            # every episode of the volume shares the player and its volume
+            player.reset()
+            dims = np.array(player._image_dims)
+            starts = np.clip((fractions * dims).astype('int64'), 0, dims - 1)
+            env = BatchedMedicalEnv([player] * len(starts), auto_reset=False)
+            ob = env.start(starts)
+            state = np.zeros(ob.shape + (history_len,), dtype=ob.dtype)
+            state[..., -1] = ob
+            slots = np.arange(len(starts))
+            final = np.zeros_like(starts)
+            volume_start = time.time()
+            while len(slots):
+                q_values = pred(state)[0]
+                ob, _, isOver, info = env.step(q_values.argmax(axis=1), q_values)
+                state[..., :-1] = state[..., 1:]
+                state[..., -1] = ob
+                for k in np.flatnonzero(isOver):
+                    i = slots[k]
+                    final[i] = env.location[k]
+                    writer.add({'filename': info[k]['filename'], 'start': int(i),
+                                'start_location': starts[i].tolist(),
+                                'location': final[i].tolist(),
+                                'distError': float(info[k]['distError']),
+                                'steps': int(env.cnt[k]), 'seconds': time.time() - volume_start,
+                                'target': None if player._target_loc is None else
+                                [float(x) for x in player._target_loc]})
+                if isOver.any():
+                    running = np.flatnonzero(~isOver)
+                    env.keep(running)
+                    state = state[running]
+                    slots = slots[running]
+            rows = writer.results[-len(starts):]
+            for name, consensus in (('mean', np.mean), ('median', np.median)):
+                location = consensus(final, axis=0)
+                distError = None
+                if player._target_loc is not None:
+                    distError = float(player.calcDistance(location, player._target_loc, player.spacing))
+                writer.add({'filename': rows[0]['filename'], 'start': name, 'start_location': None,
+                            'location': location.tolist(), 'distError': distError,
+                            'steps': sum(r['steps'] for r in rows),
+                            'seconds': time.time() - volume_start, 'target': rows[0]['target']})
+    finally:
+        writer.close()
+
+    t = time.time() - t
+    for name in ('mean', 'median'):
+        dist = [r['distError'] for r in writer.results if r['start'] == name and r['distError'] is not None]
+        if dist:
+            logger.info("Evaluated {} files from {} start points in {:.1f}s; Average {} Distance: {}; "
+                        "Max {} Distance: {}".format(len(dist), len(fractions), t, name, np.mean(dist),
+                                                     name, np.max(dist)))
+    return writer.results
+
+###############################################################################
+
 def eval_with_funcs(predictors, nr_eval, get_player_fn, files_list=None, data_type=None):
     """
     Args:
@@ -155,17 +393,28 @@ def eval_with_funcs(predictors, nr_eval, get_player_fn, files_list=None, data_ty
 
 ###############################################################################
 
-def eval_model_multithread(pred, nr_eval, get_player_fn, files_list):
+def eval_model_multithread(pred, nr_eval, get_player_fn, files_list, max_batch=0, max_latency=0.005):
     """
     Args:
         pred (OfflinePredictor): state -> Qvalue
+        max_batch (int): batch the predictions of the threads in an
+            InferenceServer of at most max_batch states (0 disables it)
 
     Evaluate pretrained models, or checkpoints of models during training
     """
     NR_PROC = min(multiprocessing.cpu_count() // 2, 8)
     with pred.sess.as_default():
-        mean_score, max_score, mean_dist, max_dist = eval_with_funcs(
-            [pred] * NR_PROC, nr_eval, get_player_fn, files_list)
+        if max_batch:
+            server = InferenceServer(None, None, max_batch=max_batch, max_latency=max_latency,
+                                     predictor=pred)
+            server.start()
+            pred = server
+        try:
+            mean_score, max_score, mean_dist, max_dist = eval_with_funcs(
+                [pred] * NR_PROC, nr_eval, get_player_fn, files_list)
+        finally:
+            if max_batch:
+                server.stop()
     logger.info("Average Score: {}; Max Score: {}; Average Distance: {}; Max Distance: {}".format(mean_score, max_score, mean_dist, max_dist))
 
 ###############################################################################
@@ -173,7 +422,12 @@ def eval_model_multithread(pred, nr_eval, get_player_fn, files_list):
 class Evaluator(Callback):
 
     def __init__(self, nr_eval, input_names, output_names,
-                 get_player_fn, files_list=None, data_type=None):
+                 get_player_fn, files_list=None, data_type=None, inference_server=None):
+        """
+        inference_server (InferenceServer): predict the states of all the
+            evaluation threads through the server instead of a predictor each
+        """
+        self.inference_server = inference_server
         self.files_list = files_list
         self.eval_episode = nr_eval
         self.input_names = input_names
@@ -183,8 +437,11 @@ class Evaluator(Callback):
 
     def _setup_graph(self):
         NR_PROC = min(multiprocessing.cpu_count() // 2, 20)
-        self.pred_funcs = [self.trainer.get_predictor(
-            self.input_names, self.output_names)] * NR_PROC
+        if self.inference_server is not None:
+            self.pred_funcs = [self.inference_server] * NR_PROC
+        else:
+            self.pred_funcs = [self.trainer.get_predictor(
+                self.input_names, self.output_names)] * NR_PROC
 
     def _trigger(self):
         """triggered by Trainer"""
@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: cropping.py
+
+import itertools
+import numpy as np
+from scipy import ndimage
+from collections import namedtuple
+
+__all__ = ['grid_start', 'window_lower', 'crop_grid', 'crop_volume', 'crop_image',
+           'FrameRef', 'crop_ref', 'VolumePyramid']
+
+# a screen referenced by the image (ImageRecord) it is cropped from, the
+# location of the agent and its scale
+FrameRef = namedtuple('FrameRef', ['image', 'location', 'scale'])
+
+
+def grid_start(lower, scale):
+    """ Return the first voxel sampled by MedicalPlayer._current_state along
+    one axis, given the lower bound of the window and the scale (stride).
+
+    Inside the image the window is sampled at lower, lower + scale, ...
+    When the window starts before the image, the current crop starts sampling
+    at voxel 0 and right-aligns the samples in the screen, which is the same
+    as sampling from the first multiple of scale above lower.
+    """
+    if lower >= 0:
+        return lower
+    return -((-lower) // scale) * scale
+
+
+def window_lower(location, scale, screen_dims):
+    """ Return the (unclipped) lower corner of the window of
+    MedicalPlayer._current_state, for one location or an array of locations.
+
+    Args
+      location: (3,) or (N, 3) integer locations
+      scale: scale of the window, an integer or an (N,) array
+      screen_dims: shape of the screen
+    """
+    span = np.asarray(screen_dims) * np.asarray(scale)[..., None]
+    # odd scales start one voxel before the centred window
+    return np.asarray(location) - span // 2 - np.asarray(scale)[..., None] % 2
+
+
+def crop_grid(source, start, screen_dims, out=None):
+    """ Copy source[start[0]:start[0] + screen_dims[0], ...] into a screen,
+    filling the voxels outside of source with zeros.
+
+    Args
+      source: 3d array
+      start: index of the first voxel along each axis, may be negative
+      screen_dims: shape of the screen
+      out: optional array of shape screen_dims to write into
+    Returns
+      the screen
+    """
+    if out is None:
+        out = np.zeros(screen_dims, dtype=source.dtype)
+    else:
+        out.fill(0)
+    src, dst = [], []
+    for axis in range(3):
+        lo = max(start[axis], 0)
+        hi = min(start[axis] + screen_dims[axis], source.shape[axis])
+        if hi <= lo:
+            return out
+        src.append(slice(lo, hi))
+        dst.append(slice(lo - start[axis], hi - start[axis]))
+    out[tuple(dst)] = source[tuple(src)]
+    return out
+
+
+def crop_volume(data, lower, scale, screen_dims, out=None):
+    """ Return the screen seen at scale with the window starting at lower,
+    sampled directly from the full resolution volume (see VolumePyramid.crop)
+    """
+    start = [grid_start(l, scale) for l in lower]
+    grid = data[start[0] % scale::scale,
+                start[1] % scale::scale,
+                start[2] % scale::scale]
+    return crop_grid(grid, [g // scale for g in start], screen_dims, out)
+
+
+def crop_image(image, lower, scale, screen_dims, out=None):
+    """ Return the screen of an ImageRecord, cropped from its pyramid when the
+    data reader attached one (see VolumePyramid.crop) or else from its data
+    """
+    pyramid = getattr(image, 'pyramid', None)
+    if pyramid is not None:
+        return pyramid.crop(lower, scale, screen_dims, out=out)
+    return crop_volume(image.data, lower, scale, screen_dims, out=out)
+
+
+def crop_ref(ref, screen_dims, out=None):
+    """ Return the screen of a FrameRef, as MedicalPlayer._current_state saw it """
+    lower = window_lower(ref.location, ref.scale, screen_dims)
+    return crop_image(ref.image, lower.tolist(), int(ref.scale), screen_dims, out=out)
+
+
+class VolumePyramid(object):
+    """ Pre-computed strided grids of a volume for the multi-scale agent.
+
+        At scale s the agent samples every s-th voxel starting at some voxel
+        g, i.e. data[g::s]. The pyramid stores, for every scale and every
+        phase g % s, the contiguous array data[px::s, py::s, pz::s], so a crop
+        at any scale becomes a contiguous slice of a small array instead of a
+        strided gather over the full resolution volume. All phases of a scale
+        together hold as many voxels as the volume itself.
+
+        With padding > 0 every grid (and the full resolution volume) is padded
+        once with that many zero voxels on each side. When the padding covers
+        half a screen, any window around a location inside the image is a
+        fixed-shape slice of a padded grid, so crops need no boundary
+        clipping and are returned as read-only views without allocating a
+        screen (see `padding_for`).
+
+        With antialias=True the volume is box filtered over s voxels before
+        sub-sampling, so coarse scales see the mean intensity of the
+        neighbourhood. This changes what the network sees and should only be
+        used with models trained that way.
+
+        The grids can be packed into a single flat array (see `pack`) and
+        viewed again with `from_packed`, so that a pyramid is stored next to
+        its volume and memory mapped instead of being rebuilt.
+
+        Attributes:
+        data: 3d volume
+        scales: strides to pre-compute (scale 1 uses data directly)
+        antialias: box filter before sub-sampling (default: False)
+        padding: zero voxels added on each side of every grid (default: 0)
+    """
+
+    def __init__(self, data, scales=(1, 2, 3), antialias=False, padding=0):
+        self.data = data
+        self.scales = scales
+        self.antialias = antialias
+        self.padding = padding
+        self.levels = {1: {(0, 0, 0): self._pad(data)}}
+        for scale in scales:
+            if scale == 1:
+                continue
+            source = data
+            if antialias:
+                source = ndimage.uniform_filter(data.astype('float32'), size=scale,
+                                                mode='constant')
+                if data.dtype.kind in 'ui':
+                    # round the averages as the volumes (see to_uint8)
+                    np.rint(source, out=source)
+                source = source.astype(data.dtype)
+            self.levels[scale] = {
+                phase: self._pad(source[phase[0]::scale,
+                                        phase[1]::scale,
+                                        phase[2]::scale])
+                for phase in itertools.product(range(scale), repeat=3)}
+
+    @staticmethod
+    def _layout(shape, scales, padding):
+        """ (scale, phase, shape) of the grids of a volume of shape held by
+        the packed array, in order; the unpadded scale 1 grid is the volume
+        itself and is not packed
+        """
+        layout = []
+        for scale in sorted(set(scales) | {1}):
+            if scale == 1 and not padding:
+                continue
+            for phase in itertools.product(range(scale), repeat=3):
+                layout.append((scale, phase, tuple(-(-(n - p) // scale) + 2 * padding
+                                                   for n, p in zip(shape, phase))))
+        return layout
+
+    def pack(self):
+        """ return the grids of the pyramid concatenated into a flat array """
+        grids = [self.levels[scale][phase].reshape(-1)
+                 for scale, phase, _ in self._layout(self.data.shape, self.scales, self.padding)]
+        if not grids:
+            return np.zeros(0, dtype=self.data.dtype)
+        return np.concatenate(grids)
+
+    @classmethod
+    def from_packed(cls, data, packed, scales=(1, 2, 3), antialias=False, padding=0):
+        """ return the pyramid of data whose grids are views of packed, an
+        array returned by `pack` (e.g. memory mapped from a volume cache)
+        """
+        layout = cls._layout(data.shape, scales, padding)
+        size = sum(int(np.prod(shape)) for _, _, shape in layout)
+        if packed.shape != (size,):
+            raise ValueError('packed pyramid of shape {}, expected ({},)'.format(packed.shape, size))
+        pyramid = cls.__new__(cls)
+        pyramid.data = data
+        pyramid.scales = scales
+        pyramid.antialias = antialias
+        pyramid.padding = padding
+        pyramid.levels = {1: {(0, 0, 0): data}}
+        offset = 0
+        for scale, phase, shape in layout:
+            n = int(np.prod(shape))
+            pyramid.levels.setdefault(scale, {})[phase] = packed[offset:offset + n].reshape(shape)
+            offset += n
+        return pyramid
+
+    @staticmethod
+    def padding_for(screen_dims):
+        """ return the padding that turns every crop of screen_dims around a
+        location inside the image into a slice of a padded grid
+        """
+        # the window starts at most half a screen (plus the odd scale offset
+        # rounded to the grid) before the location and ends at most half a
+        # screen (plus one grid voxel) after it
+        return max(screen_dims) // 2 + 2
+
+    def _pad(self, grid):
+        if not self.padding:
+            return np.ascontiguousarray(grid)
+        padded = np.zeros([n + 2 * self.padding for n in grid.shape], dtype=grid.dtype)
+        padded[self.padding:-self.padding,
+               self.padding:-self.padding,
+               self.padding:-self.padding] = grid
+        return padded
+
+    @property
+    def nbytes(self):
+        return sum(level.nbytes for scale, phases in self.levels.items()
+                   for level in phases.values() if scale > 1 or self.padding)
+
+    def crop(self, lower, scale, screen_dims, out=None):
+        """ Return the screen seen at scale with the window starting at lower
+        (the unclipped xmin, ymin, zmin of MedicalPlayer._current_state).
+
+        The screen is written into out if given. Otherwise a window lying in
+        the padded grid is returned as a read-only view and only windows
+        reaching past the padding allocate a new screen.
+        """
+        start = [grid_start(l, scale) for l in lower]
+        level = self.levels[scale][tuple(g % scale for g in start)]
+        index = [g // scale + self.padding for g in start]
+        if all(0 <= i and i + n <= m for i, n, m in zip(index, screen_dims, level.shape)):
+            view = level[index[0]:index[0] + screen_dims[0],
+                         index[1]:index[1] + screen_dims[1],
+                         index[2]:index[2] + screen_dims[2]]
+            if out is None:
+                # the view shares memory with the grid, it must not be modified
+                view.flags.writeable = False
+                return view
+            out[...] = view
+            return out
+        return crop_grid(level, index, screen_dims, out)
@@ -12,9 +12,17 @@ import SimpleITK as sitk
 from tensorpack import logger
 from IPython.core.debugger import set_trace
 import os
+import json
+import threading
+import weakref
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from scipy import ndimage
+from RL.volumeCache import VolumeCache, VolumeStore, to_uint8
+from RL.cropping import VolumePyramid
 
-__all__ = ['filesListBrainMRLandmark', 'filesListCardioLandmark', 'filesListFetalUSLandmark', 'NiftiImage']
+__all__ = ['filesListLandmark', 'filesListBrainMRLandmark', 'filesListCardioLandmark', 'filesListFetalUSLandmark',
+           'NiftiImage', 'register_dataset', 'register_landmark_parser', 'DATASETS']
 
 
 def getLandmarksFromTXTFile(file):
@@ -66,81 +74,166 @@ def getLandmarksFromVTKFile(file):
 ###############################################################################
 
 
-class filesListBrainMRLandmark(object):
-    """ A class for managing train files for mri brain data
+# registered landmark parsers, each returns an (N, 3) array of landmarks
+LANDMARK_PARSERS = {
+    'txt': getLandmarksFromTXTFile,
+    'txt_us': getLandmarksFromTXTFileUS,
+    'vtk': getLandmarksFromVTKFile,
+}
 
-        Attributes:
-        files_list: Two or one text files that contain a list of all images and (landmarks)
-        returnLandmarks: Return landmarks if task is train or eval (default: True)
+Dataset = namedtuple('Dataset', ['parser', 'landmark_index', 'physical_landmarks'])
+
+# registered datasets (modalities), see register_dataset
+DATASETS = {}
+
+
+def register_landmark_parser(name, parser):
+    """ Register a function that reads a landmark file and returns an (N, 3) array
     """
+    LANDMARK_PARSERS[name] = parser
 
-    def __init__(self, files_list=None, returnLandmarks=True, agents=1):
-        # check if files_list exists
-        assert files_list, 'There is no file give'
-        # read image filenames
-        with open(files_list[0].name) as f:
-            self.image_files = [line.split('\n')[0] for line in f]
-        # read landmark filenames if task is train or eval
-        self.returnLandmarks = returnLandmarks
-        self.agents = agents
-        if self.returnLandmarks:
-            with open(files_list[1].name) as f:
-                self.landmark_files = [line.split('\n')[0] for line in f]
-            assert len(self.image_files) == len(
-                self.landmark_files), 'number of image files is not equal to number of landmark files'
 
-    @property
-    def num_files(self):
-        return len(self.image_files)
+def register_dataset(name, parser, landmark_index, physical_landmarks=False):
+    """ Register a dataset (modality) used by filesListLandmark
 
-    def sample_circular(self, shuffle=False):
-        """ return a random sampled ImageRecord from the list of files
-        """
-        if shuffle:
-            indexes = rng.choice(x, len(x), replace=False)
-        else:
-            indexes = np.arange(self.num_files)
+        Args:
+        name: name of the dataset, as passed to --type
+        parser: name of a registered landmark parser
+        landmark_index: default index of the landmark to detect
+        physical_landmarks: True if the landmarks are in physical space and
+            need to be transformed to image coordinates
+    """
+    assert parser in LANDMARK_PARSERS, 'unknown landmark parser {}'.format(parser)
+    DATASETS[name] = Dataset(parser, landmark_index, physical_landmarks)
 
-        while True:
-            for idx in indexes:
-                sitk_image, image = NiftiImage().decode(self.image_files[idx])
-                if self.returnLandmarks:
-                    ## transform landmarks to image space if they are in physical space
-                    landmark_file = self.landmark_files[idx]
-                    all_landmarks = getLandmarksFromTXTFile(landmark_file)
-                    landmark = all_landmarks[14] # landmark index is 13 for ac-point and 14 pc-point
-                    # transform landmark from physical to image space if required
-                    # landmarks = sitk_image.TransformPhysicalPointToContinuousIndex(landmark)
-                    # landmarks = [np.round(all_landmarks[(i + 14) % 15]) for i in range(self.agents)]
-                    landmark = np.round(landmark).astype('int')
-                else:
-                    landmark = None
-                # extract filename from path, remove .nii.gz extension
-                image_filename = self.image_files[idx][:-7]
-
-                # images = [image] * self.agents
-                yield image, landmark, image_filename, sitk_image.GetSpacing()
-            # break
+
+# landmark index is 13 for ac-point and 14 pc-point
+register_dataset('BrainMRI', 'txt', 14)
+# Indexes: 0-2 RV insert points, 1 -> RV lateral wall turning point, 3 -> LV lateral wall mid-point,
+# 4 -> apex, 5-> center of the mitral valve
+register_dataset('CardiacMRI', 'vtk', 4, physical_landmarks=True)
+# landmark point 12 csp - 11 leftCerebellar - 10 rightCerebellar
+register_dataset('FetalUS', 'txt_us', 12)
 ###############################################################################
 
 
-class filesListCardioLandmark(object):
-    """ A class for managing train files for mri cardiac data
+# ways of building the per-volume pyramid of the multi-scale agent
+PYRAMIDS = (None, 'stride', 'antialias')
+
+# pyramids of the volumes in use in this process, by pyramid key, so that
+# players sampling the same volume share one pyramid
+_PYRAMIDS = weakref.WeakValueDictionary()
+_PYRAMIDS_LOCK = threading.Lock()
+
+
+class _FileName(object):
+    """ stand-in for the file objects given by argparse, only `name` is used """
+    def __init__(self, name):
+        self.name = name
+
+
+class filesListLandmark(object):
+    """ A class for managing image (and landmark) files of any registered dataset
+
+        Landmarks are read with the parser registered for the dataset. Decoded
+        volumes are optionally stored in a `VolumeCache` so that later passes
+        over the files list skip the decoding.
 
         Attributes:
         files_list: Two or one text files that contain a list of all images and (landmarks)
         returnLandmarks: Return landmarks if task is train or eval (default: True)
+        cache_dir: directory of the pre-processed volume cache (default: None, no caching)
+        store_dir: directory of a prebuilt, memory mapped `VolumeStore` (default: None)
+        dataset: name of a registered dataset (default: the class `dataset`)
+        dataset_spec: `Dataset` of a modality that is not registered, named
+            dataset (default: the registered one)
+        landmark_index: index of the landmark to detect (default: from the dataset)
+        shuffle: visit the files in a new random order on every pass (default: False)
+        seed: seed of the shuffling, equal seeds give equal orders (default: None)
+        shard: (index, count) - only sample every count-th file starting at
+            index, so that workers sharing a seed sample disjoint files.
+            With more shards than files, shard index samples the file
+            index % num_files alone
+        fast_normalisation: normalise intensities with the in place numpy
+            path instead of SimpleITK (default: False)
+        pyramid: attach a `VolumePyramid` to every sampled image, either
+            'stride' or 'antialias' (default: None). It is built once per
+            volume and saved in the volume cache next to the volume, or read
+            from the volume store if it was exported with the volume
+        pyramid_padding: zero voxels around every grid of the pyramid (default: 0)
     """
+    dataset = None
 
-    def __init__(self, files_list=None, returnLandmarks=True, agents=1):
+    def __init__(self, files_list=None, returnLandmarks=True, agents=1, cache_dir=None,
+                 store_dir=None, dataset=None, landmark_index=None, shuffle=False,
+                 seed=None, shard=(0, 1), fast_normalisation=False, pyramid=None,
+                 pyramid_padding=0, dataset_spec=None):
         # check if files_list exists
         assert files_list, 'There is no file given'
-        # read image filenames
-        with open(files_list[0].name) as f:
-            self.image_files = [line.split('\n')[0] for line in f]
+        if dataset is not None:
+            self.dataset = dataset
+        if dataset_spec is None:
+            assert self.dataset in DATASETS, 'unknown dataset {}'.format(self.dataset)
+            dataset_spec = DATASETS[self.dataset]
+        spec = dataset_spec
+        self.landmark_parser = spec.parser
+        self.physical_landmarks = spec.physical_landmarks
+        self.landmark_index = spec.landmark_index if landmark_index is None else landmark_index
         # read landmark filenames if task is train or eval
         self.returnLandmarks = returnLandmarks
         self.agents = agents
+        self._read_files_list(files_list)
+        self.cache = VolumeCache(cache_dir) if cache_dir else None
+        self.store = VolumeStore(store_dir) if store_dir else None
+        self.nifti = NiftiImage(fast_normalisation)
+        self.shuffle = shuffle
+        self.seed = seed
+        assert 0 <= shard[0] < shard[1], 'invalid shard {}'.format(shard)
+        if shard[1] > self.num_files:
+            # more workers than files, workers share the file of their index
+            shard = (shard[0] % self.num_files, self.num_files)
+        self.shard = shard
+        assert pyramid in PYRAMIDS, 'unknown pyramid {}'.format(pyramid)
+        self.pyramid = pyramid
+        self.pyramid_padding = pyramid_padding
+
+    @classmethod
+    def from_manifest(cls, manifest, returnLandmarks=True, **kwargs):
+        """ create a files list from a JSON manifest, e.g.
+            {"type": "BrainMRI",
+             "images": "./data/filenames/brain_train_files_new_paths.txt",
+             "landmarks": "./data/filenames/brain_train_landmarks_new_paths.txt",
+             "landmark_index": 13, "shuffle": true, "seed": 0}
+        A new modality is declared with "parser" (a registered landmark parser)
+        and optionally "physical_landmarks" instead of a registered "type";
+        it is only known to the returned files list, not registered.
+        Keyword arguments override the manifest.
+        """
+        with open(manifest) as f:
+            spec = json.load(f)
+        dataset = spec.get('type')
+        options = {'dataset': dataset}
+        if dataset is None:
+            assert spec['parser'] in LANDMARK_PARSERS, 'unknown landmark parser {}'.format(spec['parser'])
+            options['dataset'] = os.path.basename(manifest)
+            options['dataset_spec'] = Dataset(spec['parser'], spec.get('landmark_index', 0),
+                                              spec.get('physical_landmarks', False))
+        files_list = [_FileName(spec['images'])]
+        if returnLandmarks:
+            files_list.append(_FileName(spec['landmarks']))
+        for key in ['landmark_index', 'shuffle', 'seed']:
+            if key in spec:
+                options[key] = spec[key]
+        if 'shard' in spec:
+            options['shard'] = tuple(spec['shard'])
+        options.update(kwargs)
+        return cls(files_list, returnLandmarks=returnLandmarks, **options)
+
+    def _read_files_list(self, files_list):
+        """ read the image filenames, and the landmark filenames if returnLandmarks
+        """
+        with open(files_list[0].name) as f:
+            self.image_files = [line.split('\n')[0] for line in f]
         if self.returnLandmarks:
             with open(files_list[1].name) as f:
                 self.landmark_files = [line.split('\n')[0] for line in f]
@@ -151,142 +244,271 @@ class filesListCardioLandmark(object):
     def num_files(self):
         return len(self.image_files)
 
-    def sample_circular(self, shuffle=False):
-        """ return a random sampled ImageRecord from the list of files
+    def _decode(self, idx):
+        """ decode image idx and return (image, landmark, spacing)
         """
-        if shuffle:
-            indexes = rng.choice(x, len(x), replace=False)
-        else:
-            indexes = np.arange(self.num_files)
+        sitk_image, image = self.nifti.decode(self.image_files[idx])
+        landmark = self._parse_landmark(idx, sitk_image) if self.returnLandmarks else None
+        return image, landmark, sitk_image.GetSpacing()
 
+    def _parse_landmark(self, idx, sitk_image=None):
+        """ return the landmark of image idx in image space, transformed from
+        physical space with sitk_image (read if None) if required
+        """
+        all_landmarks = LANDMARK_PARSERS[self.landmark_parser](self.landmark_files[idx])
+        landmark = all_landmarks[self.landmark_index]
+        if self.physical_landmarks:
+            if sitk_image is None:
+                sitk_image = sitk.ReadImage(os.path.expanduser(self.image_files[idx]))
+            landmark = sitk_image.TransformPhysicalPointToContinuousIndex(landmark)
+        return np.round(landmark).astype('int')
+
+    def cache_key(self, idx):
+        """ return the key of image idx in the volume cache and store, the
+        same with and without landmarks
+        """
+        return VolumeCache.key(self.image_files[idx], **self.nifti.preprocessing_params())
+
+    def landmark_key(self, idx):
+        """ return the key of the landmark of image idx in the volume cache and store
+        """
+        return VolumeCache.key(self.image_files[idx], self.landmark_files[idx],
+                               landmark_parser=self.landmark_parser,
+                               landmark_index=self.landmark_index,
+                               physical_landmarks=self.physical_landmarks)
+
+    def _load_landmark(self, idx):
+        """ return the landmark of image idx, read from the store or cache,
+        or else parsed (and saved in the cache if enabled)
+        """
+        key = self.landmark_key(idx)
+        landmark = None
+        if self.store is not None:
+            landmark = self.store.load_landmark(key)
+        if landmark is None and self.cache is not None:
+            landmark = self.cache.load_landmark(key)
+        if landmark is None:
+            landmark = self._parse_landmark(idx)
+            if self.cache is not None:
+                self.cache.save_landmark(key, landmark, source=self.landmark_files[idx])
+        return landmark
+
+    def pyramid_key(self, idx):
+        """ return the key of the pyramid of image idx in the volume cache and store
+        """
+        return '{}-pyramid-{}-{}'.format(self.cache_key(idx), self.pyramid, self.pyramid_padding)
+
+    def _load_pyramid(self, idx, data, spacing):
+        """ return the VolumePyramid of image idx, shared with the players of
+        the process holding it, read from the store or cache, or else built
+        (and saved in the cache if enabled)
+        """
+        key = self.pyramid_key(idx)
+        with _PYRAMIDS_LOCK:
+            pyramid = _PYRAMIDS.get(key)
+        if pyramid is not None:
+            return pyramid
+        antialias = self.pyramid == 'antialias'
+        entry = None
+        if self.store is not None:
+            entry = self.store.load(key)
+        if entry is None and self.cache is not None:
+            entry = self.cache.load(key)
+        if entry is not None:
+            try:
+                pyramid = VolumePyramid.from_packed(data, entry[0], antialias=antialias,
+                                                    padding=self.pyramid_padding)
+            except ValueError as e:
+                logger.warn("Ignoring the pyramid of {}: {}".format(self.image_files[idx], e))
+        if pyramid is None:
+            pyramid = VolumePyramid(data, antialias=antialias, padding=self.pyramid_padding)
+            if self.cache is not None:
+                self.cache.save(key, pyramid.pack(), None, spacing, source=self.image_files[idx])
+        with _PYRAMIDS_LOCK:
+            return _PYRAMIDS.setdefault(key, pyramid)
+
+    def _load(self, idx):
+        """ return (image, landmark, spacing) of image idx, using the store
+        and cache if enabled
+        """
+        if self.cache is None and self.store is None:
+            return self._decode(idx)
+
+        key = self.cache_key(idx)
+        entry = None
+        if self.store is not None:
+            entry = self.store.load(key)
+            if entry is None:
+                logger.warn("{} is not in the volume store, decoding it".format(self.image_files[idx]))
+        if entry is None and self.cache is not None:
+            entry = self.cache.load(key)
+        if entry is None:
+            image, landmark, spacing = self._decode(idx)
+            if self.cache is not None:
+                self.cache.save(key, image.data, None, spacing, source=self.image_files[idx])
+                if landmark is not None:
+                    self.cache.save_landmark(self.landmark_key(idx), landmark,
+                                             source=self.landmark_files[idx])
+        else:
+            data, _, spacing = entry
+            image = ImageRecord()
+            image.name = os.path.expanduser(self.image_files[idx])
+            image.data = data
+            image.dims = data.shape
+            landmark = self._load_landmark(idx) if self.returnLandmarks else None
+        return image, landmark, spacing
+
+    def export_to_store(self, store):
+        """ add every image of the files list that is missing from a `VolumeStore`,
+        with its landmark if the files list has landmarks and its packed
+        pyramid if it has one
+        """
+        for idx in range(self.num_files):
+            key = self.cache_key(idx)
+            missing = key not in store
+            missing_landmark = self.returnLandmarks and self.landmark_key(idx) not in store
+            missing_pyramid = self.pyramid and self.pyramid_key(idx) not in store
+            if not (missing or missing_landmark or missing_pyramid):
+                continue
+            logger.info("Adding {} to the volume store".format(self.image_files[idx]))
+            image, landmark, spacing = self._load(idx)
+            if missing:
+                store.add(key, image.data, None, spacing, source=self.image_files[idx])
+            if missing_landmark:
+                store.add_landmark(self.landmark_key(idx), landmark, source=self.landmark_files[idx])
+            if missing_pyramid:
+                pyramid = VolumePyramid(image.data, antialias=self.pyramid == 'antialias',
+                                        padding=self.pyramid_padding)
+                store.add(self.pyramid_key(idx), pyramid.pack(), None, spacing,
+                          source=self.image_files[idx])
+        store.flush()
+
+    def _circular_indexes(self, shuffle=None):
+        """ return an endless generator of the file indexes of this shard
+        """
+        if shuffle is None:
+            shuffle = self.shuffle
+        rng = np.random.RandomState(self.seed)
+        indexes = np.arange(self.num_files)
         while True:
-            for idx in indexes:
-                sitk_image, image = NiftiImage().decode(self.image_files[idx], is_cardiac=True)
-                if self.returnLandmarks:
-                    landmark_file = self.landmark_files[idx]
-                    all_landmarks = getLandmarksFromVTKFile(landmark_file)
-                    # transform landmarks to image coordinates
-                    # print(all_landmarks, '\n')
-                    all_landmarks = [sitk_image.TransformPhysicalPointToContinuousIndex(point)
-                                     for point in all_landmarks]
-                    # print(all_landmarks, '\n')
-                    # Indexes: 0-2 RV insert points, 1 -> RV lateral wall turning point, 3 -> LV lateral wall mid-point,
-                    # 4 -> apex, 5-> center of the mitral valve
-                    landmark = all_landmarks[4]
-                    # landmarks = [np.round(all_landmarks[(i + 4) % 6]) for i in range(self.agents)]  # Apex + MV
-                    # landmarks = [np.round(all_landmarks[(i + 3) % 6]) for i in range(self.agents)]  # LV + Apex
-                    # landmarks = [np.round(all_landmarks[((i + 1) + 3) % 6]) for i in range(self.agents)] # LV + MV
-                    landmark = np.round(landmark).astype('int')
-                else:
-                    landmark = None
-
-                # extract filename from path, remove .nii.gz extension
-                image_filename = self.image_files[idx][:-7]
-                # images = [image] * self.agents
-                yield image, landmark, image_filename, sitk_image.GetSpacing()
-            # break
+            if shuffle:
+                # all shards draw the same permutation and take their part of it
+                indexes = rng.permutation(self.num_files)
+            for idx in indexes[self.shard[0]::self.shard[1]]:
+                yield idx
+
+    def _sample(self, idx):
+        """ return (image, landmark, image_filename, spacing) of image idx
+        """
+        image, landmark, spacing = self._load(idx)
+        if self.pyramid:
+            # loaded here so that it is built in the prefetch threads
+            image.pyramid = self._load_pyramid(idx, image.data, spacing)
+        # extract filename from path, remove .nii.gz extension
+        image_filename = self.image_files[idx][:-7]
+        # images = [image] * self.agents
+        return image, landmark, image_filename, spacing
+
+    def sample_circular(self, shuffle=None):
+        """ return a random sampled ImageRecord from the list of files
+        """
+        for idx in self._circular_indexes(shuffle):
+            yield self._sample(idx)
+
+    def sample_prefetch(self, size, workers=1, shuffle=None):
+        """ same as sample_circular, but the next `size` volumes are decoded
+        ahead of time by a pool of `workers` background threads, so taking
+        the next sample only waits if the volume is not ready yet.
+        Decoding releases the GIL (SimpleITK, numpy, file IO) so threads are
+        enough to overlap it with the simulator.
+        """
+        indexes = self._circular_indexes(shuffle)
+        executor = ThreadPoolExecutor(max_workers=workers)
+        # bounded queue of volumes being decoded, kept in sampling order
+        pending = deque(executor.submit(self._sample, next(indexes))
+                        for _ in range(size))
+        try:
+            while True:
+                sample = pending.popleft().result()
+                pending.append(executor.submit(self._sample, next(indexes)))
+                yield sample
+        finally:
+            executor.shutdown(wait=False)
 ###############################################################################
 
 
-class filesListFetalUSLandmark(object):
-    """ A class for managing train files for fetal ultrasound data
-
-        Attributes:
-        files_list: Two or one text files that contain a list of all images and (landmarks)
-        returnLandmarks: Return landmarks if task is train or eval (default: True)
+class filesListBrainMRLandmark(filesListLandmark):
+    """ A class for managing train files for mri brain data
     """
+    dataset = 'BrainMRI'
 
-    def __init__(self, files_list=None, returnLandmarks=True, agents=1):
-        # check if files_list exists
-        assert files_list, 'There is no file given'
-        # read image filenames
-        with open(files_list[0].name) as f:
-            self.image_files = [line.split('\n')[0] for line in f]
-        # read landmark filenames if task is train or eval
-        self.returnLandmarks = returnLandmarks
-        self.agents = agents
-        if self.returnLandmarks:
-            with open(files_list[1].name) as f:
-                self.landmark_files = [line.split('\n')[0] for line in f]
-            assert len(self.image_files) == len(
-                self.landmark_files), 'number of image files is not equal to number of landmark files'
 
-    @property
-    def num_files(self):
-        return len(self.image_files)
+class filesListCardioLandmark(filesListLandmark):
+    """ A class for managing train files for mri cardiac data
+    """
+    dataset = 'CardiacMRI'
 
-    def sample_circular(self, shuffle=False):
-        """ return a random sampled ImageRecord from the list of files
-        """
-        if shuffle:
-            indexes = rng.choice(x, len(x), replace=False)
-        else:
-            indexes = np.arange(self.num_files)
 
-        while True:
-            for idx in indexes:
-                sitk_image, image = NiftiImage().decode(self.image_files[idx])
-                if self.returnLandmarks:
-                    landmark_file = self.landmark_files[idx]
-                    all_landmarks = getLandmarksFromTXTFileUS(landmark_file)
-                    # landmark point 12 csp - 11 leftCerebellar - 10 rightCerebellar
-                    landmark = all_landmarks[12] #0
-
-
-                    # landmarks = [np.round(all_landmarks[(i*2 + 10) % 13]) for i in range(self.agents)]
-                    # landmark = [np.round(all_landmarks[(i + 10) % 13]) for i in range(self.agents)]  # Apex + MV
-                    landmark = np.round(landmark).astype('int')
-                else:
-                    landmark = None
-
-                # extract filename from path, remove .nii.gz extension
-                image_filename = self.image_files[idx][:-7]
-                # images = [image] * self.agents
-
-                yield image, landmark, image_filename, sitk_image.GetSpacing()
-            # break
+class filesListFetalUSLandmark(filesListLandmark):
+    """ A class for managing train files for fetal ultrasound data
+    """
+    dataset = 'FetalUS'
 ###############################################################################
 
-class fileHITL(object):
+class fileHITL(filesListLandmark):
     """ A class for managing train image for HITL
 
         Attributes:
-        files_list: Two or one text files that contain a list of all images and (landmarks)
-        returnLandmarks: Return landmarks if task is train or eval (default: True)
+        file_name: list of the image files, given in place of a files list
+        returnLandmarks: ignored, the HITL images have no landmark files
     """
+    dataset = 'HITL'
 
-    def __init__(self, file_name=None, returnLandmarks=False, agents=1):
-        # check if files_list exists
-        assert file_name, 'There is no file given'
-        # read image filenames
-        self.image_files = file_name
-        # read landmark filenames if task is train or eval
-        self.returnLandmarks = returnLandmarks
-        self.agents = agents
+    def __init__(self, file_name=None, returnLandmarks=False, **kwargs):
+        super(fileHITL, self).__init__(file_name, returnLandmarks=False,
+                                       dataset_spec=Dataset(None, None, False), **kwargs)
 
-    @property
-    def num_files(self):
-        return 1
+    def _read_files_list(self, files_list):
+        """ the image filenames are given in place of the files list """
+        self.image_files = list(files_list)
+###############################################################################
 
-    def sample_circular(self, shuffle=False):
-        """ return a random sampled ImageRecord from the list of files
-        """
-        if shuffle:
-            indexes = rng.choice(x, len(x), replace=False)
-        else:
-            indexes = np.arange(self.num_files)
 
-        while True:
-            for idx in indexes:
-                sitk_image, image = NiftiImage().decode(self.image_files[idx])
-                landmark = None
-
-                # extract filename from path, remove .nii.gz extension
-                image_filename = self.image_files[idx][:-7]
-                # images = [image] * self.agents
-                yield image, landmark, image_filename, sitk_image.GetSpacing()
-            # break
-###############################################################################
+def normalise_intensity(data, lower_percentile, upper_percentile, output_range=(0, 255)):
+    """ Clip a volume between two percentiles and re-scale it to output_range, in place.
+
+    Equivalent to the SimpleITK path in NiftiImage.decode (two Threshold
+    passes and RescaleIntensity) but both percentiles are found with a single
+    np.partition and clipping/re-scaling is done in place, so only one extra
+    copy of the volume is allocated. The percentiles are the ones of
+    np.percentile (linear interpolation); the rescaled values are computed in
+    float32 instead of float64, and differ from SimpleITK by less than 1e-3.
+    After rounding to uint8 a few voxels lying on a .5 boundary (about one in
+    a million) can differ by one intensity level.
+
+    Args
+      data: float32 array, modified in place
+    Returns
+      data
+    """
+    flat = data.reshape(-1)
+    n = flat.size
+    # positions of the order statistics interpolated by np.percentile
+    positions = [q / 100.0 * (n - 1) for q in (lower_percentile, upper_percentile)]
+    kth = sorted({int(np.floor(p)) for p in positions} | {int(np.ceil(p)) for p in positions})
+    part = np.partition(flat, kth)
+    lower, upper = [part[int(np.floor(p))] + (part[int(np.ceil(p))] - part[int(np.floor(p))]) * (p - np.floor(p))
+                    for p in positions]
+    del part
+
+    np.clip(flat, lower, upper, out=flat)
+    if upper > lower:
+        flat -= lower
+        flat *= (output_range[1] - output_range[0]) / (upper - lower)
+        flat += output_range[0]
+    else:
+        flat.fill(output_range[0])
+    return data
 
 
 class ImageRecord(object):
@@ -297,8 +519,25 @@ class ImageRecord(object):
 class NiftiImage(object):
     """Helper class that provides TensorFlow image coding utilities."""
 
-    def __init__(self):
-        pass
+    # threshold the intensities between these percentiles, then re-scale
+    lower_percentile = 10
+    upper_percentile = 99
+    output_range = (0, 255)
+
+    def __init__(self, fast_normalisation=False):
+        """
+        :param fast_normalisation: normalise the intensities in place with
+            numpy (see normalise_intensity) instead of SimpleITK filters
+        """
+        self.fast_normalisation = fast_normalisation
+
+    def preprocessing_params(self):
+        """ return the intensity pre-processing parameters, used to key cached volumes
+        """
+        return {'lower_percentile': self.lower_percentile,
+                'upper_percentile': self.upper_percentile,
+                'output_range': list(self.output_range),
+                'fast_normalisation': self.fast_normalisation}
 
     def _is_nifti(self, filename):
         """Determine if a file contains a nifti format image.
@@ -312,6 +551,9 @@ class NiftiImage(object):
 
     def decode(self, filename, label=False, is_cardiac=False):
         """ decode a single nifti image
+        Intensities are normalised in float32 then rounded to uint8 (see
+        to_uint8), so decoded, cached and stored volumes are identical and a
+        quarter of the size of the float32 volume.
         Args
           filename: string for input images
           label: True if nifti image is label
@@ -325,14 +567,26 @@ class NiftiImage(object):
 
         if label:
             sitk_image = sitk.ReadImage(image.name, sitk.sitkInt8)
+        elif self.fast_normalisation:
+            sitk_image = sitk.ReadImage(image.name, sitk.sitkFloat32)
+            np_image = normalise_intensity(sitk.GetArrayFromImage(sitk_image),
+                                           self.lower_percentile,
+                                           self.upper_percentile,
+                                           self.output_range)
+            # Convert from [depth, width, height] to [width, height, depth]
+            image.data = to_uint8(np_image, inplace=True).transpose(2, 1, 0)
+            image.dims = image.data.shape
+            # the returned sitk image only provides the geometry (spacing,
+            # physical to index transform) which normalisation does not change
+            return sitk_image, image
         else:
             sitk_image = sitk.ReadImage(image.name, sitk.sitkFloat32)
             np_image = sitk.GetArrayFromImage(sitk_image)
 
             # threshold image between p10 and p98 then re-scale [0-255]
             p0 = np_image.min().astype('float')
-            p10 = np.percentile(np_image, 10)
-            p99 = np.percentile(np_image, 99)
+            p10 = np.percentile(np_image, self.lower_percentile)
+            p99 = np.percentile(np_image, self.upper_percentile)
             p100 = np_image.max().astype('float')
             # logger.info('p0 {} , p5 {} , p10 {} , p90 {} , p98 {} , p100 {}'.format(p0,p5,p10,p90,p98,p100))
             sitk_image = sitk.Threshold(sitk_image,
@@ -344,11 +598,14 @@ class NiftiImage(object):
                                         upper=p99,
                                         outsideValue=p99)
             sitk_image = sitk.RescaleIntensity(sitk_image,
-                                               outputMinimum=0,
-                                               outputMaximum=255)
+                                               outputMinimum=self.output_range[0],
+                                               outputMaximum=self.output_range[1])
 
         # Convert from [depth, width, height] to [width, height, depth]
-        image.data = sitk.GetArrayFromImage(sitk_image).transpose(2, 1, 0)  # .astype('uint8')
+        image.data = sitk.GetArrayFromImage(sitk_image)
+        if not label:
+            image.data = to_uint8(image.data, inplace=True)
+        image.data = image.data.transpose(2, 1, 0)
         image.dims = image.data.shape
         
         return sitk_image, image
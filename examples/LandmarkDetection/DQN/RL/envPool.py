@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: envPool.py
+
+import traceback
+import multiprocessing as mp
+from multiprocessing.sharedctypes import RawArray
+import numpy as np
+from collections import defaultdict
+
+from tensorpack.utils import logger
+from tensorpack.utils.stats import StatCounter
+
+from RL.batchedEnv import BatchedMedicalEnv
+
+__all__ = ['EnvPool']
+
+
+def _worker(conn, player_fn, indexes, buffer, shape, dtype):
+    """ step a BatchedMedicalEnv of the players indexes and write its
+    observations into the shared ring buffer
+    """
+    try:
+        env = BatchedMedicalEnv([player_fn(i) for i in indexes])
+        ring = np.frombuffer(buffer, dtype=dtype).reshape(shape)
+        lo, hi = indexes[0], indexes[-1] + 1
+        conn.send(('ready', (env.action_space, env.observation_space)))
+        while True:
+            cmd, args = conn.recv()
+            if cmd == 'step':
+                slot, acts, qvalues = args
+                _, reward, isOver, info = env.step(acts, qvalues, out=ring[slot, lo:hi])
+            elif cmd == 'reset':
+                slot = args
+                env.reset(out=ring[slot, lo:hi])
+                reward, isOver, info = None, None, None
+            elif cmd == 'close':
+                break
+            # report the games played and won since the last command
+            stats = (env.num_games.sum, env.num_success.sum)
+            env.reset_stat()
+            conn.send(('ok', (reward, isOver, info, stats)))
+    except Exception:
+        conn.send(('error', traceback.format_exc()))
+    finally:
+        conn.close()
+
+
+class EnvPool(object):
+    """ A pool of worker processes stepping MedicalPlayer episodes.
+
+        Every worker owns the players of a contiguous block of episodes,
+        steps them as a BatchedMedicalEnv and crops their observations into a
+        ring of shared memory buffers. The parent only sends actions and
+        q-values and receives rewards, terminal flags and infos over pipes,
+        so env stepping runs on several cores instead of behind the GIL.
+
+        The pool has the interface of BatchedMedicalEnv. Observations are
+        read-only views of the ring, a buffer is overwritten ring_size steps
+        after it was returned; they are written as uint8 (the dtype of the
+        replay memory) unless another dtype is given.
+
+        Attributes:
+        player_fn: function returning the MedicalPlayer of episode i, run in
+            the workers (must be picklable if processes are not forked)
+        num_envs: number of episodes
+        num_workers: number of worker processes
+        screen_dims: shape of the observations
+        ring_size: number of observation buffers (default: 2)
+    """
+
+    def __init__(self, player_fn, num_envs, num_workers, screen_dims, ring_size=2, dtype='uint8'):
+        assert 0 < num_workers <= num_envs, 'invalid number of workers {} for {} episodes'.format(
+            num_workers, num_envs)
+        self.num_envs = num_envs
+        self.ring_size = ring_size
+        self.dtype = np.dtype(dtype)
+        self._slot = 0
+        shape = (ring_size, num_envs) + tuple(screen_dims)
+        buffer = RawArray('b', int(np.prod(shape)) * self.dtype.itemsize)
+        self._ring = np.frombuffer(buffer, dtype=self.dtype).reshape(shape)
+        self._blocks = np.array_split(np.arange(num_envs), num_workers)
+
+        self._conns, self._procs = [], []
+        for indexes in self._blocks:
+            parent_conn, child_conn = mp.Pipe()
+            proc = mp.Process(target=_worker, args=(child_conn, player_fn, list(indexes),
+                                                    buffer, shape, self.dtype))
+            proc.daemon = True
+            proc.start()
+            child_conn.close()
+            self._conns.append(parent_conn)
+            self._procs.append(proc)
+        self.action_space, self.observation_space = self._receive()[0]
+        self.actions = self.action_space.n
+        self.reset_stat()
+        logger.info("Started {} env workers for {} episodes".format(num_workers, num_envs))
+
+    def reset_stat(self):
+        """ Reset all statistics counter"""
+        self.stats = defaultdict(list)
+        self.num_games = StatCounter()
+        self.num_success = StatCounter()
+
+    def _receive(self):
+        replies = []
+        for conn in self._conns:
+            status, reply = conn.recv()
+            if status == 'error':
+                self.close()
+                raise RuntimeError("Env worker failed:\n{}".format(reply))
+            replies.append(reply)
+        return replies
+
+    def _collect(self):
+        """ gather the replies of all workers into arrays """
+        replies = self._receive()
+        for _, _, _, (games, success) in replies:
+            if games:
+                self.num_games.feed(games)
+            if success:
+                self.num_success.feed(success)
+        return replies
+
+    def _next_slot(self):
+        slot = self._slot
+        self._slot = (self._slot + 1) % self.ring_size
+        return slot
+
+    def _observation(self, slot):
+        obs = self._ring[slot]
+        obs.flags.writeable = False
+        return obs
+
+    def reset(self):
+        """ start a new episode in every slot and return the (N, ...) observations """
+        slot = self._next_slot()
+        for conn in self._conns:
+            conn.send(('reset', slot))
+        self._collect()
+        return self._observation(slot)
+
+    def step(self, acts, qvalues=None):
+        """ apply one action per episode, see BatchedMedicalEnv.step """
+        acts = np.asarray(acts)
+        if qvalues is None:
+            qvalues = np.zeros((self.num_envs, self.actions), dtype='float32')
+        slot = self._next_slot()
+        for conn, indexes in zip(self._conns, self._blocks):
+            conn.send(('step', (slot, acts[indexes], qvalues[indexes])))
+        replies = self._collect()
+        reward = np.concatenate([r[0] for r in replies])
+        isOver = np.concatenate([r[1] for r in replies])
+        info = [i for r in replies for i in r[2]]
+        return self._observation(slot), reward, isOver, info
+
+    def close(self):
+        """ stop the worker processes """
+        for conn in self._conns:
+            try:
+                conn.send(('close', None))
+            except (OSError, BrokenPipeError):
+                pass
+        for proc in self._procs:
+            proc.join(timeout=5)
+        self._conns, self._procs = [], []
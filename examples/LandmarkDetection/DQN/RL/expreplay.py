@@ -19,8 +19,11 @@ from tensorpack.utils.utils import get_tqdm, get_rng
 from tensorpack.utils.concurrency import LoopThread, ShareSessionThread
 
 import os
-import pickle
-from RL.medical import MedicalPlayer
+import math
+import json
+from RL.cropping import FrameRef, crop_ref
+from RL.sumTree import SumTree
+from RL.hitl import hitl_paths, hitl_log_files, allowed_images, render_logs, DemonstrationBuffer
 
 __all__ = ['ExpReplay']
 
@@ -29,12 +32,38 @@ Experience = namedtuple('Experience',
 
 
 class ReplayMemory(object):
-    def __init__(self, max_size, state_shape, history_len):
-        self.max_size = int(max_size)
+    """ Replay memory of single frames, stacked into histories when sampled.
+
+    With num_streams > 1 the memory holds the interleaved transitions of
+    num_streams environments stepped together (see BatchedMedicalEnv), which
+    must be appended in the same environment order at every step. The frames
+    of one environment are then num_streams slots apart.
+
+    With n_step > 1, sample_batch returns n-step transitions: the sum of the
+    next n rewards (clipped to [-1, 1]) discounted by gamma, the history of
+    the n-th next state and the discount gamma^n of its value, which is 0 if
+    the episode ends within the n steps.
+
+    The memory can be saved into a directory and restored from it (see save
+    and restore), so that resumed trainings start from a full memory.
+    """
+    # slots per chunk of frames written by save, only the chunks with new
+    # transitions since the last save are written again
+    SAVE_CHUNK = 1024
+    # fields of the saved metadata that must match to restore a memory
+    _SAVE_FIELDS = ('max_size', 'state_shape', 'history_len', 'num_streams', 'n_step')
+
+    def __init__(self, max_size, state_shape, history_len, num_streams=1, n_step=1, gamma=None):
+        self.num_streams = int(num_streams)
+        # every stream keeps the same slots when the memory wraps around
+        self.max_size = int(max_size) // self.num_streams * self.num_streams
         self.state_shape = state_shape
         self.history_len = int(history_len)
+        self.n_step = int(n_step)
+        assert self.n_step == 1 or gamma is not None, 'n-step returns need a discount factor'
+        self.gamma = gamma
 
-        self.state = np.zeros((self.max_size,) + state_shape, dtype='uint8')
+        self._init_storage()
         self.action = np.zeros((self.max_size,), dtype='int32')
         self.reward = np.zeros((self.max_size,), dtype='float32')
         self.isOver = np.zeros((self.max_size,), dtype='bool')
@@ -42,30 +71,50 @@ class ReplayMemory(object):
 
         self._curr_size = 0
         self._curr_pos = 0
-        self._hist = deque(maxlen=history_len - 1)
+        self._hists = [deque(maxlen=history_len - 1) for _ in range(self.num_streams)]
+        # chunks of slots changed since the last save, and the frames file it wrote
+        self._dirty = np.ones(-(-self.max_size // self.SAVE_CHUNK), dtype='bool')
+        self._saved_frames = None
+        # appends hold the lock, so that save can take a consistent snapshot
+        self._lock = threading.Lock()
+        self._num_appended = 0
+
+    def _init_storage(self):
+        self.state = np.zeros((self.max_size,) + self.state_shape, dtype='uint8')
 
     def append(self, exp):
         """Append the replay memory with experience sample
         Args:
             exp (Experience): experience contains (state, reward, action, isOver)
+        Returns:
+            the slot of the experience
         """
-        # increase current memory size if it is not full yet
-        if self._curr_size < self.max_size:
-            self._assign(self._curr_pos, exp)
-            self._curr_pos = (self._curr_pos + 1) % self.max_size
-            self._curr_size += 1
-        else:
-            self._assign(self._curr_pos, exp)
-            self._curr_pos = (self._curr_pos + 1) % self.max_size
-        if exp.isOver:
-            self._hist.clear()
-        else:
-            self._hist.append(exp)
+        with self._lock:
+            pos = self._curr_pos
+            hist = self._hists[pos % self.num_streams]
+            # increase current memory size if it is not full yet
+            if self._curr_size < self.max_size:
+                self._assign(self._curr_pos, exp)
+                self._curr_pos = (self._curr_pos + 1) % self.max_size
+                self._curr_size += 1
+            else:
+                self._assign(self._curr_pos, exp)
+                self._curr_pos = (self._curr_pos + 1) % self.max_size
+            self._num_appended += 1
+            # marked after the assignment, a concurrent save then writes the chunk again
+            self._dirty[pos // self.SAVE_CHUNK] = True
+            if exp.isOver:
+                hist.clear()
+            else:
+                # keep the stored frame, the caller may reuse the buffer of exp.state
+                hist.append(exp._replace(state=self._frame(pos)))
+        return pos
 
-    def recent_state(self):
+    def recent_state(self, stream=0):
         """ return a list of (hist_len-1,) + STATE_SIZE """
-        lst = list(self._hist)
-        states = [np.zeros(self.state_shape, dtype='uint8')] * (self._hist.maxlen - len(lst))
+        hist = self._hists[stream]
+        lst = list(hist)
+        states = [np.zeros(self.state_shape, dtype='uint8')] * (hist.maxlen - len(lst))
         states.extend([k.state for k in lst])
         return states
 
@@ -76,7 +125,15 @@ class ReplayMemory(object):
         """
         idx = (self._curr_pos + idx) % self._curr_size
         k = self.history_len + 1
-        if idx + k <= self._curr_size:
+        if self.num_streams > 1:
+            # the next frames of the same stream are num_streams slots apart
+            index = (idx + np.arange(k) * self.num_streams) % self._curr_size
+            state = self.state[index]
+            reward = self.reward[index]
+            action = self.action[index]
+            isOver = self.isOver[index]
+            human = self.human[index]
+        elif idx + k <= self._curr_size:
             state = self.state[idx: idx + k]
             reward = self.reward[idx: idx + k]
             action = self.action[idx: idx + k]
@@ -92,6 +149,63 @@ class ReplayMemory(object):
         ret = self._pad_sample(state, reward, action, isOver, human)
         return ret
 
+    def sample_batch(self, idx, out=None):
+        """ Sample the experiences of an array of indexes (see sample) at once
+        :returns: a list [state, action, reward, isOver, human] of batched
+                  arrays, as ExpReplay._process_batch, followed by the
+                  discount of the next state value when n_step > 1. The states
+                  are written into out if given, of shape
+                  (B,) + STATE_SIZE + (history_length+n_step,): the first
+                  history_length frames are the state and the last ones the
+                  n-th next state.
+        """
+        idx = np.asarray(idx)
+        k = self.history_len + self.n_step
+        # (B, k) slots of the frames, the next frames of a stream are num_streams slots apart
+        index = (self._curr_pos + idx[:, None] + np.arange(k) * self.num_streams) % self._curr_size
+        isOver = self.isOver[index]
+        # the frames up to the last terminal of the history belong to a previous episode
+        last = np.full(len(idx), -1)
+        if self.history_len > 1:
+            last = np.where(isOver[:, :self.history_len - 1],
+                            np.arange(self.history_len - 1), -1).max(axis=1)
+        keep = np.arange(k) > last[:, None]
+        # frames between the state and the n-th next state are not used
+        keep[:, self.history_len:self.n_step] = False
+        if out is None:
+            out = np.empty((len(idx),) + self.state_shape + (k,), dtype='uint8')
+        # one copy per frame straight into its channel, faster than gathering
+        # all frames at once and transposing them
+        for b in range(len(idx)):
+            for j in range(k):
+                if keep[b, j]:
+                    self._frame(index[b, j], out=out[b, ..., j])
+                else:
+                    out[b, ..., j] = 0
+        current = index[:, self.history_len - 1]
+        batch = [out, self.action[current].astype('int8'), self.reward[current],
+                 isOver[:, self.history_len - 1], self.human[current]]
+        if self.n_step > 1:
+            batch[2], batch[3], discount = self._n_step_return(index[:, self.history_len - 1:-1],
+                                                               isOver[:, self.history_len - 1:-1])
+            batch.append(discount)
+        return batch
+
+    def _n_step_return(self, index, isOver):
+        """ discounted sum of the clipped rewards of the (B, n_step) slots in
+        index up to the end of their episode, whether it ended and the
+        discount of the value of the n-th next state
+        """
+        reward = np.clip(self.reward[index], -1, 1)
+        # a step counts if no earlier step of the n ended the episode
+        alive = np.ones(isOver.shape, dtype='bool')
+        alive[:, 1:] = ~np.logical_or.accumulate(isOver[:, :-1], axis=1)
+        discounts = self.gamma ** np.arange(self.n_step)
+        total = (reward * alive * discounts).sum(axis=1).astype('float32')
+        isOver = isOver.any(axis=1)
+        discount = np.where(isOver, 0, self.gamma ** self.n_step).astype('float32')
+        return total, isOver, discount
+
     # the next_state is a different episode if current_state.isOver==True
     def _pad_sample(self, state, reward, action, isOver, human):
         for k in range(self.history_len - 2, -1, -1):
@@ -114,6 +228,137 @@ class ReplayMemory(object):
     def __len__(self):
         return self._curr_size
 
+    @property
+    def window(self):
+        """ number of slots spanned by the frames of one sample """
+        return (self.history_len + self.n_step) * self.num_streams
+
+    def save(self, directory, global_step=None, extra=None):
+        """ Save the memory into directory.
+
+        The frames are kept in directory/state.npy, in which only the chunks
+        of slots changed since the last save are written, then the
+        transitions and positions are replaced at once in transitions.npz and
+        meta.json. The memory may be appended while the chunks are written:
+        the frames of the slots appended meanwhile are then written again,
+        and the transitions and positions taken, with the appends blocked,
+        so the saved memory is the one at the end of the save.
+
+        :param global_step: step of the checkpoint saved with the memory,
+            checked by restore
+        :param extra: function returning a dict of more arrays to save in
+            transitions.npz, called with the appends blocked
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        path = os.path.join(directory, 'state.npy')
+        with self._lock:
+            num_appended = self._num_appended
+            if self._saved_frames != path or not os.path.exists(path):
+                self._dirty[:] = True
+            chunks = np.flatnonzero(self._dirty)
+            self._dirty[chunks] = False
+        if self._saved_frames != path or not os.path.exists(path):
+            frames = np.lib.format.open_memmap(path, mode='w+', dtype='uint8',
+                                               shape=self.state.shape)
+        else:
+            frames = np.load(path, mmap_mode='r+')
+        for c in chunks:
+            chunk = slice(c * self.SAVE_CHUNK, (c + 1) * self.SAVE_CHUNK)
+            frames[chunk] = self.state[chunk]
+
+        with self._lock:
+            # slots overwritten while the chunks were written
+            appended = min(self._num_appended - num_appended, self.max_size)
+            slots = np.sort((self._curr_pos - 1 - np.arange(appended)) % self.max_size)
+            for start in range(0, len(slots), self.SAVE_CHUNK):
+                index = slots[start:start + self.SAVE_CHUNK]
+                frames[index] = self.state[index]
+            meta = self._save_meta()
+            meta.update(curr_size=self._curr_size, curr_pos=self._curr_pos,
+                        hist_lens=[len(h) for h in self._hists], global_step=global_step)
+            transitions = dict(action=self.action.copy(), reward=self.reward.copy(),
+                               isOver=self.isOver.copy(), human=self.human.copy())
+            if extra is not None:
+                transitions.update(extra())
+        frames.flush()
+        del frames
+        self._saved_frames = path
+
+        tmp = os.path.join(directory, 'transitions.tmp.npz')
+        np.savez(tmp, **transitions)
+        os.replace(tmp, os.path.join(directory, 'transitions.npz'))
+        tmp = os.path.join(directory, 'meta.json.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp, os.path.join(directory, 'meta.json'))
+        logger.info("Saved {} replay transitions ({} chunks and {} appended frames) to {}".format(
+            meta['curr_size'], len(chunks), appended, directory))
+
+    def restore(self, directory, mmap=False, global_step=None):
+        """ Restore the memory saved into directory by save.
+
+        With mmap the frames are mapped copy-on-write from the saved file, and
+        only read from disk when sampled, instead of being loaded at once.
+        :param global_step: step of the loaded checkpoint, the memory must
+            have been saved with it
+        :returns: False if directory holds no saved memory of this shape (and step)
+        """
+        path = os.path.join(directory, 'meta.json')
+        if not os.path.exists(path):
+            return False
+        with open(path) as f:
+            meta = json.load(f)
+        expected = self._save_meta()
+        if any(meta.get(k) != expected[k] for k in self._SAVE_FIELDS):
+            logger.warn("Replay memory in {} does not match this memory, not restored".format(directory))
+            return False
+        if global_step is not None and meta.get('global_step') != global_step:
+            logger.warn("Replay memory in {} was saved at step {}, not at the step {} of the "
+                        "loaded checkpoint, not restored".format(directory, meta.get('global_step'),
+                                                                 global_step))
+            return False
+
+        path = os.path.join(directory, 'state.npy')
+        if mmap:
+            self.state = np.load(path, mmap_mode='c')
+        else:
+            self.state[...] = np.load(path, mmap_mode='r')
+        with np.load(os.path.join(directory, 'transitions.npz')) as transitions:
+            for k in ('action', 'reward', 'isOver', 'human'):
+                getattr(self, k)[...] = transitions[k]
+        self._curr_size = meta['curr_size']
+        self._curr_pos = meta['curr_pos']
+        for stream, length in enumerate(meta['hist_lens']):
+            self._restore_hist(stream, length)
+        self._dirty[:] = False
+        self._saved_frames = path
+        logger.info("Restored {} replay transitions from {}".format(self._curr_size, directory))
+        return True
+
+    def _save_meta(self):
+        return dict(max_size=self.max_size, state_shape=list(self.state_shape),
+                    history_len=self.history_len, num_streams=self.num_streams,
+                    n_step=self.n_step)
+
+    def _restore_hist(self, stream, length):
+        """ rebuild the history of stream from its last length slots """
+        hist = self._hists[stream]
+        hist.clear()
+        # last slot appended by the stream, its previous frames are num_streams slots apart
+        last = self._curr_pos - 1 - (self._curr_pos - 1 - stream) % self.num_streams
+        for j in range(length - 1, -1, -1):
+            pos = (last - j * self.num_streams) % self.max_size
+            hist.append(Experience(self._frame(pos), self.action[pos], self.reward[pos],
+                                   self.isOver[pos], self.human[pos]))
+
+    def _frame(self, pos, out=None):
+        """ frame stored in slot pos, copied into out if given """
+        if out is None:
+            return self.state[pos]
+        out[...] = self.state[pos]
+        return out
+
     def _assign(self, pos, exp):
         self.state[pos] = exp.state
         self.reward[pos] = exp.reward
@@ -121,80 +366,243 @@ class ReplayMemory(object):
         self.isOver[pos] = exp.isOver
         self.human[pos] = exp.human
 
+
+class CompactReplayMemory(ReplayMemory):
+    """ Replay memory of FrameRefs, cropped again from their volume when sampled.
+
+    Every transition stores the id of its volume, the location and the scale
+    of the agent instead of a frame (about 20 bytes instead of 91 KB for
+    45^3 screens). The memory keeps a reference to the image of every volume
+    used by a stored transition, and drops it once the last of them is
+    overwritten. Experiences are appended with a FrameRef as state (see
+    MedicalPlayer.frame_ref); sampling crops history_len + 1 screens,
+    through the pyramid of the volumes when the data reader built one.
+    """
+    def _init_storage(self):
+        self.volume = np.full((self.max_size,), -1, dtype='int32')
+        self.location = np.zeros((self.max_size, 3), dtype='int16')
+        self.scale = np.zeros((self.max_size,), dtype='int8')
+        # volume id -> image, name -> volume id and volume id -> number of slots
+        self._images = {}
+        self._volume_ids = {}
+        self._refcounts = {}
+        self._next_id = 0
+
+    def _volume_id(self, image):
+        """ id of the volume of image, registering it if needed """
+        vid = self._volume_ids.get(image.name)
+        if vid is None:
+            vid = self._next_id
+            self._next_id += 1
+            self._volume_ids[image.name] = vid
+            self._images[vid] = image
+            self._refcounts[vid] = 0
+        return vid
+
+    def _release(self, vid):
+        self._refcounts[vid] -= 1
+        if not self._refcounts[vid]:
+            image = self._images.pop(vid)
+            del self._volume_ids[image.name]
+            del self._refcounts[vid]
+
+    @property
+    def num_volumes(self):
+        """ number of volumes referenced by the stored transitions """
+        return len(self._images)
+
+    def _frame(self, pos, out=None):
+        ref = FrameRef(self._images[self.volume[pos]], self.location[pos], self.scale[pos])
+        if out is None:
+            out = np.empty(self.state_shape, dtype='uint8')
+        crop_ref(ref, self.state_shape, out=out)
+        return out
+
+    def sample(self, idx):
+        """ Sample an experience replay from memory with index idx, see
+        ReplayMemory.sample
+        """
+        idx = (self._curr_pos + idx) % self._curr_size
+        k = self.history_len + 1
+        # the next frames of the same stream are num_streams slots apart
+        index = (idx + np.arange(k) * self.num_streams) % self._curr_size
+        state = np.stack([self._frame(i) for i in index])
+        return self._pad_sample(state, self.reward[index], self.action[index],
+                                self.isOver[index], self.human[index])
+
+    def _assign(self, pos, exp):
+        ref = exp.state
+        vid = self._volume_id(ref.image)
+        self._refcounts[vid] += 1
+        if self.volume[pos] >= 0:
+            self._release(self.volume[pos])
+        self.volume[pos] = vid
+        self.location[pos] = ref.location
+        self.scale[pos] = ref.scale
+        self.reward[pos] = exp.reward
+        self.action[pos] = exp.action
+        self.isOver[pos] = exp.isOver
+        self.human[pos] = exp.human
+
 ###############################################################################
 # HITL UPDATE
 
 class HumanDemReplayMemory(ReplayMemory):
-    def __init__(self, max_size, state_shape, history_len, arg_type=None):
-        super(HumanDemReplayMemory, self).__init__(max_size, state_shape, history_len)
+    def __init__(self, max_size, state_shape, history_len, arg_type=None, n_step=1, gamma=None):
+        super(HumanDemReplayMemory, self).__init__(max_size, state_shape, history_len,
+                                                   n_step=n_step, gamma=gamma)
         self.arg_type = arg_type
 
-    def load_experience(self):
+    def load_experience(self, workers=0):
         """
         Fills in the buffer with the saved actions from the expert.
-        Actions are stored under .data/HITL in the form of log files
+        Actions are stored under .data/HITL in the form of log files,
+        rendered by workers processes (see render_logs)
         """
-        ## Path for GPU cluster ##
-        directory = "Documents/rl-medical/examples/LandmarkDetection/DQN/data/HITL"
-        # Directory needs for pulling images
-        if self.arg_type == 'Fetal_us':
-            image_directory = "/vol/project/2019/545/g1954503/aeg19/Fetal_US/"
-            train_paths = "/vol/biomedic/users/aa16914/shared/data/RL_data/fetalUS_train_files_new_paths.txt"
-            type_name = "FetalUS"
-        elif self.arg_type == 'Brain_MRI':
-            image_directory = "/vol/project/2019/545/g1954503/aeg19/Brain_MRI/"
-            train_paths = "/vol/biomedic/users/aa16914/shared/data/RL_data/brain_train_files_new_paths.txt"
-            type_name = "BrainMRI"
-        else:
-            image_directory = "/vol/project/2019/545/g1954503/aeg19/Cardiac_MRI/"
-            train_paths = "/vol/biomedic/users/aa16914/shared/data/RL_data/cardiac_train_files_new_paths.txt"
-            type_name = "CardiacMRI"
-
-
+        directory, image_directory, train_paths, type_name = hitl_paths(self.arg_type)
         # check that the path exists to the human data
         assert os.path.exists(directory), ('For privacy reasons you need to be connected'
                                             ' to a DOC computer to access the images.'
                                             ' If however you have the files in a'
                                             ' seperate folder please update the paths in'
-                                            ' expreplay.py in the HumanDemReplayMemory class')
+                                            ' hitl.py')
         ## Exclude testing images ##
-        allowed_images = []
-        with open(train_paths) as f:
-            for line in f.readlines():
-                allowed_images.append((line.split("/")[-1]).split('.')[0])
-        total_images = 0
-        used_images = 0
-        ## Loop 1: Loops through all log files in the directory
-        for filename in os.listdir(directory):
-            if (filename.endswith(".pickle") or filename.endswith(".p")) and type_name in filename:
-                log_file = os.path.join(directory, filename)
-                logger.info("Log filename: {}".format(log_file))
-                file_contents = pickle.load( open( log_file, "rb" ) )
-                # Loop 2: Loops through all 3D images in the log file
-                for entry in file_contents:
-                    total_images += 1
-                    if (entry['img_name']) in allowed_images:
-                        image_path = os.path.join(image_directory, entry['img_name']+".nii.gz")
-                        # target_coordinates = entry['target']
-                        logger.info("Image path: {}".format(image_path))
-                        used_images += 1
-                        dummy_env = MedicalPlayer(directory=image_directory, screen_dims=(45, 45, 45),
-                                                            viz=0, saveGif='False', saveVideo='False',
-                                                            task='play', files_list=[image_path], data_type='HITL',
-                                                            max_num_frames=1500)
-                        # Loop 3: Loops through each state, action pair recorded
-                        for key, state_coordinates in enumerate(entry['states']):
-                            if key != len(entry['states'])-1:
-                                # logger.info("{} state: {}".format(key, state_coordinates))
-                                # logger.info("{} reward: {}".format(key+1, entry['rewards'][key+1]))
-                                # logger.info("{} action: {}".format(key+1, entry['actions'][key+1]))
-                                # logger.info("{} is_over: {}".format(key+1, entry['is_over'][key+1]))
-                                # logger.info("{} resolution: {}".format(key, entry['resolution'][key]))
-                                dummy_env.HITL_set_location(state_coordinates, entry['resolution'][key])
-                                state_image = dummy_env._current_state()
-                                self.append(Experience(state_image, entry['actions'][key+1], entry['rewards'][key+1], entry['is_over'][key+1], True))
-        logger.info("total images: {}".format(total_images))
-        logger.info("used images: {}".format(used_images))
+        compact = isinstance(self, CompactReplayMemory)
+        num_entries = num_used = 0
+        for log in render_logs(hitl_log_files(directory, type_name), image_directory,
+                               allowed_images(train_paths), screen_dims=self.state_shape,
+                               workers=0 if compact else workers, compact=compact):
+            for i in range(len(log.action)):
+                self.append(Experience(log.frames[i], log.action[i], log.reward[i],
+                                       log.isOver[i], True))
+            num_entries += log.num_entries
+            num_used += log.num_used
+        logger.info("total images: {}".format(num_entries))
+        logger.info("used images: {}".format(num_used))
+
+    def load_buffer(self, directory):
+        """ Fills in the buffer with the transitions of a DemonstrationBuffer
+        built by utils/build_hitl_buffer.py, instead of rendering the logs.
+        """
+        buffer = DemonstrationBuffer(directory)
+        assert len(buffer.logs), 'no demonstration buffer in {}'.format(directory)
+        assert tuple(buffer.state_shape) == tuple(self.state_shape), \
+            'demonstration buffer {} has screens {}, expected {}'.format(
+                directory, tuple(buffer.state_shape), self.state_shape)
+        for frames, action, reward, isOver in buffer.transitions():
+            for i in range(len(frames)):
+                self.append(Experience(frames[i], action[i], reward[i], isOver[i], True))
+        logger.info("Loaded {} human transitions from {}".format(len(buffer), directory))
+
+
+class CompactHumanDemReplayMemory(CompactReplayMemory, HumanDemReplayMemory):
+    """ HumanDemReplayMemory storing FrameRefs, see CompactReplayMemory """
+
+
+class PrioritizedReplay(object):
+    """ Proportional prioritization of the slots of a ReplayMemory
+    (Schaul et al., Prioritized Experience Replay, 2016).
+
+    Slot i is sampled with probability p_i^alpha / sum_k p_k^alpha, where p_i
+    is the last absolute TD error of its transition (plus epsilon). New
+    transitions get the largest priority seen so far. The priorities are kept
+    in a SumTree, so sampling a batch and updating priorities are
+    O(batch log n). The importance sampling weights (N P(i))^-beta, divided
+    by their largest value in the batch, correct the bias of the updates.
+
+    The memory is appended, sampled and updated from different threads,
+    so every operation holds a lock.
+
+    The TD errors of a batch come back after the input queue buffered it, when
+    the simulator may have overwritten some of its slots with new transitions.
+    Every slot counts its writes, and the samples are identified by keys
+    generation * max_size + slot, so the updates of overwritten slots are
+    dropped instead of giving the new transitions stale priorities.
+    """
+    def __init__(self, max_size, alpha=0.6, epsilon=1e-6):
+        self.alpha = alpha
+        self.epsilon = epsilon
+        self.max_priority = 1.0
+        self.max_size = max_size
+        self.tree = SumTree(max_size)
+        # number of transitions written to every slot
+        self.generation = np.zeros(max_size, dtype='int64')
+        self._lock = threading.Lock()
+
+    def add(self, pos):
+        """ give the new transition of slot pos the largest priority """
+        with self._lock:
+            self.generation[pos] += 1
+            self.tree.update_one(pos, self.max_priority ** self.alpha)
+
+    def snapshot(self):
+        """ the priorities of all slots and the largest priority, as arrays
+        saved with the memory (see ReplayMemory.save) """
+        with self._lock:
+            return dict(priority=self.tree.get(np.arange(self.max_size)),
+                        max_priority=np.array(self.max_priority))
+
+    def restore(self, arrays, size):
+        """ restore the priorities of a snapshot, or give the size restored
+        transitions the largest priority if it holds none """
+        with self._lock:
+            if 'priority' in arrays and len(arrays['priority']) == self.max_size:
+                self.max_priority = float(arrays['max_priority'])
+                self.tree.update(np.arange(self.max_size), arrays['priority'])
+                return True
+            self.tree.update(np.arange(size), np.full(size, self.max_priority ** self.alpha))
+            return False
+
+    def update(self, keys, td_errors):
+        """ set the priorities of the sampled transitions from their TD
+        errors, ignoring the negative keys (samples of other memories) and the
+        slots written since they were sampled
+        """
+        keys = np.asarray(keys)
+        valid = keys >= 0
+        if not valid.any():
+            return
+        slots, generation = keys[valid] % self.max_size, keys[valid] // self.max_size
+        priority = np.abs(np.asarray(td_errors, dtype='float64')[valid]) + self.epsilon
+        with self._lock:
+            current = self.generation[slots] == generation
+            if not current.any():
+                return
+            self.max_priority = max(self.max_priority, priority[current].max())
+            self.tree.update(slots[current], priority[current] ** self.alpha)
+
+    def sample(self, rng, memory, batch_size, low, high, beta):
+        """ Sample batch_size transitions of memory by priority, among the
+        indexes [low, high) of ReplayMemory.sample.
+        :returns: (indexes for ReplayMemory.sample_batch, keys of the samples
+                   for update, importance sampling weights)
+        """
+        size = len(memory)
+        with self._lock:
+            total = self.tree.total
+            # one value in each of batch_size equal segments of the priorities
+            values = (np.arange(batch_size) + rng.rand(batch_size)) * (total / batch_size)
+            slots = self.tree.find(values)
+            for attempt in range(11):
+                idx = (slots - memory._curr_pos) % size
+                # transitions too recent (their next frames are not in the memory
+                # yet) or about to be overwritten are sampled again
+                invalid = (idx < low) | (idx >= high) | (self.tree.get(slots) <= 0)
+                if not invalid.any():
+                    break
+                if attempt == 10:
+                    # give up on the priorities of the few left
+                    idx[invalid] = rng.randint(low, high, size=invalid.sum())
+                    slots = (idx + memory._curr_pos) % size
+                    break
+                slots[invalid] = self.tree.find(rng.rand(invalid.sum()) * total)
+            priority = self.tree.get(slots)
+            keys = self.generation[slots] * self.max_size + slots
+        # the weights (N P(i))^-beta normalised by their largest value in the batch
+        positive = priority[priority > 0]
+        smallest = positive.min() if len(positive) else 1.0
+        weights = (np.maximum(priority, smallest) / smallest) ** -beta
+        return idx, keys, weights.astype('float32')
 
 
 ###############################################################################
@@ -221,16 +629,61 @@ class ExpReplay(DataFlow, Callback):
                  memory_size, init_memory_size,
                  init_exploration,
                  update_frequency, history_len,
-                 arg_type=None):
+                 arg_type=None, compact=False,
+                 prioritized=False, priority_alpha=0.6, priority_beta=0.4,
+                 n_step=1, gamma=None, save_dir=None, restore_dir=None,
+                 mmap_restore=False, hitl_buffer=None, hitl_workers=0,
+                 inference_server=None, replay_ratio=None, sync_every=400):
         """
         Args:
             predictor_io_names (tuple of list of str): input/output names to
                 predict Q value from state.
-            player (RLEnvironment): the player.
+            player (RLEnvironment): the player, or a BatchedMedicalEnv whose
+                episodes are stepped together with one prediction per step,
+                or an ActorPool whose actors play asynchronously (see
+                replay_ratio).
             update_frequency (int): number of new transitions to add to memory
                 after sampling a batch of transitions for training.
             history_len (int): length of history frames to concat. Zero-filled
                 initial frames.
+            compact (bool): store transitions as FrameRefs in a
+                CompactReplayMemory instead of frames. The player must provide
+                frame_ref (or frame_refs when batched).
+            n_step (int): sample n-step transitions with the discount factor
+                gamma (see ReplayMemory). The batches then hold the discount
+                of the next state value after the terminal flags.
+            prioritized (bool): sample the agent transitions by the TD errors of
+                their last update (see PrioritizedReplay), with priority_alpha
+                and the importance sampling exponent priority_beta. The
+                batches then hold the importance sampling weights and the
+                keys of the samples, and the model must output 'td_error'
+                and 'sample_index' (see Model3D).
+            save_dir (str): save the replay memories into save_dir at every
+                trigger of the callback, next to the ModelSaver checkpoints.
+                The saves run in a background thread and only write the frames
+                changed since the previous one (see ReplayMemory.save), with
+                the global step and the priorities of the prioritized replay.
+            restore_dir (str): restore the replay memories saved into
+                restore_dir before training (mapping the frames from disk with
+                mmap_restore), instead of filling them again. The agent
+                memory is only restored if it was saved at the global step of
+                the loaded checkpoint.
+            hitl_buffer (str): directory of a demonstration buffer prebuilt
+                from the HITL logs (see utils/build_hitl_buffer.py) loaded
+                into the human memory instead of rendering the logs.
+            hitl_workers (int): number of processes rendering the HITL logs
+                (0 renders them in the training process).
+            inference_server (InferenceServer): predict the Q-values through
+                the server shared with the evaluator instead of a predictor.
+                The server must run before this callback (see InferenceServer).
+            replay_ratio (float): with an ActorPool, number of sampled
+                transitions per transition of the actors. The learner waits
+                for the actors when it samples more, and the actors for the
+                learner when it samples less (default: batch_size /
+                update_frequency, the ratio of the lock-step simulator). The
+                actors explore with their own epsilons, not exploration.
+            sync_every (int): with an ActorPool, number of training steps
+                between the weights sent to the actors.
         """
         init_memory_size = int(init_memory_size)
 
@@ -240,6 +693,10 @@ class ExpReplay(DataFlow, Callback):
         self.exploration = init_exploration
         self.num_actions = player.action_space.n
         logger.info("Number of Legal actions: {}".format(self.num_actions))
+        # number of transitions added by every step of the player, or by
+        # every round of the actors (a transition of each)
+        self.num_actors = getattr(player, 'num_actors', 0)
+        self.num_envs = self.num_actors or getattr(player, 'num_envs', 1)
 
         self.rng = get_rng(self)
         self._init_memory_flag = threading.Event()  # tell if memory has been initialized
@@ -248,18 +705,50 @@ class ExpReplay(DataFlow, Callback):
         self._populate_job_queue = queue.Queue(maxsize=5)
 
 
-        self.mem = ReplayMemory(memory_size, state_shape, history_len)
+        if compact and (save_dir or restore_dir):
+            logger.warn("The compact replay memory references volumes and is not saved")
+            self.save_dir = self.restore_dir = None
+        if compact and hitl_buffer:
+            logger.warn("The compact replay memory renders the HITL logs, ignoring the demonstration buffer")
+            self.hitl_buffer = None
+        assert not (compact and self.num_actors), 'the actors send frames, not FrameRefs'
+        if compact:
+            assert hasattr(player, 'frame_refs' if self.num_envs > 1 else 'frame_ref'), \
+                'the compact replay memory needs the FrameRefs of the player observations'
+            memory_cls, human_memory_cls = CompactReplayMemory, CompactHumanDemReplayMemory
+        else:
+            memory_cls, human_memory_cls = ReplayMemory, HumanDemReplayMemory
+        self.mem = memory_cls(memory_size, state_shape, history_len, num_streams=self.num_envs,
+                              n_step=n_step, gamma=gamma)
+        self.priorities = None
+        if prioritized:
+            self.priorities = PrioritizedReplay(self.mem.max_size, alpha=priority_alpha)
         ###############################################################################
         # HITL UPDATE
         self.hmem_full = False
         if self.update_frequency < 4:
-            self.hmem = HumanDemReplayMemory(memory_size, state_shape, history_len, arg_type=arg_type)
-            self.hmem.load_experience()
+            self.hmem = human_memory_cls(memory_size, state_shape, history_len, arg_type=arg_type,
+                                         n_step=n_step, gamma=gamma)
+            if not self._restore(self.hmem, 'human'):
+                if self.hitl_buffer:
+                    self.hmem.load_buffer(self.hitl_buffer)
+                else:
+                    self.hmem.load_experience(workers=hitl_workers)
             self.hmem_full = True
             logger.info("HITL buffer full")
 
         ###############################################################################
-        self._current_ob = self.player.reset()
+        self._batch_state_buffer = None
+        self._save_th = None
+        # transitions inserted by the actors and sampled since the memory was filled
+        self._replay_cond = threading.Condition()
+        self._num_inserted = 0
+        self._num_sampled = 0
+        self._steps_since_sync = 0
+        self._stop_actors = threading.Event()
+        if not self.num_actors:
+            self._current_ob = self.player.reset()
+            self._current_ref = self._observation_ref()
         self._player_scores = StatCounter()
         self._player_distError = StatCounter()
 
@@ -273,22 +762,112 @@ class ExpReplay(DataFlow, Callback):
             ###############################################################################
             #logger.info("update_frequency: {}".format(self.update_frequency))
 
-            for _ in range(int(self.update_frequency)):
+            for _ in range(self._steps_per_job()):
                 self._populate_exp()
 
-        th = ShareSessionThread(LoopThread(populate_job_func, pausable=False))
+        self._simulator_loop = LoopThread(populate_job_func, pausable=False)
+        th = ShareSessionThread(self._simulator_loop)
         th.name = "SimulatorThread"
         return th
 
+    def _steps_per_job(self):
+        """ number of player steps adding update_frequency transitions """
+        return int(math.ceil(self.update_frequency / float(self.num_envs)))
+
     def _init_memory(self):
+        if self.num_actors:
+            return self._init_actor_memory()
         logger.info("Populating replay memory with epsilon={} ...".format(self.exploration))
 
         with get_tqdm(total=self.init_memory_size) as pbar:
             while len(self.mem) < self.init_memory_size:
                 self._populate_exp()
-                pbar.update()
+                pbar.update(self.num_envs)
+        self._init_memory_flag.set()
+
+    def _init_actor_memory(self):
+        logger.info("Populating replay memory with {} actors ...".format(self.num_actors))
+        with get_tqdm(total=self.init_memory_size) as pbar:
+            with self._replay_cond:
+                size = len(self.mem)
+                pbar.update(size)
+                while size < self.init_memory_size:
+                    self._replay_cond.wait(0.1)
+                    self._check_receiver()
+                    pbar.update(len(self.mem) - size)
+                    size = len(self.mem)
+                # the replay ratio counts from the filled memory
+                self._num_inserted = self._num_sampled = 0
         self._init_memory_flag.set()
 
+    def _round_size(self):
+        """ number of transitions of a chunk of every actor """
+        return self.player.chunk_size * self.num_actors
+
+    def _replay_ratio(self):
+        """ sampled transitions per inserted one, None while only the human
+        memory is sampled """
+        if not self.update_frequency:
+            return None
+        return self.replay_ratio or self.batch_size / float(self.update_frequency)
+
+    def _actors_ahead(self):
+        """ True once the actors inserted more than a round of transitions
+        the learner has not sampled by the replay ratio """
+        if not self._init_memory_flag.is_set():
+            return False
+        ratio = self._replay_ratio()
+        return ratio is None or ratio * (self._num_inserted - self._round_size()) > self._num_sampled
+
+    def _receive_actors(self):
+        """ append the chunks of the actors to the memory, one transition of
+        every actor at a time as the streams of a batched player """
+        round_size = self._round_size()
+        while not self._stop_actors.is_set():
+            with self._replay_cond:
+                if self._actors_ahead():
+                    self._replay_cond.wait(0.1)
+                    continue
+            chunks = self.player.receive()
+            for _, _, _, _, episodes in chunks:
+                for score, distError in episodes:
+                    self._player_scores.feed(score)
+                    self._player_distError.feed(distError)
+            # As generated by AI human = False
+            for j in range(self.player.chunk_size):
+                for frames, action, reward, isOver, _ in chunks:
+                    self._append(Experience(frames[j], action[j], reward[j], isOver[j], False))
+            with self._replay_cond:
+                self._num_inserted += round_size
+                self._replay_cond.notify_all()
+
+    def _after_batch(self, size):
+        """ let the simulator play update_frequency steps, or wait until the
+        actors inserted enough transitions for the replay ratio """
+        if not self.num_actors:
+            self._populate_job_queue.put(1)
+            return
+        with self._replay_cond:
+            self._num_sampled += size
+            self._replay_cond.notify_all()
+            while not self._stop_actors.is_set():
+                ratio = self._replay_ratio()
+                if ratio is None or self._num_sampled <= ratio * self._num_inserted:
+                    break
+                self._replay_cond.wait(0.1)
+                self._check_receiver()
+
+    def _check_receiver(self):
+        if not self._receiver_th.is_alive() and not self._stop_actors.is_set():
+            raise RuntimeError("The actors stopped, see the error of the ActorReceiverThread")
+
+    def _sync_weights(self):
+        """ send the weights of the network to the actors, unless they did
+        not get the last ones yet """
+        if not self.player.sending:
+            names = self.player.variable_names
+            self.player.send_weights(dict(zip(names, self.trainer.sess.run(names))))
+
     # quickly fill the memory for debug
     def _fake_init_memory(self):
         from copy import deepcopy
@@ -297,15 +876,26 @@ class ExpReplay(DataFlow, Callback):
                 self._populate_exp()
                 pbar.update()
             while len(self.mem) < self.init_memory_size:
-                self.mem.append(deepcopy(self.mem._hist[0]))
+                self.mem.append(deepcopy(self.mem._hists[0][0]))
                 pbar.update()
         self._init_memory_flag.set()
 
+    def _observation_ref(self):
+        """ FrameRef(s) of the current observation(s) of the player, stored
+        by the compact memory instead of the frames """
+        if not self.compact:
+            return None
+        if self.num_envs > 1:
+            return self.player.frame_refs()
+        return self.player.frame_ref()
+
     def _populate_exp(self):
         """ populate a transition by epsilon-greedy"""
-
+        if self.num_envs > 1:
+            return self._populate_batch_exp()
 
         old_s = self._current_ob
+        old_ref = self._current_ref
 
         # initialize q_values to zeros
         q_values = [0, ] * self.num_actions
@@ -328,6 +918,7 @@ class ExpReplay(DataFlow, Callback):
             act = np.argmax(q_values)
 
         self._current_ob, reward, isOver, info = self.player.step(act, q_values)
+        self._current_ref = self._observation_ref()
 
         if isOver:
             # if info['gameOver']:  # only record score when a whole game is over (not when an episode is over)
@@ -336,7 +927,45 @@ class ExpReplay(DataFlow, Callback):
             self._player_distError.feed(info['distError'])
             self.player.reset()
         # As generated by AI human = False
-        self.mem.append(Experience(old_s, act, reward, isOver, False))
+        self._append(Experience(old_s if old_ref is None else old_ref,
+                                act, reward, isOver, False))
+
+    def _populate_batch_exp(self):
+        """ populate one transition of every episode of a batched player by
+        epsilon-greedy, with a single prediction for all of them"""
+        old_s = self._current_ob
+        old_refs = self._current_ref
+        n = self.num_envs
+
+        q_values = np.zeros((n, self.num_actions), dtype='float32')
+        explore = self.rng.rand(n) <= self.exploration
+        if len(self.mem) <= self.mem.window:
+            explore[:] = True
+        act = self.rng.choice(range(self.num_actions), size=n)
+        if not explore.all():
+            # build the history states of all episodes
+            history = [self.mem.recent_state(i) + [old_s[i]] for i in range(n)]
+            history = np.stack([np.stack(h, axis=-1) for h in history])
+            q_values = self.predictor(history)[0]
+            act = np.where(explore, act, np.argmax(q_values, axis=1))
+            q_values[explore] = 0
+
+        # terminal episodes are reset by the player
+        self._current_ob, reward, isOver, info = self.player.step(act, q_values)
+        self._current_ref = self._observation_ref()
+
+        for i in np.flatnonzero(isOver):
+            self._player_scores.feed(info[i]['score'])
+            self._player_distError.feed(info[i]['distError'])
+        # As generated by AI human = False
+        for i in range(n):
+            self._append(Experience(old_s[i] if old_refs is None else old_refs[i],
+                                    act[i], reward[i], isOver[i], False))
+
+    def _append(self, exp):
+        pos = self.mem.append(exp)
+        if self.priorities is not None:
+            self.priorities.add(pos)
 
     def _debug_sample(self, sample):
         import cv2
@@ -367,46 +996,71 @@ class ExpReplay(DataFlow, Callback):
             if self.update_frequency == 0:
                 idx = self.rng.randint(
                     self._populate_job_queue.maxsize * 4,
-                    len(self.hmem)- self.history_len - 1,
+                    len(self.hmem) - self.hmem.window,
                     size=self.batch_size)
-                batch_exp = [self.hmem.sample(i) for i in idx]
-
-                yield self._process_batch(batch_exp)
+                yield self._prioritized_batch(self.hmem.sample_batch(idx, out=self._batch_state(len(idx))))
                 logger.info("Human batch ...")
-                self._populate_job_queue.put(1)
+                self._after_batch(len(idx))
             # After pretraining sampling from both HITL and agent buffer
             elif self.hmem_full == True:
-                ex_idx = self.rng.randint(
-                    self._populate_job_queue.maxsize * self.update_frequency,
-                    len(self.mem) - self.history_len - 1,
-                    size=38)    #38
+                ex_idx, slots, weights = self._sample_agent(38)    #38
                 hu_idx = self.rng.randint(
                     self._populate_job_queue.maxsize * 4,
-                    len(self.hmem)- self.history_len - 1,
+                    len(self.hmem) - self.hmem.window,
                     size=10)    #10
 
 
-                batch_exp = [self.mem.sample(i) for i in ex_idx]
-                for j in hu_idx:
-                    batch_exp.append(self.hmem.sample(j))
-
-                yield self._process_batch(batch_exp)
+                state = self._batch_state(len(ex_idx) + len(hu_idx))
+                batch = self.mem.sample_batch(ex_idx, out=state[:len(ex_idx)])
+                human_batch = self.hmem.sample_batch(hu_idx, out=state[len(ex_idx):])
+                batch = [state] + [np.concatenate((a, h)) for a, h in zip(batch[1:], human_batch[1:])]
+                if slots is not None:
+                    slots = np.concatenate((slots, np.full(len(hu_idx), -1, dtype='int64')))
+                    weights = np.concatenate((weights, np.ones(len(hu_idx), dtype='float32')))
+                yield self._prioritized_batch(batch, slots, weights)
                 logger.info("Mixed batch 0.8agent 0.2human ...")
-                self._populate_job_queue.put(1)
+                self._after_batch(len(state))
             # HITL not implemented therefore only sample from agent buffer
             else:
-                idx = self.rng.randint(
-                    self._populate_job_queue.maxsize * self.update_frequency,
-                    len(self.mem) - self.history_len - 1,
-                    size=self.batch_size)
-                batch_exp = [self.mem.sample(i) for i in idx]
-
-                yield self._process_batch(batch_exp)
-                self._populate_job_queue.put(1)
-
-
-
-
+                idx, slots, weights = self._sample_agent(self.batch_size)
+                batch = self.mem.sample_batch(idx, out=self._batch_state(len(idx)))
+                yield self._prioritized_batch(batch, slots, weights)
+                self._after_batch(len(idx))
+
+    def _sample_agent(self, size):
+        """ indexes of size transitions of the agent memory, with their
+        keys (see PrioritizedReplay) and importance sampling weights when
+        prioritized
+        """
+        if self.num_actors:
+            # the receiver thread may be appending two rounds
+            low = 2 * self._round_size()
+        else:
+            low = self._populate_job_queue.maxsize * self._steps_per_job() * self.num_envs
+        high = len(self.mem) - self.mem.window
+        if self.priorities is None:
+            return self.rng.randint(low, high, size=size), None, None
+        return self.priorities.sample(self.rng, self.mem, size, low, high, self.priority_beta)
+
+    def _prioritized_batch(self, batch, slots=None, weights=None):
+        """ add the importance sampling weights and the keys of the samples
+        to a batch when prioritized (ones and -1 for human samples)
+        """
+        if self.priorities is None:
+            return batch
+        if slots is None:
+            slots = np.full(len(batch[0]), -1, dtype='int64')
+            weights = np.ones(len(batch[0]), dtype='float32')
+        return batch + [weights, slots]
+
+    def _batch_state(self, batch_size):
+        """ state array of the batches, allocated once. QueueInput copies every
+        batch into its queue before asking for the next one, so it is reused.
+        """
+        shape = (batch_size,) + tuple(self.state_shape) + (self.history_len + self.n_step,)
+        if self._batch_state_buffer is None or self._batch_state_buffer.shape != shape:
+            self._batch_state_buffer = np.empty(shape, dtype='uint8')
+        return self._batch_state_buffer
 
     def _process_batch(self, batch_exp):
         state = np.asarray([e[0] for e in batch_exp], dtype='uint8')
@@ -417,13 +1071,64 @@ class ExpReplay(DataFlow, Callback):
         return [state, action, reward, isOver, human]
 
     def _setup_graph(self):
-        self.predictor = self.trainer.get_predictor(*self.predictor_io_names)
+        if self.inference_server is not None:
+            self.predictor = self.inference_server
+        else:
+            self.predictor = self.trainer.get_predictor(*self.predictor_io_names)
+
+    def _before_run(self, _):
+        # fetch the TD errors of the trained batch to update its priorities
+        if self.priorities is not None:
+            return ['td_error:0', 'sample_index:0']
+        return None
+
+    def _after_run(self, _, run_values):
+        if self.priorities is not None:
+            td_error, slots = run_values.results
+            self.priorities.update(slots, td_error)
+
+    def _restore(self, memory, name, global_step=None):
+        """ restore memory from restore_dir/name, True if it was saved there
+        (at global_step if given) """
+        if not self.restore_dir:
+            return False
+        return memory.restore(os.path.join(self.restore_dir, name), mmap=self.mmap_restore,
+                              global_step=global_step)
+
+    def _save_memories(self, global_step):
+        """ save the memories into save_dir, the agent one (with its
+        priorities) as save_dir/agent and the human one as save_dir/human
+        """
+        self.mem.save(os.path.join(self.save_dir, 'agent'), global_step,
+                      extra=None if self.priorities is None else self.priorities.snapshot)
+        if self.hmem_full:
+            self.hmem.save(os.path.join(self.save_dir, 'human'), global_step)
 
     def _before_train(self):
+        # the agent memory must have been saved with the loaded checkpoint
+        if self._restore(self.mem, 'agent', self.global_step) and self.priorities is not None:
+            with np.load(os.path.join(self.restore_dir, 'agent', 'transitions.npz')) as arrays:
+                if not self.priorities.restore(arrays, len(self.mem)):
+                    logger.warn("No priorities saved with the replay memory, "
+                                "the restored transitions get the largest priority")
+        if self.num_actors:
+            self._sync_weights()
+            self._receiver_th = threading.Thread(target=self._receive_actors, name='ActorReceiverThread')
+            self._receiver_th.daemon = True
+            self._receiver_th.start()
+            self._init_memory()
+            return
         self._init_memory()
         self._simulator_th = self.get_simulator_thread()
         self._simulator_th.start()
 
+    def _trigger_step(self):
+        if self.num_actors:
+            self._steps_since_sync += 1
+            if self._steps_since_sync >= self.sync_every:
+                self._sync_weights()
+                self._steps_since_sync = 0
+
     def _trigger(self):
         # log player statistics in training
         v = self._player_scores
@@ -457,6 +1162,34 @@ class ExpReplay(DataFlow, Callback):
             self.trainer.monitors.put_scalar('n_success_ratio', 0)
         # reset stats
         self.player.reset_stat()
+        if self.num_actors and self._num_inserted:
+            self.trainer.monitors.put_scalar('expreplay/replay_ratio',
+                                             self._num_sampled / float(self._num_inserted))
+
+        # save the memories next to the checkpoints, unless the last save is still running
+        if self.save_dir and (self._save_th is None or not self._save_th.is_alive()):
+            self._save_th = threading.Thread(target=self._save_memories, args=(self.global_step,),
+                                             name='ReplaySaveThread')
+            self._save_th.daemon = True
+            self._save_th.start()
+
+    def _after_train(self):
+        if self.num_actors:
+            self._stop_actors.set()
+        elif getattr(self, '_simulator_th', None) is not None:
+            # stop the simulator before the player it steps, waking it up if it waits for a job
+            self._simulator_loop.stop()
+            try:
+                self._populate_job_queue.put_nowait(1)
+            except queue.Full:
+                pass
+            self._simulator_th.join(10)
+        # stop the processes of an EnvPool or ActorPool
+        close = getattr(self.player, 'close', None)
+        if close is not None:
+            close()
+        if self._save_th is not None:
+            self._save_th.join()
 
 
 # if __name__ == 'main':
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: history.py
+
+__all__ = ['LocationHistory']
+
+
+class LocationHistory(object):
+    """ Ring buffer of the last locations (and q-values) of an agent.
+
+        The number of visits of every location in the buffer is kept up to
+        date on each push, together with the number of locations visited more
+        than threshold times, so checking for oscillations is O(1). The
+        buffer also keeps the max q-value of each entry for `best_location`.
+
+        Attributes:
+        length: number of locations kept (default: 20)
+        threshold: the agent oscillates when a location is visited more than
+            threshold times (default: 3)
+        best_of: number of last entries searched by `best_location` (default: 4)
+    """
+
+    def __init__(self, length=20, threshold=3, best_of=4):
+        assert 0 < best_of <= length, 'best_of {} must be in [1, {}]'.format(best_of, length)
+        self.length = length
+        self.threshold = threshold
+        self.best_of = best_of
+        self.clear()
+
+    def clear(self):
+        """ forget all locations """
+        self._locations = [None] * self.length
+        self._max_qvalues = [0] * self.length
+        self._pos = 0
+        self._counts = {}
+        self._num_over = 0
+
+    def push(self, location, qvalues=None):
+        """ add a location (x, y, z) and the q-values of the action taken
+        there, dropping the oldest entry
+        """
+        oldest = self._locations[self._pos]
+        if oldest is not None:
+            count = self._counts[oldest] - 1
+            if count == self.threshold:
+                self._num_over -= 1
+            if count:
+                self._counts[oldest] = count
+            else:
+                del self._counts[oldest]
+        count = self._counts.get(location, 0) + 1
+        self._counts[location] = count
+        if count == self.threshold + 1:
+            self._num_over += 1
+        self._locations[self._pos] = location
+        self._max_qvalues[self._pos] = 0 if qvalues is None else max(qvalues)
+        self._pos = (self._pos + 1) % self.length
+
+    @property
+    def oscillating(self):
+        """ True if a location was visited more than threshold times """
+        return self._num_over > 0
+
+    def count(self, location):
+        """ number of visits of location in the buffer """
+        return self._counts.get(location, 0)
+
+    def best_location(self):
+        """ location with the lowest max q-value among the last best_of
+        entries, the oldest one on ties
+        """
+        best = None
+        for k in range(self.best_of, 0, -1):
+            i = (self._pos - k) % self.length
+            if best is None or self._max_qvalues[i] < self._max_qvalues[best]:
+                best = i
+        location = self._locations[best]
+        # empty entries stand for the origin as in the former list history
+        return (0, 0, 0) if location is None else location
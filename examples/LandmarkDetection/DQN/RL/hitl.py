@@ -0,0 +1,328 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: hitl.py
+
+import os
+import json
+import pickle
+import shutil
+import tempfile
+import multiprocessing as mp
+from collections import OrderedDict, namedtuple
+import numpy as np
+
+from tensorpack.utils import logger
+from tensorpack.utils.utils import get_tqdm
+
+from RL.medical import MedicalPlayer
+
+__all__ = ['hitl_paths', 'hitl_log_files', 'allowed_images', 'load_hitl_log',
+           'num_transitions', 'render_entry', 'render_logs', 'DemonstrationBuffer']
+
+## Path for GPU cluster ##
+HITL_DIRECTORY = "Documents/rl-medical/examples/LandmarkDetection/DQN/data/HITL"
+# data type -> (image directory, train files list, dataset name in the log file names)
+_HITL_DATA = {
+    'FetalUS': ("/vol/project/2019/545/g1954503/aeg19/Fetal_US/",
+                "/vol/biomedic/users/aa16914/shared/data/RL_data/fetalUS_train_files_new_paths.txt",
+                "FetalUS"),
+    'BrainMRI': ("/vol/project/2019/545/g1954503/aeg19/Brain_MRI/",
+                 "/vol/biomedic/users/aa16914/shared/data/RL_data/brain_train_files_new_paths.txt",
+                 "BrainMRI"),
+    'CardiacMRI': ("/vol/project/2019/545/g1954503/aeg19/Cardiac_MRI/",
+                   "/vol/biomedic/users/aa16914/shared/data/RL_data/cardiac_train_files_new_paths.txt",
+                   "CardiacMRI"),
+}
+# former spellings of the data types
+_HITL_DATA['Fetal_us'] = _HITL_DATA['FetalUS']
+_HITL_DATA['Brain_MRI'] = _HITL_DATA['BrainMRI']
+
+
+def hitl_paths(data_type):
+    """ (log directory, image directory, train files list, dataset name) of
+    the HITL data of data_type, cardiac MRI for unknown types """
+    return (HITL_DIRECTORY,) + _HITL_DATA.get(data_type, _HITL_DATA['CardiacMRI'])
+
+
+def hitl_log_files(directory, type_name):
+    """ sorted paths of the HITL log files of the dataset type_name """
+    return [os.path.join(directory, filename) for filename in sorted(os.listdir(directory))
+            if (filename.endswith(".pickle") or filename.endswith(".p")) and type_name in filename]
+
+
+def allowed_images(train_paths):
+    """ names (without extension) of the images of the train files list """
+    with open(train_paths) as f:
+        return set((line.split("/")[-1]).split('.')[0] for line in f.readlines())
+
+
+def load_hitl_log(log_file, allowed):
+    """ (entries of the log whose image is in allowed, number of entries) """
+    with open(log_file, "rb") as f:
+        file_contents = pickle.load(f)
+    return [entry for entry in file_contents if entry['img_name'] in allowed], len(file_contents)
+
+
+def num_transitions(entry):
+    """ number of transitions recorded by a log entry """
+    return max(len(entry['states']) - 1, 0)
+
+
+def _hitl_player(image_directory, img_name, screen_dims):
+    """ MedicalPlayer of the image img_name of the logs """
+    image_path = os.path.join(image_directory, img_name + ".nii.gz")
+    logger.info("Image path: {}".format(image_path))
+    return MedicalPlayer(directory=image_directory, screen_dims=screen_dims,
+                         viz=0, saveGif='False', saveVideo='False',
+                         task='play', files_list=[image_path], data_type='HITL',
+                         max_num_frames=1500)
+
+
+def render_entry(entry, image_directory, compact=False, player=None, screen_dims=(45, 45, 45)):
+    """ Yield the (state, action, reward, isOver) transitions recorded by a log
+    entry, whose states are the screens of the agent (or its FrameRefs if
+    compact) at the recorded locations and resolutions.
+
+    player is a MedicalPlayer of the image of the entry, made if None.
+    """
+    if player is None:
+        player = _hitl_player(image_directory, entry['img_name'], screen_dims)
+    for key in range(num_transitions(entry)):
+        player.HITL_set_location(entry['states'][key], entry['resolution'][key])
+        state = player.frame_ref() if compact else player._current_state()
+        yield state, entry['actions'][key + 1], entry['rewards'][key + 1], entry['is_over'][key + 1]
+
+
+RenderedLog = namedtuple('RenderedLog', ['log_file', 'frames', 'action', 'reward', 'isOver',
+                                         'num_entries', 'num_used'])
+
+
+def _render_group(image_directory, screen_dims, img_name, items, frames, compact=False):
+    """ render the entries of img_name into the frames of their logs,
+    starting every entry at its offset, with a single player (and decode) of
+    the image
+    """
+    player = _hitl_player(image_directory, img_name, screen_dims)
+    for log, offset, entry in items:
+        for k, (state, _, _, _) in enumerate(render_entry(entry, image_directory, compact, player)):
+            frames[log][offset + k] = state
+
+
+def _render_worker(task, frames=None, compact=False):
+    """ render a group of entries, into the frames files of their logs if
+    frames is None
+    :returns: the logs of the entries and their number of transitions
+    """
+    image_directory, screen_dims, img_name, items, frames_paths = task
+    logs = sorted(set(log for log, _, _ in items))
+    if frames is None:
+        frames = {log: np.load(frames_paths[log], mmap_mode='r+') for log in logs}
+        _render_group(image_directory, screen_dims, img_name, items, frames)
+        for log in logs:
+            frames[log].flush()
+    else:
+        _render_group(image_directory, screen_dims, img_name, items, frames, compact)
+    return logs, sum(num_transitions(entry) for _, _, entry in items)
+
+
+def render_logs(log_files, image_directory, allowed, screen_dims=(45, 45, 45), workers=0,
+                compact=False, frames_paths=None):
+    """ Render the transitions of the entries of log_files whose image is in
+    allowed, log by log.
+
+    The entries are grouped by image, so that every image is decoded once
+    however many entries (and logs) record it. The frames are written into
+    a memory mapped file per log, at frames_paths or in a temporary folder
+    deleted once the logs are rendered, by a pool of processes if
+    workers > 0. A log is yielded as soon as the groups of its entries are
+    rendered, so the frames of the logs are never all held in memory.
+
+    :returns: generator of RenderedLog in the order of log_files, the
+        frames (or FrameRefs if compact, rendered in this process), actions,
+        rewards and terminal flags of the transitions of the log in the
+        order of its entries, and the number of entries read and used
+    """
+    assert not (compact and workers), 'FrameRefs are rendered in the training process'
+    screen_dims = tuple(screen_dims)
+    # (used entries, number of entries, number of transitions) of every log,
+    # image -> (log, offset of the first transition in the log, entry) of its entries
+    logs, groups = [], OrderedDict()
+    for log, log_file in enumerate(log_files):
+        logger.info("Log filename: {}".format(log_file))
+        used, num = load_hitl_log(log_file, allowed)
+        offset = 0
+        for entry in used:
+            groups.setdefault(entry['img_name'], []).append((log, offset, entry))
+            offset += num_transitions(entry)
+        logs.append((used, num, offset))
+    # number of groups still to render of every log
+    pending = [0] * len(logs)
+    for items in groups.values():
+        for log in set(log for log, _, _ in items):
+            pending[log] += 1
+
+    tmp_dir = None
+    if frames_paths is None and not compact:
+        tmp_dir = tempfile.mkdtemp(prefix='hitl')
+        frames_paths = [os.path.join(tmp_dir, '{}.npy'.format(log)) for log in range(len(logs))]
+    pool = None
+    try:
+        if compact:
+            frames = [[None] * size for _, _, size in logs]
+        else:
+            frames = [np.lib.format.open_memmap(path, mode='w+', dtype='uint8', shape=(size,) + screen_dims)
+                      for path, (_, _, size) in zip(frames_paths, logs)]
+        tasks = [(image_directory, screen_dims, img_name, items, frames_paths)
+                 for img_name, items in groups.items()]
+        if workers:
+            pool = mp.Pool(min(workers, max(len(groups), 1)))
+            results = pool.imap_unordered(_render_worker, tasks)
+        else:
+            results = (_render_worker(task, frames, compact) for task in tasks)
+
+        next_log = 0
+        with get_tqdm(total=sum(size for _, _, size in logs)) as pbar:
+            while next_log < len(logs):
+                if pending[next_log]:
+                    done, n = next(results)
+                    for log in done:
+                        pending[log] -= 1
+                    pbar.update(n)
+                    continue
+                used, num, size = logs[next_log]
+                action = np.zeros((size,), dtype='int32')
+                reward = np.zeros((size,), dtype='float32')
+                isOver = np.zeros((size,), dtype='bool')
+                offset = 0
+                for entry in used:
+                    n = num_transitions(entry)
+                    action[offset:offset + n] = entry['actions'][1:n + 1]
+                    reward[offset:offset + n] = entry['rewards'][1:n + 1]
+                    isOver[offset:offset + n] = entry['is_over'][1:n + 1]
+                    offset += n
+                log_frames, frames[next_log] = frames[next_log], None
+                if not compact:
+                    log_frames.flush()
+                yield RenderedLog(log_files[next_log], log_frames, action, reward, isOver, num, len(used))
+                next_log += 1
+        logger.info("Rendered {} transitions of {} images with {} workers".format(
+            sum(size for _, _, size in logs), len(groups), workers))
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+class DemonstrationBuffer(object):
+    """ Prebuilt transitions of the HITL logs of a dataset, ready to be
+        memory mapped by HumanDemReplayMemory.load_buffer.
+
+        Every log file has its frames in <log>.frames.npy and its actions,
+        rewards and terminal flags in <log>.npz, described by manifest.json:
+        the size and modification time of the log, the train images it was
+        filtered by and its number of transitions. `update` only renders the
+        logs which are new or changed since the last build (see
+        utils/build_hitl_buffer.py).
+
+        Attributes:
+        directory: folder of the buffer
+    """
+    VERSION = 1
+
+    def __init__(self, directory):
+        self.directory = os.path.expanduser(directory)
+        self.manifest_path = os.path.join(self.directory, 'manifest.json')
+        self.logs = {}
+        self.state_shape = None
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                manifest = json.load(f)
+            if manifest.get('version') != self.VERSION:
+                logger.warn("Demonstration buffer {} has version {}, expected {} - ignoring it".format(
+                    self.directory, manifest.get('version'), self.VERSION))
+            else:
+                self.logs = manifest['logs']
+                self.state_shape = manifest['state_shape']
+
+    def __len__(self):
+        """ number of transitions """
+        return sum(log['transitions'] for log in self.logs.values())
+
+    def _paths(self, name):
+        base = os.path.join(self.directory, name)
+        return base + '.frames.npy', base + '.npz'
+
+    def update(self, log_files, image_directory, allowed, state_shape=(45, 45, 45), workers=0):
+        """ render the logs which are new, changed or filtered by other train
+        images since the last build (with workers processes, see render_logs),
+        and drop the logs not in log_files
+        :returns: number of logs rendered
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        if self.state_shape is not None and tuple(self.state_shape) != tuple(state_shape):
+            logger.warn("Rebuilding demonstration buffer {} for screens {}".format(self.directory, state_shape))
+            self.logs = {}
+        self.state_shape = list(state_shape)
+        allowed = sorted(allowed)
+        names = [os.path.basename(log_file) for log_file in log_files]
+        stats = [os.stat(log_file) for log_file in log_files]
+        changed = []
+        for i, (name, stat) in enumerate(zip(names, stats)):
+            log = self.logs.get(name)
+            if log is None or log['size'] != stat.st_size or \
+                    log['mtime'] != stat.st_mtime or log['allowed'] != allowed:
+                changed.append(i)
+        if changed:
+            # the changed logs are rendered together, so that their images are decoded once,
+            # straight into the frames files of the logs
+            tmp_paths = [self._paths(names[i])[0][:-len('.npy')] + '.tmp{}.npy'.format(os.getpid())
+                         for i in changed]
+            try:
+                rendered = render_logs([log_files[i] for i in changed], image_directory, set(allowed),
+                                       screen_dims=tuple(state_shape), workers=workers,
+                                       frames_paths=tmp_paths)
+                for i, tmp, log in zip(changed, tmp_paths, rendered):
+                    self._write(names[i], tmp, log.action, log.reward, log.isOver)
+                    self.logs[names[i]] = dict(size=stats[i].st_size, mtime=stats[i].st_mtime,
+                                               allowed=allowed, transitions=len(log.action))
+                    # keep the logs built so far if the build is interrupted
+                    self.flush()
+            finally:
+                for tmp in tmp_paths:
+                    if os.path.exists(tmp):
+                        os.remove(tmp)
+        for name in set(self.logs) - set(names):
+            del self.logs[name]
+            for path in self._paths(name):
+                if os.path.exists(path):
+                    os.remove(path)
+        self.flush()
+        return len(changed)
+
+    def _write(self, name, frames_tmp, action, reward, isOver):
+        """ write the transitions of the log name, whose frames were
+        rendered into frames_tmp """
+        frames_path, arrays_path = self._paths(name)
+        os.replace(frames_tmp, frames_path)
+        tmp = arrays_path[:-len('.npz')] + '.tmp{}.npz'.format(os.getpid())
+        np.savez(tmp, action=action, reward=reward, isOver=isOver)
+        os.replace(tmp, arrays_path)
+
+    def flush(self):
+        """ write the manifest of the buffer """
+        tmp_path = self.manifest_path + '.tmp{}'.format(os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': self.VERSION, 'state_shape': self.state_shape,
+                       'logs': self.logs}, f)
+        os.replace(tmp_path, self.manifest_path)
+
+    def transitions(self):
+        """ yield (frames, action, reward, isOver) arrays of every log, in the
+        order of the log names, with frames memory mapped read-only """
+        for name in sorted(self.logs):
+            frames_path, arrays_path = self._paths(name)
+            frames = np.load(frames_path, mmap_mode='r')
+            with np.load(arrays_path) as arrays:
+                yield frames, arrays['action'], arrays['reward'], arrays['isOver']
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: inference.py
+
+import time
+import threading
+import numpy as np
+from six.moves import queue
+
+from tensorpack.utils import logger
+from tensorpack.utils.stats import StatCounter
+from tensorpack.callbacks.base import Callback
+from tensorpack.utils.concurrency import StoppableThread, ShareSessionThread
+
+__all__ = ['InferenceServer']
+
+
+class _Request(object):
+    """ inputs of a prediction and the event set once its outputs are ready """
+    def __init__(self, inputs):
+        self.inputs = inputs
+        self.size = len(inputs[0])
+        self.outputs = None
+        self.error = None
+        self.time = time.time()
+        self.done = threading.Event()
+
+
+class _ServerThread(StoppableThread, ShareSessionThread):
+    def __init__(self, server):
+        super(_ServerThread, self).__init__()
+        self.server = server
+        self.name = 'InferenceServerThread'
+        self.daemon = True
+
+    def run(self):
+        with self.default_sess():
+            while not self.stopped():
+                self.server._serve_batch()
+
+
+class InferenceServer(Callback):
+    """ A predictor shared by many threads, running one forward pass for a
+        batch of their requests.
+
+        The server is called like the predictor, with a batch of inputs
+        (usually a single state), and blocks until its outputs are ready. A
+        server thread takes the queued requests and runs them together, once
+        max_batch states are queued or max_latency seconds after the first
+        one, so the simulator and the evaluator threads share the session
+        instead of serialising on it. The mean batch size, the latency of the
+        requests and the number of states predicted per second are put to the
+        monitors at every trigger.
+
+        As a callback the server gets its predictor from the trainer and runs
+        during training; otherwise give the predictor and call start and stop.
+
+        Attributes:
+        input_names, output_names: names of the predictor inputs and outputs
+        max_batch: largest number of states predicted together (default: 32)
+        max_latency: longest wait in seconds for more requests (default: 0.005)
+        predictor: predictor of the server, from the trainer if None
+    """
+
+    def __init__(self, input_names, output_names, max_batch=32, max_latency=0.005,
+                 predictor=None):
+        assert max_batch > 0, 'invalid max_batch {}'.format(max_batch)
+        self.input_names = input_names
+        self.output_names = output_names
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self.predictor = predictor
+        self._queue = queue.Queue()
+        self._thread = None
+        self.reset_stat()
+
+    def reset_stat(self):
+        """ Reset all statistics counter"""
+        self.batch_sizes = StatCounter()
+        self.latencies = StatCounter()
+        self._stat_time = time.time()
+
+    def __call__(self, *inputs):
+        """ predict the outputs of a batch of inputs, like the predictor """
+        if self._thread is None or self._thread.stopped():
+            raise RuntimeError("stopped!")
+        request = _Request(inputs)
+        self._queue.put(request)
+        while not request.done.wait(0.1):
+            if not self._thread.is_alive():
+                raise RuntimeError("stopped!")
+        if request.error is not None:
+            raise request.error
+        return request.outputs
+
+    def _next_batch(self):
+        """ requests of the next batch, None if no request came in 0.1 s """
+        try:
+            batch = [self._queue.get(timeout=0.1)]
+        except queue.Empty:
+            return None
+        size = batch[0].size
+        deadline = time.time() + self.max_latency
+        while size < self.max_batch:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            batch.append(request)
+            size += request.size
+        return batch
+
+    def _serve_batch(self):
+        batch = self._next_batch()
+        if batch is None:
+            return
+        try:
+            inputs = [np.concatenate([r.inputs[i] for r in batch]) for i in range(len(batch[0].inputs))]
+            outputs = self.predictor(*inputs)
+        except Exception as e:
+            for request in batch:
+                request.error = e
+                request.done.set()
+            return
+        start = 0
+        now = time.time()
+        for request in batch:
+            end = start + request.size
+            request.outputs = [o[start:end] for o in outputs]
+            request.done.set()
+            self.latencies.feed(now - request.time)
+            start = end
+        self.batch_sizes.feed(start)
+
+    def start(self):
+        """ start the server thread, in the default session """
+        assert self.predictor is not None, 'the inference server has no predictor'
+        self._thread = _ServerThread(self)
+        self._thread.start()
+        logger.info("Started the inference server (max batch {}, max latency {} ms)".format(
+            self.max_batch, 1e3 * self.max_latency))
+
+    def stop(self):
+        """ stop the server thread, failing the requests still queued """
+        if self._thread is None:
+            return
+        self._thread.stop()
+        self._thread.join()
+        while True:
+            try:
+                request = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            request.error = RuntimeError("stopped!")
+            request.done.set()
+
+    def _setup_graph(self):
+        if self.predictor is None:
+            self.predictor = self.trainer.get_predictor(self.input_names, self.output_names)
+
+    def _before_train(self):
+        self.start()
+
+    def _after_train(self):
+        self.stop()
+
+    def _trigger(self):
+        elapsed = time.time() - self._stat_time
+        if self.batch_sizes.count:
+            self.trainer.monitors.put_scalar('inference/mean_batch', self.batch_sizes.average)
+            self.trainer.monitors.put_scalar('inference/mean_latency_ms', 1e3 * self.latencies.average)
+            self.trainer.monitors.put_scalar('inference/max_latency_ms', 1e3 * self.latencies.max)
+            self.trainer.monitors.put_scalar('inference/states_per_sec', self.batch_sizes.sum / elapsed)
+        self.reset_stat()
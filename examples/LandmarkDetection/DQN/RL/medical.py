@@ -41,6 +41,9 @@ from tensorpack.utils.stats import StatCounter
 from IPython.core.debugger import set_trace
 from RL.dataReader import *
 from RL.dataReader import fileHITL
+from RL.cropping import VolumePyramid, FrameRef
+from RL.actions import move
+from RL.history import LocationHistory
 
 _ALE_LOCK = threading.Lock()
 
@@ -58,7 +61,10 @@ class MedicalPlayer(gym.Env):
 
     def __init__(self, directory=None, viz=False, task=False, files_list=None,
                  screen_dims=(27,27,27), history_length=20, multiscale=True,
-                 max_num_frames=0, saveGif=False, saveVideo=False, data_type=None):
+                 max_num_frames=0, saveGif=False, saveVideo=False, data_type=None,
+                 cache_dir=None, store_dir=None, prefetch=0, manifest=None,
+                 shuffle=None, seed=None, shard=None, fast_normalisation=False,
+                 pyramid=None, padded_crops=False, oscillation_threshold=3):
         """
         :param train_directory: environment or game name
         :param viz: visualization
@@ -71,28 +77,30 @@ class MedicalPlayer(gym.Env):
         :param location_history_length: consider lost of lives as end of
             episode (useful for training)
         :max_num_frames: maximum numbe0r of frames per episode.
+        :param cache_dir: directory of the pre-processed volume cache
+            (default None disables caching)
+        :param store_dir: directory of a prebuilt volume store whose volumes
+            are memory mapped read-only and shared between processes
+        :param prefetch: number of volumes decoded ahead of time in a
+            background thread (default 0 decodes on reset)
+        :param manifest: JSON manifest describing the dataset, used instead
+            of files_list and data_type (see filesListLandmark.from_manifest)
+        :param shuffle, seed, shard: sampling of the files list, default to
+            the manifest values or to sequential sampling of all files
+        :param fast_normalisation: normalise intensities in place with numpy
+            instead of SimpleITK filters (faster, lower peak memory)
+        :param pyramid: pre-compute strided grids of every volume once, when
+            it is first loaded (and save them in the cache), so that crops at
+            scale 2 and 3 are contiguous slices, 'stride' gives the same
+            screens as without it, 'antialias' box filters the coarse scales
+            first (default None crops the full volume)
+        :param padded_crops: pad the pyramid grids by half a screen so that
+            crops are fixed-shape views without boundary clipping (implies
+            pyramid='stride' if no pyramid is given)
+        :param oscillation_threshold: the agent oscillates (and refines its
+            scale or stops) once it visited a location of its history more
+            than this number of times (default 3)
         """
-        # ######################################################################
-        # ## generate evaluation results from 19 different points
-        # ## save results in csv file
-        # self.csvfile = 'DuelDoubleDQN_multiscale_brain_mri_point_pc_ROI_45_45_45_midl2018.csv'
-        # if not train:
-        #     with open(self.csvfile, 'w') as outcsv:
-        #         fields = ["filename", "dist_error"]
-        #         writer = csv.writer(outcsv)
-        #         writer.writerow(map(lambda x: x, fields))
-        #
-        # x = [0.5,0.25,0.75]
-        # y = [0.5,0.25,0.75]
-        # z = [0.5,0.25,0.75]
-        # self.start_points = []
-        # for combination in itertools.product(x, y, z):
-        #     if 0.5 in combination: self.start_points.append(combination)
-        # self.start_points = itertools.cycle(self.start_points)
-        # self.count_points = 0
-        # self.total_loc = []
-        # ######################################################################
-
         super(MedicalPlayer, self).__init__()
 
         # inits stat counters
@@ -118,6 +126,20 @@ class MedicalPlayer(gym.Env):
         self.data_type = data_type
         #directory is file for logging evaluation
         self.directory = directory
+        # on-disk cache of pre-processed volumes
+        self.cache_dir = cache_dir
+        self.store_dir = store_dir
+        # number of volumes to decode ahead of the current episode
+        self.prefetch = prefetch
+        # dataset manifest and sampling of the files list
+        self.manifest = manifest
+        self.sampling = {k: v for k, v in [('shuffle', shuffle), ('seed', seed), ('shard', shard)]
+                         if v is not None}
+        self.fast_normalisation = fast_normalisation
+        if padded_crops and pyramid is None:
+            pyramid = 'stride'
+        self.pyramid = pyramid
+        self.pyramid_padding = VolumePyramid.padding_for(screen_dims) if padded_crops else 0
 
         # init env dimensions
         if self.dims == 2:
@@ -147,6 +169,8 @@ class MedicalPlayer(gym.Env):
                                             dtype=np.uint8)
         # history buffer for storing last locations to check oscilations
         self._history_length = history_length
+        self.oscillation_threshold = oscillation_threshold
+        self._history = LocationHistory(history_length, oscillation_threshold)
         # initialize rectangle limits from input image coordinates
         self.rectangle = Rectangle(0, 0, 0, 0, 0, 0)
         # add your data loader here
@@ -160,23 +184,41 @@ class MedicalPlayer(gym.Env):
         self._restart_episode()
 
     def set_dataLoader(self, files_list):
-        if self.data_type == 'BrainMRI':
-            self.data_loader = filesListBrainMRLandmark
-        elif self.data_type == 'CardiacMRI':
-            self.data_loader = filesListCardioLandmark
-        elif self.data_type == 'FetalUS':
-            self.data_loader = filesListFetalUSLandmark
-        elif self.data_type == "HITL":
-            self.data_loader = fileHITL
-
-        if self.task == 'play':
-            self.files = self.data_loader(files_list,
-                                          returnLandmarks=False)
+        # landmarks are only available (and needed) for train and eval
+        returnLandmarks = self.task != 'play'
+        if self.data_type == "HITL":
+            self.files = fileHITL(files_list,
+                                  returnLandmarks=returnLandmarks,
+                                  cache_dir=self.cache_dir,
+                                  store_dir=self.store_dir,
+                                  fast_normalisation=self.fast_normalisation,
+                                  pyramid=self.pyramid,
+                                  pyramid_padding=self.pyramid_padding)
+        elif self.manifest:
+            self.files = filesListLandmark.from_manifest(self.manifest,
+                                                         returnLandmarks=returnLandmarks,
+                                                         cache_dir=self.cache_dir,
+                                                         store_dir=self.store_dir,
+                                                         fast_normalisation=self.fast_normalisation,
+                                                         pyramid=self.pyramid,
+                                                         pyramid_padding=self.pyramid_padding,
+                                                         **self.sampling)
+            self.data_type = self.files.dataset
         else:
-            self.files = self.data_loader(files_list,
-                                         returnLandmarks=True)
-
-        self.sampled_files = self.files.sample_circular()
+            self.files = filesListLandmark(files_list,
+                                           returnLandmarks=returnLandmarks,
+                                           cache_dir=self.cache_dir,
+                                           store_dir=self.store_dir,
+                                           dataset=self.data_type,
+                                           fast_normalisation=self.fast_normalisation,
+                                           pyramid=self.pyramid,
+                                           pyramid_padding=self.pyramid_padding,
+                                           **self.sampling)
+
+        if self.prefetch:
+            self.sampled_files = self.files.sample_prefetch(self.prefetch)
+        else:
+            self.sampled_files = self.files.sample_circular()
 
     def HITL_episode_log(self):
         """ Method to save episode info for HITL """
@@ -215,9 +257,6 @@ class MedicalPlayer(gym.Env):
         self.cnt = 0 # counter to limit number of steps per episodes
         self.num_games.feed(1)
         self.current_episode_score.reset()  # reset the stat counter
-        self._loc_history = [(0,) * self.dims] * self._history_length
-        # list of q-value lists
-        self._qvalues_history = [(0,) * self.actions] * self._history_length
         self._clear_history()
         self.new_random_game()
 
@@ -231,32 +270,6 @@ class MedicalPlayer(gym.Env):
         """
         self.terminal = False
         self.viewer = None
-        # ######################################################################
-        # ## generate evaluation results from 19 different points
-        # if self.count_points ==0:
-        #     print('\n============== new game ===============\n')
-        #     # save results
-        #     if self.total_loc:
-        #         with open(self.csvfile, 'a') as outcsv:
-        #             fields= [self.filename, self.cur_dist]
-        #             writer = csv.writer(outcsv)
-        #             writer.writerow(map(lambda x: x, fields))
-        #         self.total_loc = []
-        #     # sample a new image
-        #     self._image, self._target_loc, self.filepath, self.spacing = next(self.sampled_files)
-        #     scale = next(self.start_points)
-        #     self.count_points +=1
-        # else:
-        #     self.count_points += 1
-        #     logger.info('count_points {}'.format(self.count_points))
-        #     scale = next(self.start_points)
-        #
-        # x = int(scale[0] * self._image.dims[0])
-        # y = int(scale[1] * self._image.dims[1])
-        # z = int(scale[2] * self._image.dims[2])
-        # logger.info('starting point {}-{}-{}'.format(x,y,z))
-        # ######################################################################
-
         # sample a new image
         self._image, self._target_loc, self.filepath, self.spacing = next(self.sampled_files)
         self.filename = os.path.basename(self.filepath)
@@ -356,66 +369,11 @@ class MedicalPlayer(gym.Env):
         self._qvalues = qvalues
         current_loc = self._location
         self.terminal = False
-        go_out = False
         self.viewer = viewer
 
-        # UP Z+ -----------------------------------------------------------
-        if (act == 0):
-            next_location = (current_loc[0],
-                             current_loc[1],
-                             round(current_loc[2] + self.action_step))
-            if (next_location[2] >= self._image_dims[2]):
-                # print(' trying to go out the image Z+ ',)
-                next_location = current_loc
-                go_out = True
-
-        # FORWARD Y+ ---------------------------------------------------------
-        if (act == 1):
-            next_location = (current_loc[0],
-                             round(current_loc[1] + self.action_step),
-                             current_loc[2])
-            if (next_location[1] >= self._image_dims[1]):
-                # print(' trying to go out the image Y+ ',)
-                next_location = current_loc
-                go_out = True
-        # RIGHT X+ -----------------------------------------------------------
-        if (act == 2):
-            next_location = (round(current_loc[0] + self.action_step),
-                             current_loc[1],
-                             current_loc[2])
-            if next_location[0] >= self._image_dims[0]:
-                # print(' trying to go out the image X+ ',)
-                next_location = current_loc
-                go_out = True
-        # LEFT X- -----------------------------------------------------------
-        if act == 3:
-            next_location = (round(current_loc[0] - self.action_step),
-                             current_loc[1],
-                             current_loc[2])
-            if next_location[0] <= 0:
-                # print(' trying to go out the image X- ',)
-                next_location = current_loc
-                go_out = True
-        # BACKWARD Y- ---------------------------------------------------------
-        if act == 4:
-            next_location = (current_loc[0],
-                             round(current_loc[1] - self.action_step),
-                             current_loc[2])
-            if next_location[1] <= 0:
-                # print(' trying to go out the image Y- ',)
-                next_location = current_loc
-                go_out = True
-        # DOWN Z- -----------------------------------------------------------
-        if act == 5:
-            next_location = (current_loc[0],
-                             current_loc[1],
-                             round(current_loc[2] - self.action_step))
-            if next_location[2] <= 0:
-                # print(' trying to go out the image Z- ',)
-                next_location = current_loc
-                go_out = True
-        # ---------------------------------------------------------------------
-        # ---------------------------------------------------------------------
+        # move along the axis of the action, refused at the image border
+        next_location, go_out = move(current_loc, act, self.action_step, self._image_dims)
+
         # punish -1 reward if the agent tries to go out
         if (self.task!='play'):
             if go_out:
@@ -493,24 +451,6 @@ class MedicalPlayer(gym.Env):
                     writer = csv.writer(outcsv)
                     writer.writerow(map(lambda x: x, fields))
 
-
-        # #######################################################################
-        # ## generate evaluation results from 19 different points
-        # if self.terminal:
-        #     logger.info(info)
-        #     self.total_loc.append(self._location)
-        #     if not(self.count_points == 19):
-        #         self._restart_episode()
-        #     else:
-        #         mean_location = np.mean(self.total_loc,axis=0)
-        #         logger.info('total_loc {} \n mean_location{}'.format(self.total_loc, mean_location))
-        #         self.cur_dist = self.calcDistance(mean_location,
-        #                                           self._target_loc,
-        #                                           self.spacing)
-        #         logger.info('final distance error {} \n'.format(self.cur_dist))
-        #         self.count_points = 0
-        # #######################################################################
-
         return self._current_state(), self.reward, self.terminal, info
 
     def stepManual(self, act, viewer):
@@ -520,7 +460,6 @@ class MedicalPlayer(gym.Env):
         # self._qvalues = qvalues
         current_loc = self._location
         self.terminal = False
-        go_out = False
         self.viewer = viewer
         self._act = act
 
@@ -528,61 +467,7 @@ class MedicalPlayer(gym.Env):
         if act == -1:
             pass
         else:
-            # UP Z+ -----------------------------------------------------------
-            if (act == 0):
-                next_location = (current_loc[0],
-                                 current_loc[1],
-                                 round(current_loc[2] + self.action_step))
-                if (next_location[2] >= self._image_dims[2]):
-                    # print(' trying to go out the image Z+ ',)
-                    next_location = current_loc
-                    go_out = True
-
-            # FORWARD Y+ ---------------------------------------------------------
-            if (act == 1):
-                next_location = (current_loc[0],
-                                 round(current_loc[1] + self.action_step),
-                                 current_loc[2])
-                if (next_location[1] >= self._image_dims[1]):
-                    # print(' trying to go out the image Y+ ',)
-                    next_location = current_loc
-                    go_out = True
-            # RIGHT X+ -----------------------------------------------------------
-            if (act == 2):
-                next_location = (round(current_loc[0] + self.action_step),
-                                 current_loc[1],
-                                 current_loc[2])
-                if next_location[0] >= self._image_dims[0]:
-                    # print(' trying to go out the image X+ ',)
-                    next_location = current_loc
-                    go_out = True
-            # LEFT X- -----------------------------------------------------------
-            if act == 3:
-                next_location = (round(current_loc[0] - self.action_step),
-                                 current_loc[1],
-                                 current_loc[2])
-                if next_location[0] <= 0:
-                    # print(' trying to go out the image X- ',)
-                    next_location = current_loc
-                    go_out = True
-            # BACKWARD Y- ---------------------------------------------------------
-            if act == 4:
-                next_location = (current_loc[0],
-                                 round(current_loc[1] - self.action_step),
-                                 current_loc[2])
-                if next_location[1] <= 0:
-                    # print(' trying to go out the image Y- ',)
-                    next_location = current_loc
-                    go_out = True
-            # DOWN Z- -----------------------------------------------------------
-            if act == 5:
-                next_location = (current_loc[0],
-                                 current_loc[1],
-                                 round(current_loc[2] - self.action_step))
-                if next_location[2] <= 0:
-                    # print(' trying to go out the image Z- ',)
-                    next_location = current_loc
-                    go_out = True
+            next_location, go_out = move(current_loc, act, self.action_step, self._image_dims)
 
             if go_out:
                 self.reward = -1
@@ -610,14 +495,7 @@ class MedicalPlayer(gym.Env):
         ''' get best location with best qvalue from last for locations
         stored in history
         '''
-        last_qvalues_history = self._qvalues_history[-4:]
-        last_loc_history = self._loc_history[-4:]
-        best_qvalues = np.max(last_qvalues_history, axis=1)
-        # best_idx = best_qvalues.argmax()
-        best_idx = best_qvalues.argmin()
-        best_location = last_loc_history[best_idx]
-
-        return best_location
+        return self._history.best_location()
 
     def adjustMultiScale(self, higherRes=True):
         '''Adjusts the agent's step size'''
@@ -643,8 +521,7 @@ class MedicalPlayer(gym.Env):
             self._reward_history = []
             self._res_history = []
         else:
-            self._loc_history = [(0,) * self.dims] * self._history_length
-            self._qvalues_history = [(0,) * self.actions] * self._history_length
+            self._history.clear()
 
     def _update_history(self):
         ''' update history buffer with current state
@@ -655,12 +532,14 @@ class MedicalPlayer(gym.Env):
             self._res_history.append(self.xscale)
             self._reward_history.append(self.reward)
         else:
-            # update location history
-            self._loc_history[:-1] = self._loc_history[1:]
-            self._loc_history[-1] = self._location
-            # update q-value history
-            self._qvalues_history[:-1] = self._qvalues_history[1:]
-            self._qvalues_history[-1] = self._qvalues
+            # update location and q-value history
+            self._history.push(self._location, self._qvalues)
+
+    def frame_ref(self):
+        """ FrameRef of the current screen, to crop it again later (see
+        CompactReplayMemory)
+        """
+        return FrameRef(self._image, tuple(self._location), self.xscale)
 
     def _current_state(self):
         """
@@ -669,9 +548,6 @@ class MedicalPlayer(gym.Env):
 
         :return: new state
         """
-        # initialize screen with zeros - all background
-        screen = np.zeros((self.screen_dims)).astype(self._image.data.dtype)
-
         # screen uses coordinate system relative to origin (0, 0, 0)
         screen_xmin, screen_ymin, screen_zmin = 0, 0, 0
         screen_xmax, screen_ymax, screen_zmax = self.screen_dims
@@ -693,25 +569,38 @@ class MedicalPlayer(gym.Env):
             zmin = self._location[2] - round(self.depth * self.zscale / 2)
             zmax = self._location[2] + round(self.depth * self.zscale / 2)
 
+        pyramid = getattr(self._image, 'pyramid', None)
+        if pyramid is not None:
+            # contiguous crop of the pre-computed grid of this scale,
+            # a view of the padded grid when the volume was padded
+            screen = pyramid.crop((xmin, ymin, zmin), self.xscale, self.screen_dims)
+            self.rectangle = Rectangle(max(xmin, 0), min(xmax, self._image_dims[0]),
+                                       max(ymin, 0), min(ymax, self._image_dims[1]),
+                                       max(zmin, 0), min(zmax, self._image_dims[2]))
+            return screen
+
+        # initialize screen with zeros - all background
+        screen = np.zeros(self.screen_dims, dtype=self._image.data.dtype)
+
         # check if they violate image boundary and fix it
         if xmin < 0:
             xmin = 0
-            screen_xmin = screen_xmax - len(np.arange(xmin, xmax, self.xscale))
+            screen_xmin = screen_xmax - len(range(xmin, xmax, self.xscale))
         if ymin < 0:
             ymin = 0
-            screen_ymin = screen_ymax - len(np.arange(ymin, ymax, self.yscale))
+            screen_ymin = screen_ymax - len(range(ymin, ymax, self.yscale))
         if zmin < 0:
             zmin = 0
-            screen_zmin = screen_zmax - len(np.arange(zmin, zmax, self.zscale))
+            screen_zmin = screen_zmax - len(range(zmin, zmax, self.zscale))
         if xmax > self._image_dims[0]:
             xmax = self._image_dims[0]
-            screen_xmax = screen_xmin + len(np.arange(xmin,xmax,self.xscale))
+            screen_xmax = screen_xmin + len(range(xmin,xmax,self.xscale))
         if ymax>self._image_dims[1]:
             ymax = self._image_dims[1]
-            screen_ymax = screen_ymin + len(np.arange(ymin,ymax,self.yscale))
+            screen_ymax = screen_ymin + len(range(ymin,ymax,self.yscale))
         if zmax>self._image_dims[2]:
             zmax = self._image_dims[2]
-            screen_zmax = screen_zmin + len(np.arange(zmin,zmax,self.zscale))
+            screen_zmax = screen_zmin + len(range(zmin,zmax,self.zscale))
 
         # crop image data to update what network sees
         # image coordinate system becomes screen coordinates
@@ -754,18 +643,10 @@ class MedicalPlayer(gym.Env):
 
     @property
     def _oscillate(self):
-        """ Return True if the agent is stuck and oscillating
+        """ Return True if the agent is stuck and oscillating, i.e. visited a
+        location of its history more than oscillation_threshold times
         """
-        counter = Counter(self._loc_history)
-        freq = counter.most_common()
-
-        if freq[0][0] == (0, 0, 0):
-            if (freq[1][1] > 3):
-                return True
-            else:
-                return False
-        elif (freq[0][1] > 3):
-            return True
+        return self._history.oscillating
 
     def get_action_meanings(self):
         """ return array of integers for actions"""
@@ -795,6 +676,24 @@ class MedicalPlayer(gym.Env):
         self.num_games = StatCounter()
         self.num_success = StatCounter()
 
+    @property
+    def num_shard_files(self):
+        """ number of files sampled by this player in a pass """
+        shard = self.files.shard
+        return len(range(shard[0], self.files.num_files, shard[1]))
+
+    def restart_files(self, shuffle=False):
+        """ sample the files of the shard again from the first one (in the
+        order of the files list unless shuffle), so that the next
+        num_shard_files episodes visit every file of the shard once """
+        close = getattr(self.sampled_files, 'close', None)
+        if close is not None:
+            close()
+        if self.prefetch:
+            self.sampled_files = self.files.sample_prefetch(self.prefetch, shuffle=shuffle)
+        else:
+            self.sampled_files = self.files.sample_circular(shuffle=shuffle)
+
     def display(self, return_rgb_array=False):
         # get dimensions
         current_point = self._location
@@ -922,11 +821,29 @@ class MedicalPlayer(gym.Env):
 # =============================================================================
 class FrameStack(gym.Wrapper):
     """used when not training. wrapper for Medical Env"""
-    def __init__(self, env, k):
-        """Buffer observations and stack across channels (last axis)."""
+
+    # how the stacked observation is built: a new array per step ('stack'),
+    # a view of a rolling buffer ('view') or a copy into a reused buffer ('copy')
+    MODES = ('stack', 'view', 'copy')
+
+    def __init__(self, env, k, mode='stack'):
+        """Buffer observations and stack across channels (last axis).
+
+        In 'view' and 'copy' modes every frame is written once into the next
+        channel of a preallocated channels-last buffer of 2k channels, so the
+        last k frames are always a range of channels; when the range reaches
+        the end of the buffer it is moved to the front (every k steps).
+        'view' returns the range as a read-only view, 'copy' copies it into
+        one reused contiguous array. Both are overwritten by the next steps.
+        """
+        assert mode in self.MODES, 'invalid FrameStack mode {}'.format(mode)
         gym.Wrapper.__init__(self, env)
         self.k = k  # history length
+        self.mode = mode
         self.frames = deque([], maxlen=k)
+        self._buffer = None
+        self._out = None
+        self._start = 0
         shp = env.observation_space.shape
         self._base_dim = len(shp)
         new_shape = shp + (k,)
@@ -936,6 +853,16 @@ class FrameStack(gym.Wrapper):
     def reset(self):
         """Clear buffer and re-fill by duplicating the first observation."""
         ob = self.env.reset()
+        if self.mode != 'stack':
+            if self._buffer is None or self._buffer.shape[:-1] != ob.shape \
+                    or self._buffer.dtype != ob.dtype:
+                self._buffer = np.zeros(ob.shape + (2 * self.k,), dtype=ob.dtype)
+                self._out = np.empty(ob.shape + (self.k,), dtype=ob.dtype)
+            else:
+                self._buffer.fill(0)
+            self._start = 0
+            self._buffer[..., self.k - 1] = ob
+            return self._observation()
         for _ in range(self.k - 1):
             self.frames.append(np.zeros_like(ob))
         self.frames.append(ob)
@@ -943,10 +870,48 @@ class FrameStack(gym.Wrapper):
 
     def step(self, action, q_values, viewer):
         ob, reward, done, info = self.env.step(action, q_values, viewer)
-        self.frames.append(ob)
+        if self.mode != 'stack':
+            self._push(ob)
+        else:
+            self.frames.append(ob)
         return self._observation(), reward, done, info
 
+    def _channels(self, start, n, void=True):
+        """ channels start .. start+n of the buffer as one item per voxel, so
+        that they are copied with a single pass. numpy copies void items fast
+        into a contiguous array but slowly between strided arrays, where
+        plain integers of the same size are used when possible.
+        """
+        nbytes = n * self._buffer.itemsize
+        if void or nbytes not in (1, 2, 4, 8):
+            dtype = np.dtype((np.void, nbytes))
+        else:
+            dtype = np.dtype('u{}'.format(nbytes))
+        return np.ndarray(shape=(self._buffer.size // self._buffer.shape[-1],),
+                          dtype=dtype, buffer=self._buffer,
+                          offset=start * self._buffer.itemsize, strides=(self._buffer.strides[-2],))
+
+    def _push(self, ob):
+        """ write ob after the last k frames of the rolling buffer """
+        if self._start == self.k:
+            # the range reached the end of the buffer, move it to the front
+            self._channels(0, self.k, void=False)[...] = self._channels(self.k, self.k, void=False)
+            self._start = 1
+        else:
+            self._start += 1
+        self._buffer[..., self._start + self.k - 1] = ob
+
     def _observation(self):
+        if self.mode != 'stack':
+            # channels start .. start+k-1 hold the last k frames, oldest first
+            if self.mode == 'copy':
+                channels = self._channels(self._start, self.k)
+                self._out.reshape(-1).view(channels.dtype)[...] = channels
+                view = self._out.view()
+            else:
+                view = self._buffer[..., self._start:self._start + self.k]
+            view.flags.writeable = False
+            return view
         assert len(self.frames) == self.k
         return np.stack(self.frames, axis=-1)
         # if self._base_dim == 2:
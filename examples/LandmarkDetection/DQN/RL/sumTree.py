@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: sumTree.py
+
+import numpy as np
+
+__all__ = ['SumTree']
+
+
+class SumTree(object):
+    """ Binary sum tree over the priorities of capacity slots.
+
+        The leaves hold the priorities and every node the sum of its
+        children, so updating a priority and finding the slot where a
+        cumulative sum falls are O(log n). Updates add the change of the
+        leaves to all their ancestors at once, and `find` descends the tree
+        with one numpy call per level for an array of values.
+
+        Attributes:
+        capacity: number of slots
+    """
+
+    def __init__(self, capacity):
+        assert capacity > 0, 'invalid capacity {}'.format(capacity)
+        self.capacity = int(capacity)
+        # number of leaves, a power of two so that all leaves are on the same level
+        self._depth = max(self.capacity - 1, 1).bit_length()
+        self._leaves = 1 << self._depth
+        # node i >> shift for every shift is the path from node i to the root
+        self._shifts = np.arange(1, self._depth + 1)
+        self._sum = np.zeros(2 * self._leaves, dtype='float64')
+
+    @property
+    def total(self):
+        """ sum of all priorities """
+        return self._sum[1]
+
+    def get(self, slots):
+        """ priorities of slots """
+        return self._sum[np.asarray(slots) + self._leaves]
+
+    def update_one(self, slot, priority):
+        """ set the priority of a single slot """
+        node = slot + self._leaves
+        delta = priority - self._sum[node]
+        self._sum[node] = priority
+        self._sum[node >> self._shifts] += delta
+
+    def update(self, slots, priorities):
+        """ set the priorities of an array of slots (the last one wins for
+        repeated slots)
+        """
+        slots = np.asarray(slots, dtype='int64')[::-1]
+        priorities = np.asarray(priorities, dtype='float64')[::-1]
+        slots, last = np.unique(slots, return_index=True)
+        priorities = priorities[last]
+        nodes = slots + self._leaves
+        delta = priorities - self._sum[nodes]
+        self._sum[nodes] = priorities
+        # nodes share ancestors, add.at accumulates their changes
+        np.add.at(self._sum, (nodes[:, None] >> self._shifts).ravel(),
+                  np.repeat(delta, self._depth))
+
+    def find(self, values):
+        """ slots where the cumulative sums values (in [0, total)) fall """
+        values = np.array(values, dtype='float64')
+        nodes = np.ones(values.shape, dtype='int64')
+        for _ in range(self._depth):
+            left = 2 * nodes
+            left_sum = self._sum[left]
+            right = values > left_sum
+            values -= np.where(right, left_sum, 0)
+            nodes = left + right
+        return nodes - self._leaves
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: volumeCache.py
+
+import os
+import json
+import hashlib
+import threading
+import numpy as np
+from tensorpack import logger
+
+__all__ = ['VolumeCache', 'VolumeStore', 'to_uint8']
+
+# bump when the on-disk layout or the pre-processing changes
+CACHE_VERSION = 1
+
+
+def to_uint8(data, inplace=False):
+    """ Convert a volume rescaled to [0, 255] into uint8.
+    Values are rounded to the nearest integer (half to even) and clipped,
+    so the uint8 volume differs from the float32 one by at most 0.5. This is
+    the rounding of every volume used by the players (see NiftiImage.decode).
+    With inplace, data is rounded in place instead of in a temporary copy.
+    """
+    if data.dtype == np.uint8:
+        return data
+    if not inplace:
+        data = data.copy()
+    np.rint(data, out=data)
+    np.clip(data, 0, 255, out=data)
+    return data.astype('uint8')
+
+
+class VolumeCache(object):
+    """ A persistent on-disk cache of pre-processed volumes.
+
+        Every entry holds the normalised, already transposed uint8 volume
+        together with its spacing, so a cache hit skips reading the nifti file
+        and the intensity normalisation.
+
+        Volumes are keyed by the source image path, its modification time and
+        the pre-processing parameters, so the readers with and without
+        landmarks share them. The resolved landmarks are kept under their own
+        keys (see `save_landmark`). Each volume is stored as two files:
+            <key>.npy  - uint8 volume in [width, height, depth] order
+            <key>.json - spacing and source information
+        and each landmark as <key>.json alone.
+
+        Attributes:
+        directory: folder used to store the cached volumes
+    """
+
+    def __init__(self, directory):
+        self.directory = os.path.expanduser(directory)
+        os.makedirs(self.directory, exist_ok=True)
+
+    @staticmethod
+    def key(image_file, landmark_file=None, **params):
+        """ return the cache key of an image given its pre-processing
+        parameters, or of its landmark in landmark_file given the parameters
+        of the landmark
+        """
+        desc = {'version': CACHE_VERSION,
+                'image': os.path.abspath(os.path.expanduser(image_file)),
+                'image_mtime': os.path.getmtime(os.path.expanduser(image_file))}
+        if landmark_file is not None:
+            desc['landmark'] = os.path.abspath(os.path.expanduser(landmark_file))
+            desc['landmark_mtime'] = os.path.getmtime(os.path.expanduser(landmark_file))
+        desc.update(params)
+        desc = json.dumps(desc, sort_keys=True, default=str)
+        return hashlib.sha1(desc.encode('utf-8')).hexdigest()
+
+    def _paths(self, key):
+        base = os.path.join(self.directory, key)
+        return base + '.npy', base + '.json'
+
+    def load(self, key):
+        """ return (data, landmark, spacing) of a cached entry or None on a miss
+        """
+        data_path, header_path = self._paths(key)
+        if not (os.path.exists(data_path) and os.path.exists(header_path)):
+            return None
+        try:
+            with open(header_path) as f:
+                header = json.load(f)
+            # map the volume read-only so that players in different
+            # processes share the same pages through the OS page cache
+            data = np.load(data_path, mmap_mode='r')
+        except (OSError, ValueError) as e:
+            logger.warn("Ignoring corrupted cache entry {}: {}".format(key, e))
+            return None
+        landmark = header['landmark']
+        if landmark is not None:
+            landmark = np.asarray(landmark, dtype='int')
+        return data, landmark, tuple(header['spacing'])
+
+    def save(self, key, data, landmark, spacing, source=None):
+        """ store a pre-processed volume, its landmark and spacing under key
+        """
+        data_path, header_path = self._paths(key)
+        header = {'source': source,
+                  'shape': list(data.shape),
+                  'spacing': [float(s) for s in spacing],
+                  'landmark': None if landmark is None else [int(l) for l in landmark]}
+        # write to temporary files first so concurrent readers never see
+        # a partially written entry
+        tmp_suffix = '.tmp{}-{}'.format(os.getpid(), threading.get_ident())
+        with open(data_path + tmp_suffix, 'wb') as f:
+            np.save(f, to_uint8(data))
+        with open(header_path + tmp_suffix, 'w') as f:
+            json.dump(header, f)
+        os.replace(data_path + tmp_suffix, data_path)
+        os.replace(header_path + tmp_suffix, header_path)
+
+    def load_landmark(self, key):
+        """ return the landmark saved under key by save_landmark, or None on a miss
+        """
+        _, header_path = self._paths(key)
+        if not os.path.exists(header_path):
+            return None
+        try:
+            with open(header_path) as f:
+                header = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warn("Ignoring corrupted cache entry {}: {}".format(key, e))
+            return None
+        return np.asarray(header['landmark'], dtype='int')
+
+    def save_landmark(self, key, landmark, source=None):
+        """ store a resolved landmark under key
+        """
+        _, header_path = self._paths(key)
+        tmp_path = header_path + '.tmp{}-{}'.format(os.getpid(), threading.get_ident())
+        with open(tmp_path, 'w') as f:
+            json.dump({'source': source, 'landmark': [int(l) for l in landmark]}, f)
+        os.replace(tmp_path, header_path)
+
+
+class VolumeStore(object):
+    """ A packed, read-only store of pre-processed volumes for sharing across processes.
+
+        All volumes are concatenated as raw uint8 blocks in a single file and
+        described by a small index, both in the store directory:
+            volumes.raw - page aligned uint8 volumes in [width, height, depth] order
+            index.json  - maps a `VolumeCache` key to the offset, shape, spacing
+                          and source of a volume, or to a landmark and its source
+
+        The raw file is opened with `np.memmap` so every player, evaluator
+        thread and worker process maps the same pages read-only instead of
+        decoding its own copy. Stores are built once with `add` and `flush`
+        (see utils/build_volume_store.py) and only read afterwards.
+
+        Attributes:
+        directory: folder containing volumes.raw and index.json
+    """
+    # blocks are aligned to the page size so volumes never share a page
+    ALIGNMENT = 4096
+
+    def __init__(self, directory):
+        self.directory = os.path.expanduser(directory)
+        self.raw_path = os.path.join(self.directory, 'volumes.raw')
+        self.index_path = os.path.join(self.directory, 'index.json')
+        self.index = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                header = json.load(f)
+            if header.get('version') != CACHE_VERSION:
+                logger.warn("Volume store {} has version {}, expected {} - ignoring it".format(
+                    self.directory, header.get('version'), CACHE_VERSION))
+            else:
+                self.index = header['volumes']
+        self._raw = None
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def _mapping(self):
+        if self._raw is None:
+            self._raw = np.memmap(self.raw_path, dtype='uint8', mode='r')
+        return self._raw
+
+    def load(self, key):
+        """ return (data, landmark, spacing) of a stored volume or None if missing,
+        data is a read-only view of the memory mapped store
+        """
+        entry = self.index.get(key)
+        if entry is None:
+            return None
+        shape = tuple(entry['shape'])
+        offset = entry['offset']
+        data = self._mapping()[offset:offset + int(np.prod(shape))].reshape(shape)
+        landmark = entry['landmark']
+        if landmark is not None:
+            landmark = np.asarray(landmark, dtype='int')
+        return data, landmark, tuple(entry['spacing'])
+
+    def add(self, key, data, landmark, spacing, source=None):
+        """ append a pre-processed volume to the store, call `flush` to write the index
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        data = np.ascontiguousarray(to_uint8(data))
+        with open(self.raw_path, 'ab') as f:
+            offset = f.tell()
+            padding = -offset % self.ALIGNMENT
+            f.write(b'\0' * padding)
+            f.write(data.tobytes())
+        self.index[key] = {'offset': offset + padding,
+                           'shape': list(data.shape),
+                           'spacing': [float(s) for s in spacing],
+                           'landmark': None if landmark is None else [int(l) for l in landmark],
+                           'source': source}
+        # the file grew, re-map on the next load
+        self._raw = None
+
+    def load_landmark(self, key):
+        """ return the landmark stored under key, or None if missing
+        """
+        entry = self.index.get(key)
+        if entry is None:
+            return None
+        return np.asarray(entry['landmark'], dtype='int')
+
+    def add_landmark(self, key, landmark, source=None):
+        """ add a resolved landmark to the store, call `flush` to write the index
+        """
+        self.index[key] = {'landmark': [int(l) for l in landmark], 'source': source}
+
+    def flush(self):
+        """ write the index of the store
+        """
+        tmp_path = self.index_path + '.tmp{}'.format(os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': CACHE_VERSION, 'volumes': self.index}, f)
+        os.replace(tmp_path, self.index_path)
@@ -1,73 +1,185 @@
 ################################################################################
 ## Script to evaluate multiple models on test dataset and store results
 # Author: Faidon
+#
+# Every checkpoint of the model directories is evaluated on every test file in
+# a single process: the graph and the players are built once, the test
+# volumes are decoded once into a memory mapped volume store, and the weights
+# of the next checkpoint are read in a background thread while the current
+# one is evaluated (see evaluate_files for the batched episodes).
+# The results of every file are appended to one CSV table after every
+# checkpoint, and the checkpoints already in the table are skipped, so an
+# interrupted sweep resumes where it left off.
+#
+# Run from examples/LandmarkDetection/DQN, e.g.
+#   python results/evaluate_models.py --type BrainMRI --gpu 0
+#       --models train_log/experiment_1 --results results/eval_logs/experiment_1.csv
 ################################################################################
 
-import subprocess
 import os
+import sys
 import csv
 import time
+import argparse
+import threading
+from six.moves import queue
 
-data_type = "CardiacMRI"
-imperial_cluster = True
-csvfile = f"results/eval_logs/log_eval_{data_type}_{time.time()}.csv"
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 ################################################################################################
-# Step 1 - Set paths for model and test dataset
-if imperial_cluster:
-    redir = '/vol/biomedic/users/aa16914/shared/data/RL_data/' 
-    # model = "/volumes/project/2019/545/g1954503/oen19/LandmarkDetection/001/output/001/model-600000"
-    directory = "/vol/project/2019/545/g1954503/fm1710/LandmarkDetection/CardiacMRI/002/output/CardiacMRI002/" 
-else:
-    redir = 'data/filenames/'
-    # model = "/volumes/project/2019/545/g1954503/oen19/LandmarkDetection/001/output/001/model-600000"
-    directory = "/volumes/project/2019/545/g1954503/oen19/LandmarkDetection/FetalUS/001/output/FetalUS001/"
+# test dataset of every data type, in the files directory
+TEST_FILES = {
+    'BrainMRI': ('brain_test_files_new_paths.txt', 'brain_test_landmarks_new_paths.txt'),
+    'CardiacMRI': ('cardiac_test_files_new_paths.txt', 'cardiac_test_landmarks_new_paths.txt'),
+    'FetalUS': ('fetalUS_test_files_new_paths.txt', 'fetalUS_test_landmarks_new_paths.txt'),
+}
+# columns of the results table, a row per checkpoint and file
+FIELDS = ('model', 'checkpoint', 'step', 'filename', 'score', 'distError', 'steps', 'seconds',
+          'location', 'target')
 
-################################################################################################
-# Step 2 - Set test dataset paths depending on where it's running and datatype
-if data_type == 'BrainMRI':
-    # Default MRI
-    fname_images = f"{redir}brain_test_files_new_paths.txt"
-    fname_landmarks = f"{redir}brain_test_landmarks_new_paths.txt"
-elif data_type == 'CardiacMRI':
-    # Default cardiac
-    fname_images = f"{redir}cardiac_test_files_new_paths.txt"
-    fname_landmarks = f"{redir}cardiac_test_landmarks_new_paths.txt"
-elif data_type == 'FetalUS':
-    # Default fetal
-    fname_images = f"{redir}fetalUS_test_files_new_paths.txt"
-    fname_landmarks = f"{redir}fetalUS_test_landmarks_new_paths.txt"
 
-################################################################################################
-# Step 3 - Flag start of model assessment
-with open(csvfile, 'a') as outcsv:
-                fields= ['START MODEL', directory]
-                writer = csv.writer(outcsv)
-                writer.writerow(map(lambda x: x, fields))
-################################################################################################
-# Step 4 - Run test datasets on all model checkpoints
-for filename in os.listdir(directory):
-    if (filename.endswith(".index")):
-        model_name = os.path.splitext(filename)[0]
-        checkpoint = int(model_name.split('-')[1])
-        if checkpoint >= 100000 or checkpoint==50000:
-            model = os.path.join(directory, model_name)
-            with open(csvfile, 'a') as outcsv:
-                    fields= ['START CHECKPOINT', model]
-                    writer = csv.writer(outcsv)
-                    writer.writerow(map(lambda x: x, fields))        
-    
-            if imperial_cluster:
-                subprocess.run(["python3", "DQN.py", "--directory", csvfile, "--task", "eval", "--algo", "DQN", "--gpu", "0", "--load",
-                                model, "--files", 
-                                fname_images, fname_landmarks,  "--type", data_type ])
-            else:
-                subprocess.run(["python", "DQN.py", "--directory", csvfile, "--task", "eval", "--algo", "DQN", "--gpu", "0", "--load",
-                                model, "--files", 
-                                fname_images, fname_landmarks,  "--type", data_type ])                                        
-################################################################################################
-# Step 5 - Flag end of model assessment
-with open(csvfile, 'a') as outcsv:
-    fields= ['FINISH DIRECTORY']
-    writer = csv.writer(outcsv)
-    writer.writerow(map(lambda x: x, fields))
+def list_checkpoints(directories, min_step=0):
+    """ (step, path) of the checkpoints of the directories from step min_step,
+    in the order of the directories and their steps """
+    checkpoints = []
+    for directory in directories:
+        steps = sorted(int(filename[:-len('.index')].split('-')[1]) for filename in os.listdir(directory)
+                       if filename.startswith('model-') and filename.endswith('.index'))
+        checkpoints.extend((step, os.path.join(directory, 'model-{}'.format(step)))
+                           for step in steps if step >= min_step)
+    return checkpoints
+
+
+def evaluated_checkpoints(path):
+    """ checkpoints of the results table """
+    if not os.path.exists(path):
+        return set()
+    with open(path, newline='') as f:
+        return set(row['checkpoint'] for row in csv.DictReader(f))
+
+
+def read_checkpoint(path, names):
+    """ values of the variables names of the checkpoint path """
+    import tensorflow as tf
+    reader = tf.train.NewCheckpointReader(path)
+    return {name: reader.get_tensor(name) for name in names if reader.has_tensor(name)}
+
+
+def read_ahead(checkpoints, names, size):
+    """ yield (step, path, weights) of the checkpoints, reading up to size
+    checkpoints ahead in a background thread """
+    weights = queue.Queue(maxsize=size)
+
+    def read():
+        for step, path in checkpoints:
+            try:
+                weights.put((step, path, read_checkpoint(path, names)))
+            except Exception as e:
+                weights.put((step, path, e))
+        weights.put(None)
+
+    th = threading.Thread(target=read, name='CheckpointReader')
+    th.daemon = True
+    th.start()
+    while True:
+        item = weights.get()
+        if item is None:
+            break
+        yield item
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--models', nargs='+', required=True,
+                        help='directories of the checkpoints (model-<step>) to evaluate')
+    parser.add_argument('--type', help='the dataset to use',
+                        choices=sorted(TEST_FILES), default='CardiacMRI')
+    parser.add_argument('--files', type=argparse.FileType('r'), nargs=2,
+                        help='images and landmarks files of the test dataset (default: the test files of --type in --filesDir)')
+    parser.add_argument('--filesDir', help='directory of the default test files',
+                        default='data/filenames/')
+    parser.add_argument('--results', help='CSV table the results are appended to',
+                        default=None)
+    parser.add_argument('--volumeStore', help='volume store of the test volumes, built if missing (default: next to the results)',
+                        default=None)
+    parser.add_argument('--algo', help='algorithm of the models',
+                        choices=['DQN', 'Double', 'Dueling', 'DuelingDouble'], default='DQN')
+    parser.add_argument('--gpu', help='comma separated list of GPU(s) to use.')
+    parser.add_argument('--minStep', help='first step of the checkpoints to evaluate',
+                        default=0, type=int)
+    parser.add_argument('--evalEnvs', help='number of episodes stepped together with one batched prediction',
+                        default=8, type=int)
+    parser.add_argument('--readAhead', help='number of checkpoints read ahead of the evaluation',
+                        default=1, type=int)
+    parser.add_argument('--seed', help='seed of the start points, the same for every checkpoint',
+                        default=0, type=int)
+    parser.add_argument('--fastNorm', help='normalise image intensities with a single pass numpy path',
+                        action='store_true', default=False)
+    args = parser.parse_args()
+
+    if args.gpu:
+        os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu
+    results = args.results or "results/eval_logs/log_eval_{}_{}.csv".format(args.type, time.time())
+    store_dir = args.volumeStore or os.path.splitext(results)[0] + '_volumes'
+    files = args.files or [open(os.path.join(args.filesDir, name)) for name in TEST_FILES[args.type]]
+
+    ################################################################################################
+    # Step 1 - List the checkpoints not evaluated yet
+    done = evaluated_checkpoints(results)
+    checkpoints = [(step, path) for step, path in list_checkpoints(args.models, args.minStep)
+                   if path not in done]
+    print('{} checkpoints to evaluate, {} in {}'.format(len(checkpoints), len(done), results))
+    if not checkpoints:
+        sys.exit(0)
+
+    ################################################################################################
+    # Step 2 - Decode the test volumes once into the volume store
+    from RL.dataReader import filesListLandmark
+    from RL.volumeCache import VolumeStore
+    test_files = filesListLandmark(files, dataset=args.type, fast_normalisation=args.fastNorm)
+    test_files.export_to_store(VolumeStore(store_dir))
+
+    ################################################################################################
+    # Step 3 - Build the players and the graph once
+    import DQN
+    from RL.common import make_eval_players, evaluate_files
+    from tensorpack import PredictConfig, OfflinePredictor
+    import tensorflow as tf
+    DQN.METHOD = args.algo
+    DQN.STORE_DIR = store_dir
+    DQN.FAST_NORM = args.fastNorm
+    num_files = test_files.num_files
+    players = make_eval_players(DQN.get_player, num_files, args.evalEnvs, files, args.type)
+    DQN.NUM_ACTIONS = players[0].action_space.n
+    pred = OfflinePredictor(PredictConfig(
+        model=DQN.Model(DQN.IMAGE_SIZE, DQN.FRAME_HISTORY, DQN.METHOD, DQN.NUM_ACTIONS, DQN.GAMMA,
+                        ['CNN', 'FC']),
+        input_names=['state'],
+        output_names=['Qvalue']))
+    with pred.graph.as_default():
+        variables = {v.op.name: v for v in tf.global_variables()}
+
+    ################################################################################################
+    # Step 4 - Swap the weights of every checkpoint in place and append its results
+    new_table = not os.path.exists(results)
+    with open(results, 'a', newline='') as outcsv:
+        writer = csv.writer(outcsv)
+        if new_table:
+            writer.writerow(FIELDS)
+        for step, path, weights in read_ahead(checkpoints, sorted(variables), args.readAhead):
+            if isinstance(weights, Exception):
+                print('Cannot read {}: {}'.format(path, weights))
+                continue
+            missing = set(variables) - set(weights)
+            if missing:
+                print('{} misses {}, keeping their previous values'.format(path, sorted(missing)))
+            for name, value in weights.items():
+                variables[name].load(value, pred.sess)
+            t = time.time()
+            rows = evaluate_files(pred, DQN.get_player, num_files, players=players, seed=args.seed)
+            for row in rows:
+                writer.writerow([os.path.dirname(path), path, step] +
+                                [' '.join(str(x) for x in row[k]) if isinstance(row[k], list) else
+                                 '' if row[k] is None else row[k] for k in FIELDS[3:]])
+            outcsv.flush()
+            print('Evaluated {} in {:.1f}s'.format(path, time.time() - t))
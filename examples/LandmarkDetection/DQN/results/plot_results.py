@@ -24,39 +24,51 @@ mounted = os.path.exists("/volumes/project/")
 
 ############################################################################################################
 # Step 1 - Read logs and populate pandas
-with open(filename, newline='') as csvfile:
-    spamreader = csv.reader(csvfile, delimiter=' ', quotechar='|')
-    for row in spamreader:
-        if row:
-            if row[0]=="FINISH":
-                continue
-            elif row[0]=="START":
-                details = row[1].split(',')
-                if details[0]=="MODEL":
-                    folder = os.path.basename(os.path.dirname(details[1]))
-                    model_path = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(details[1]))), 'input', folder+'.txt')
-                    if mounted:
-                        if folder=="001":
-                            model_name="BrainMRI Baseline DQN"
-                        elif folder=="002":
-                            model_name="Test local point"
-                        elif folder=="003":
-                            model_name="Cardiac Baseline DQN"                            
-                        elif folder=="004":
-                            model_name="Default model in DQN folder"    
-                        elif folder =="006":
-                            model_name = "BrainMRI Baseline DQN - RERUN"
+with open(filename) as csvfile:
+    header = csvfile.readline()
+if header.startswith('model,'):
+    # results table of evaluate_models.py, a row per checkpoint and file
+    table = pd.read_csv(filename)
+    df_complete = pd.DataFrame({'model_path': table['model'],
+                                'model_name': table['model'].map(os.path.basename),
+                                'image_path': table['filename'],
+                                'checkpoint': table['step'],
+                                'score': table['score'],
+                                'distance_error': table['distError']})
+else:
+    with open(filename, newline='') as csvfile:
+        spamreader = csv.reader(csvfile, delimiter=' ', quotechar='|')
+        for row in spamreader:
+            if row:
+                if row[0]=="FINISH":
+                    continue
+                elif row[0]=="START":
+                    details = row[1].split(',')
+                    if details[0]=="MODEL":
+                        folder = os.path.basename(os.path.dirname(details[1]))
+                        model_path = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(details[1]))), 'input', folder+'.txt')
+                        if mounted:
+                            if folder=="001":
+                                model_name="BrainMRI Baseline DQN"
+                            elif folder=="002":
+                                model_name="Test local point"
+                            elif folder=="003":
+                                model_name="Cardiac Baseline DQN"                            
+                            elif folder=="004":
+                                model_name="Default model in DQN folder"    
+                            elif folder =="006":
+                                model_name = "BrainMRI Baseline DQN - RERUN"
+                            else:
+                                with open(model_path.replace("/vol/","/volumes/"), 'r') as file:
+                                    model_name = file.read().replace('\n', '')
                         else:
-                            with open(model_path.replace("/vol/","/volumes/"), 'r') as file:
-                                model_name = file.read().replace('\n', '')
+                            model_name = folder
                     else:
-                        model_name = folder
+                        checkpoint = int((os.path.basename(details[1])).split('-')[1])
                 else:
-                    checkpoint = int((os.path.basename(details[1])).split('-')[1])
-            else:
-                details = row[0].split(',')
-                df_complete.loc[entry] = [model_path, model_name, details[0], checkpoint, float(details[1]), float(details[2]) ]
-                entry += 1
+                    details = row[0].split(',')
+                    df_complete.loc[entry] = [model_path, model_name, details[0], checkpoint, float(details[1]), float(details[2]) ]
+                    entry += 1
 
 ############################################################################################################
 # Step 2 - Generate summary dataframe
@@ -0,0 +1,350 @@
+################################################################################
+## Micro-benchmarks of the environment hot paths on synthetic volumes
+# Run from examples/LandmarkDetection/DQN, e.g.
+#   python utils/benchmark.py crop --dims 200 200 200 --screen 45 45 45
+#   python utils/benchmark.py framestack --screen 45 45 45
+#   python utils/benchmark.py replay --memory 1e6
+#   python utils/benchmark.py memory --dims 200 200 200 --volumes 8
+################################################################################
+
+import os
+import sys
+import time
+import argparse
+import itertools
+import multiprocessing as mp
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gym import spaces
+from RL.medical import MedicalPlayer, FrameStack
+from RL.dataReader import ImageRecord
+from RL.cropping import VolumePyramid
+from RL.actions import move, apply_actions
+from RL.expreplay import ReplayMemory, PrioritizedReplay
+from RL.volumeCache import to_uint8
+
+
+def timeit(fn, repeat):
+    """ return the best time per call (in seconds) of three runs of repeat calls
+    """
+    best = float('inf')
+    for _ in range(3):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            fn()
+        best = min(best, (time.perf_counter() - start) / repeat)
+    return best
+
+
+def synthetic_player(dims, screen_dims, seed=0):
+    """ return a MedicalPlayer on a random uint8 volume, without a data loader
+    """
+    rng = np.random.RandomState(seed)
+    image = ImageRecord()
+    image.name = 'synthetic'
+    image.data = rng.randint(0, 256, size=dims).astype('uint8')
+    image.dims = image.data.shape
+    player = MedicalPlayer.__new__(MedicalPlayer)
+    player._image = image
+    player._image_dims = image.dims
+    player.screen_dims = screen_dims
+    player.width, player.height, player.depth = screen_dims
+    return player
+
+
+class SyntheticPlayer(MedicalPlayer):
+    """ MedicalPlayer whose episodes all sample the same random uint8 volume
+    """
+    def __init__(self, dims, **kwargs):
+        self._synthetic_dims = dims
+        super(SyntheticPlayer, self).__init__(**kwargs)
+
+    def set_dataLoader(self, files_list):
+        rng = np.random.RandomState(0)
+        image = ImageRecord()
+        image.name = 'synthetic.nii.gz'
+        image.data = rng.randint(0, 256, size=self._synthetic_dims).astype('uint8')
+        image.dims = image.data.shape
+        target = np.array([n // 2 for n in self._synthetic_dims])
+        self.sampled_files = itertools.repeat((image, target, image.name, (1, 1, 1)))
+
+
+def benchmark_crop(args):
+    player = synthetic_player(args.dims, args.screen)
+    data = player._image.data
+    rng = np.random.RandomState(1)
+    locations = [tuple(rng.randint(0, n) for n in args.dims) for _ in range(args.repeat)]
+    modes = [('full volume', None),
+             ('pyramid', 0),
+             ('padded pyramid', VolumePyramid.padding_for(args.screen))]
+    print('volume {} - screen {} - {} crops per run'.format(args.dims, args.screen, args.repeat))
+    for name, padding in modes:
+        if padding is None:
+            player._image.pyramid = None
+            build, nbytes = 0, 0
+        else:
+            start = time.perf_counter()
+            player._image.pyramid = VolumePyramid(data, padding=padding)
+            build = time.perf_counter() - start
+            nbytes = player._image.pyramid.nbytes
+        timings = []
+        for scale in (3, 2, 1):
+            player.xscale = player.yscale = player.zscale = scale
+            it = iter(locations * 3)
+
+            def crop():
+                player._location = next(it)
+                player._current_state()
+            timings.append('scale {}: {:7.1f} us'.format(scale, 1e6 * timeit(crop, args.repeat)))
+        print('{:15s} {} | build {:6.3f} s, {:7.1f} MB'.format(
+            name, ' '.join(timings), build, nbytes / 2.0 ** 20))
+
+
+def legacy_move(current_loc, act, action_step, dims):
+    """ the branches of MedicalPlayer.step before the action table """
+    go_out = False
+    if (act == 0):
+        next_location = (current_loc[0], current_loc[1], round(current_loc[2] + action_step))
+        if (next_location[2] >= dims[2]):
+            next_location = current_loc
+            go_out = True
+    if (act == 1):
+        next_location = (current_loc[0], round(current_loc[1] + action_step), current_loc[2])
+        if (next_location[1] >= dims[1]):
+            next_location = current_loc
+            go_out = True
+    if (act == 2):
+        next_location = (round(current_loc[0] + action_step), current_loc[1], current_loc[2])
+        if next_location[0] >= dims[0]:
+            next_location = current_loc
+            go_out = True
+    if act == 3:
+        next_location = (round(current_loc[0] - action_step), current_loc[1], current_loc[2])
+        if next_location[0] <= 0:
+            next_location = current_loc
+            go_out = True
+    if act == 4:
+        next_location = (current_loc[0], round(current_loc[1] - action_step), current_loc[2])
+        if next_location[1] <= 0:
+            next_location = current_loc
+            go_out = True
+    if act == 5:
+        next_location = (current_loc[0], current_loc[1], round(current_loc[2] - action_step))
+        if next_location[2] <= 0:
+            next_location = current_loc
+            go_out = True
+    return next_location, go_out
+
+
+def benchmark_actions(args):
+    rng = np.random.RandomState(1)
+    n = args.repeat
+    locations = np.stack([rng.randint(0, d, size=n) for d in args.dims], axis=1)
+    acts = rng.randint(0, 6, size=n)
+    steps = rng.choice([1, 3, 9], size=n)
+    samples = [(tuple(int(v) for v in l), int(a), int(s)) for l, a, s in zip(locations, acts, steps)]
+    # the action table gives the same moves as the branches
+    batch_locations, batch_go_out = apply_actions(locations, acts, steps, args.dims)
+    for (l, a, s), bl, bg in zip(samples, batch_locations, batch_go_out):
+        assert legacy_move(l, a, s, args.dims) == move(l, a, s, args.dims) == (tuple(bl), bg)
+
+    print('{} moves per run'.format(n))
+    for name, fn in [('branches', legacy_move), ('action table', move)]:
+        def run():
+            for l, a, s in samples:
+                fn(l, a, s, args.dims)
+        print('{:22s} {:7.3f} us per move'.format(name, 1e6 * timeit(run, 1) / n))
+    for batch in (8, 64, n):
+        chunks = [(locations[i:i + batch], acts[i:i + batch], steps[i:i + batch])
+                  for i in range(0, n, batch)]
+
+        def run():
+            for l, a, s in chunks:
+                apply_actions(l, a, s, args.dims)
+        print('{:22s} {:7.3f} us per move'.format('batch of {}'.format(batch), 1e6 * timeit(run, 1) / n))
+
+
+class FrameReplay(object):
+    """ minimal env replaying random uint8 frames, for timing FrameStack alone
+    """
+    def __init__(self, screen_dims, num_frames, episode_length, seed=0):
+        rng = np.random.RandomState(seed)
+        self.frames = [rng.randint(0, 256, size=screen_dims).astype('uint8')
+                       for _ in range(num_frames)]
+        self.episode_length = episode_length
+        self.observation_space = spaces.Box(low=0, high=255, shape=screen_dims, dtype=np.uint8)
+        self.action_space = spaces.Discrete(6)
+        self._cnt = 0
+
+    def reset(self):
+        self._cnt = 0
+        return self.frames[0]
+
+    def step(self, action, q_values, viewer):
+        self._cnt += 1
+        ob = self.frames[self._cnt % len(self.frames)]
+        return ob, 0.0, self._cnt >= self.episode_length, {}
+
+
+def benchmark_framestack(args):
+    k = 4
+    env = FrameReplay(args.screen, 16, args.repeat // 10)
+    # every mode stacks the same observations as np.stack
+    stacks = {mode: FrameStack(env, k, mode=mode) for mode in FrameStack.MODES}
+    obs = {mode: [np.array(stack.reset())] + [np.array(stack.step(0, None, None)[0]) for _ in range(2 * k)]
+           for mode, stack in stacks.items()}
+    for mode in FrameStack.MODES:
+        assert all((a == b).all() for a, b in zip(obs['stack'], obs[mode]))
+
+    print('screen {} - {} frames - {} steps per run'.format(args.screen, k, args.repeat))
+    for mode, stack in stacks.items():
+        for feed in (False, True):
+            def run():
+                ob = stack.reset()
+                for _ in range(args.repeat):
+                    ob, _, done, _ = stack.step(0, None, None)
+                    if feed:
+                        # the predictor feeds a contiguous batch of one observation
+                        np.ascontiguousarray(ob[None])
+                    if done:
+                        ob = stack.reset()
+            name = '{} + predictor feed'.format(mode) if feed else mode
+            print('{:22s} {:7.1f} us per step'.format(name, 1e6 * timeit(run, 1) / args.repeat))
+
+    # the same modes around the episodes of a MedicalPlayer, as played by
+    # play_one_episode: step, feed the observation to the predictor, reset
+    print('volume {} - MedicalPlayer episodes of at most {} steps - {} steps per run'.format(
+        args.dims, args.episode, args.repeat))
+    acts = np.random.RandomState(1).randint(0, 6, size=args.repeat)
+    for task in ('play', 'eval'):
+        timings, observations = [], {}
+        for mode in FrameStack.MODES:
+            stack = FrameStack(SyntheticPlayer(args.dims, task=task, screen_dims=args.screen,
+                                               max_num_frames=args.episode), k, mode=mode)
+            seen = observations.setdefault(mode, [])
+
+            def run():
+                # every run plays the same episodes
+                stack.unwrapped.rng = np.random.RandomState(0)
+                ob = stack.reset()
+                for act in acts:
+                    ob, _, done, _ = stack.step(act, None, None)
+                    np.ascontiguousarray(ob[None])
+                    if len(seen) < 4 * args.episode:
+                        seen.append(np.array(ob))
+                    if done:
+                        ob = stack.reset()
+            timings.append('{}: {:7.1f} us'.format(mode, 1e6 * timeit(run, 1) / args.repeat))
+        for mode in FrameStack.MODES:
+            assert all((a == b).all() for a, b in zip(observations['stack'], observations[mode]))
+        print('{:5s} per step {}'.format(task, ' '.join(timings)))
+
+
+def benchmark_replay(args):
+    batch_size = 48
+    rng = np.random.RandomState(1)
+    # the index sampling does not depend on the frames
+    mem = ReplayMemory(args.memory, (1, 1, 1), 4)
+    mem._curr_size = mem.max_size
+    low, high = 80, len(mem) - mem.window
+    priorities = PrioritizedReplay(mem.max_size)
+    start = time.perf_counter()
+    for pos in range(mem.max_size):
+        priorities.add(pos)
+    fill = time.perf_counter() - start
+    priorities.update(priorities.generation * mem.max_size + np.arange(mem.max_size),
+                      rng.exponential(size=mem.max_size))
+    td_errors = rng.exponential(size=batch_size)
+    keys = priorities.sample(rng, mem, batch_size, low, high, 0.4)[1]
+
+    def uniform():
+        rng.randint(low, high, size=batch_size)
+
+    def prioritized():
+        priorities.sample(rng, mem, batch_size, low, high, 0.4)
+
+    def update():
+        priorities.update(keys, td_errors)
+
+    print('memory {} - batch {}'.format(mem.max_size, batch_size))
+    print('{:22s} {:7.3f} us per transition'.format('add', 1e6 * fill / mem.max_size))
+    for name, fn in [('uniform sample', uniform), ('prioritized sample', prioritized),
+                     ('priority update', update)]:
+        t = timeit(fn, args.repeat)
+        print('{:22s} {:7.1f} us per batch, {:9.0f} samples/s'.format(name, 1e6 * t, batch_size / t))
+
+
+def resident_mb():
+    """ return the resident and peak resident memory of this process in MB (linux only)
+    """
+    with open('/proc/self/status') as f:
+        fields = dict(line.split(':', 1) for line in f if ':' in line)
+    return int(fields['VmRSS'].split()[0]) / 1024., int(fields['VmHWM'].split()[0]) / 1024.
+
+
+def hold_volumes(dims, screen_dims, num_volumes, uint8, conn):
+    """ decode-like pipeline run in a fresh process: normalised float32
+    volumes, rounded to uint8 if uint8, kept as the players keep them
+    """
+    rss, _ = resident_mb()
+    rng = np.random.default_rng(0)
+    players = []
+    for i in range(num_volumes):
+        # normalised intensities in [0, 255] in the [depth, height, width] order of SimpleITK
+        data = rng.random(dims[::-1], dtype='float32')
+        data *= 255
+        if uint8:
+            data = to_uint8(data, inplace=True)
+        player = synthetic_player((1, 1, 1), screen_dims)
+        player._image.data = data.transpose(2, 1, 0)
+        player._image.dims = player._image_dims = dims
+        player._image.pyramid = None
+        player._location = tuple(n // 2 for n in dims)
+        player.xscale = player.yscale = player.zscale = 1
+        players.append(player)
+    screen = players[0]._current_state()
+    after, peak = resident_mb()
+    conn.send((data.nbytes, screen.nbytes, after - rss, peak - rss))
+
+
+def benchmark_memory(args):
+    print('volume {} - screen {} - {} volumes per process'.format(args.dims, args.screen, args.volumes))
+    for name, uint8 in (('float32 (before)', False), ('uint8', True)):
+        parent_conn, child_conn = mp.Pipe()
+        proc = mp.Process(target=hold_volumes, args=(args.dims, args.screen, args.volumes, uint8, child_conn))
+        proc.start()
+        volume, screen, resident, peak = parent_conn.recv()
+        proc.join()
+        print('{:16s} volume {:7.1f} MB, screen {:6.1f} KB | process {:7.1f} MB resident, {:7.1f} MB peak'.format(
+            name, volume / 2. ** 20, screen / 2. ** 10, resident, peak))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dims', help='shape of the synthetic volume', type=int, nargs=3,
+                        default=[200, 200, 200])
+    parser.add_argument('--screen', help='shape of the screen', type=int, nargs=3,
+                        default=[45, 45, 45])
+    parser.add_argument('--repeat', help='number of calls per run', type=int, default=1000)
+    parser.add_argument('--memory', help='size of the replay memory', type=float, default=1e5)
+    parser.add_argument('--volumes', help='number of volumes held by a process', type=int, default=8)
+    parser.add_argument('--episode', help='maximum number of steps of the MedicalPlayer episodes',
+                        type=int, default=200)
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+    subparsers.add_parser('crop', help='MedicalPlayer._current_state with and without the pyramid')
+    subparsers.add_parser('actions', help='moves of the action table against the former branches')
+    subparsers.add_parser('framestack', help='FrameStack steps with np.stack against the rolling buffer,'
+                                            ' alone and around play/eval MedicalPlayer episodes')
+    subparsers.add_parser('replay', help='uniform and prioritized sampling of replay indexes')
+    subparsers.add_parser('memory', help='footprint of float32 and uint8 volumes and screens per process')
+    args = parser.parse_args()
+    args.dims, args.screen = tuple(args.dims), tuple(args.screen)
+
+    {'crop': benchmark_crop,
+     'actions': benchmark_actions,
+     'framestack': benchmark_framestack,
+     'replay': benchmark_replay,
+     'memory': benchmark_memory}[args.benchmark](args)
@@ -0,0 +1,39 @@
+################################################################################
+## Script to render the HITL logs of a dataset into a demonstration buffer
+# Run from examples/LandmarkDetection/DQN, e.g.
+#   python utils/build_hitl_buffer.py --buffer data/hitl_buffer --type BrainMRI
+# then pass --hitlBuffer data/hitl_buffer to DQN.py. Running it again only
+# renders the new or changed logs.
+################################################################################
+
+import os
+import sys
+import argparse
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from RL.hitl import hitl_paths, hitl_log_files, allowed_images, DemonstrationBuffer
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--buffer', help='directory of the demonstration buffer', required=True)
+    parser.add_argument('--type', help='the dataset of the logs',
+                        choices=['BrainMRI', 'CardiacMRI', 'FetalUS'], required=True)
+    parser.add_argument('--logDir', help='directory of the HITL log files (default: the one of RL/hitl.py)',
+                        default=None)
+    parser.add_argument('--imageDir', help='directory of the images of the logs (default: the one of RL/hitl.py)',
+                        default=None)
+    parser.add_argument('--trainFiles', help='train files list, logs of other images are skipped (default: the one of RL/hitl.py)',
+                        default=None)
+    parser.add_argument('--workers', help='number of processes rendering the logs (default 0: in process)',
+                        default=0, type=int)
+    args = parser.parse_args()
+
+    directory, image_directory, train_paths, type_name = hitl_paths(args.type)
+    buffer = DemonstrationBuffer(args.buffer)
+    rendered = buffer.update(hitl_log_files(args.logDir or directory, type_name),
+                             args.imageDir or image_directory,
+                             allowed_images(args.trainFiles or train_paths),
+                             workers=args.workers)
+    print('Rendered {} logs, demonstration buffer {} contains {} transitions of {} logs'.format(
+        rendered, args.buffer, len(buffer), len(buffer.logs)))
@@ -0,0 +1,53 @@
+################################################################################
+## Script to pack the pre-processed volumes of a files list into a VolumeStore
+# Run from examples/LandmarkDetection/DQN, e.g.
+#   python utils/build_volume_store.py --store data/volume_store --type BrainMRI
+#       --files './data/filenames/brain_train_files_new_paths.txt' './data/filenames/brain_train_landmarks_new_paths.txt'
+# then pass --volumeStore data/volume_store to DQN.py
+# With --pyramid or --paddedCrops (the same as given to DQN.py) the pyramids
+# of the volumes are stored too, so the players map them instead of building them
+################################################################################
+
+import os
+import sys
+import argparse
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from RL.dataReader import filesListLandmark, DATASETS
+from RL.volumeCache import VolumeStore
+from RL.cropping import VolumePyramid
+
+# screen of the agent of DQN.py, the padding of --paddedCrops depends on it
+SCREEN_DIMS = (45, 45, 45)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--store', help='directory of the volume store', required=True)
+    parser.add_argument('--type', help='the dataset to use',
+                        choices=sorted(DATASETS), required=True)
+    parser.add_argument('--files', type=argparse.FileType('r'), nargs='+', required=True,
+                        help="""Filepath to the text file that contains list of images.
+                                Pass a second file with the landmarks to store them with
+                                the volumes (needed for train and eval)""")
+    parser.add_argument('--cacheDir', help='directory of the pre-processed volume cache',
+                        default=None)
+    parser.add_argument('--fastNorm', help='normalise image intensities with a single pass numpy path',
+                        action='store_true', default=False)
+    parser.add_argument('--pyramid', help='also store the strided grids of every volume',
+                        choices=['stride', 'antialias'], default=None)
+    parser.add_argument('--paddedCrops', help='also store the padded grids of every volume',
+                        action='store_true', default=False)
+    args = parser.parse_args()
+    pyramid = 'stride' if args.paddedCrops and args.pyramid is None else args.pyramid
+
+    files = filesListLandmark(args.files,
+                              returnLandmarks=len(args.files) > 1,
+                              cache_dir=args.cacheDir,
+                              dataset=args.type,
+                              fast_normalisation=args.fastNorm,
+                              pyramid=pyramid,
+                              pyramid_padding=VolumePyramid.padding_for(SCREEN_DIMS) if args.paddedCrops else 0)
+    store = VolumeStore(args.store)
+    files.export_to_store(store)
+    print('Volume store {} contains {} volumes'.format(args.store, len(store)))